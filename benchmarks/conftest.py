@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import functools
+import os
+
+import pytest
+
+from hdx_scraper_insecurity_insight.synthetic_data import generate_scaled_api_response
+
+# Scales are multiples of the record counts in the api-samples, 1000x is slow so it is run by the
+# benchmark_large Makefile target rather than by default
+BENCHMARK_SCALES = [int(x) for x in os.environ.get("BENCHMARK_SCALES", "1,10,100").split(",")]
+BENCHMARK_DATASETS = os.environ.get(
+    "BENCHMARK_DATASETS",
+    "insecurity-insight-crsv-incidents,insecurity-insight-education-incidents,"
+    "insecurity-insight-aidworkerKIKA-incidents,insecurity-insight-crsv-overview",
+).split(",")
+
+
+@functools.lru_cache(maxsize=None)
+def cached_api_response(dataset_name: str, scale: int) -> list[dict]:
+    return generate_scaled_api_response(dataset_name, scale)
+
+
+@pytest.fixture(params=BENCHMARK_DATASETS)
+def dataset_name(request) -> str:
+    return request.param
+
+
+@pytest.fixture(params=BENCHMARK_SCALES, ids=lambda x: f"{x}x")
+def scale(request) -> int:
+    return request.param
+
+
+@pytest.fixture
+def api_response(dataset_name: str, scale: int) -> list[dict]:
+    # Functions which modify rows in place are given a copy of the rows
+    return [dict(x) for x in cached_api_response(dataset_name, scale)]
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Benchmarks of fetching from the local Insecurity Insight API stand-in in fake_api.py, with
+synthetic responses at each scale, a fixed latency and a bandwidth limit to approximate the API.
+"""
+
+import pytest
+
+from hdx_scraper_insecurity_insight.fake_api import FakeInsecurityInsightAPI
+from hdx_scraper_insecurity_insight.pipeline_scheduler import Task, run_task_graph
+from hdx_scraper_insecurity_insight.utilities import API_BASE_URL_VARIABLE, fetch_json_from_api
+
+pytest.importorskip("pytest_benchmark")
+
+API_LATENCY = 0.2
+API_BANDWIDTH = 20_000_000
+
+
+@pytest.fixture
+def fake_api(scale, monkeypatch):
+    with FakeInsecurityInsightAPI(scale=scale, latency=API_LATENCY, bandwidth=API_BANDWIDTH) as api:
+        monkeypatch.setenv(API_BASE_URL_VARIABLE, api.url)
+        yield api
+
+
+@pytest.fixture(params=[1, 4], ids=lambda x: f"{x}-workers")
+def max_workers(request) -> int:
+    return request.param
+
+
+def test_fetch_json_from_api(benchmark, fake_api, dataset_name):
+    # The first request builds the synthetic response so it is not timed
+    fetch_json_from_api(dataset_name)
+    api_response = benchmark.pedantic(
+        fetch_json_from_api, args=(dataset_name,), rounds=3, iterations=1
+    )
+    assert len(api_response) != 0
+
+
+def test_fetch_endpoints_concurrently(benchmark, fake_api, max_workers):
+    dataset_names = sorted(set(fake_api.endpoints.values()))
+    tasks = [Task(x, fetch_json_from_api, args=(x,)) for x in dataset_names]
+    run_task_graph(tasks, max_workers=8)
+
+    results, _ = benchmark.pedantic(
+        run_task_graph, args=(tasks,), kwargs={"max_workers": max_workers}, rounds=2
+    )
+    assert len(results) == len(dataset_names)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Load tests of dataset reads and uploads against the local HDX stand-in in fake_ckan.py, with a
+fixed latency per call to approximate HDX.
+"""
+
+import pytest
+
+from hdx.api.configuration import Configuration
+
+from hdx_scraper_insecurity_insight.create_datasets import create_datasets_in_hdx
+from hdx_scraper_insecurity_insight.create_spreadsheets import create_spreadsheet
+from hdx_scraper_insecurity_insight.fake_ckan import FakeCKANServer
+from hdx_scraper_insecurity_insight.pipeline_scheduler import Task, run_task_graph
+from hdx_scraper_insecurity_insight.run import (
+    fetch_and_cache_datasets,
+    fetch_dataset_for_cache,
+    list_datasets_to_cache,
+)
+from hdx_scraper_insecurity_insight.spreadsheet_buffers import SpreadsheetBuffers
+
+pytest.importorskip("pytest_benchmark")
+
+HDX_LATENCY = 0.05
+
+
+@pytest.fixture(scope="module")
+def fake_ckan():
+    with FakeCKANServer(latency=HDX_LATENCY) as server:
+        server.configure_hdx()
+        yield server
+    Configuration.delete()
+
+
+@pytest.fixture(params=[1, 4, 8], ids=lambda x: f"{x}-workers")
+def max_workers(request) -> int:
+    return request.param
+
+
+def fetch_datasets_concurrently(max_workers: int) -> dict:
+    tasks = [
+        Task(cache_key, fetch_dataset_for_cache, args=(dataset_name, country_filter))
+        for cache_key, dataset_name, country_filter in list_datasets_to_cache()
+    ]
+    results, _ = run_task_graph(tasks, max_workers=max_workers)
+    return results
+
+
+def test_fetch_datasets(benchmark, fake_ckan, max_workers):
+    dataset_cache = benchmark.pedantic(
+        fetch_datasets_concurrently, args=(max_workers,), rounds=3, iterations=1
+    )
+    assert len(dataset_cache) == len(list_datasets_to_cache())
+
+
+def test_concurrent_uploads(benchmark, fake_ckan, max_workers):
+    dataset_cache = fetch_and_cache_datasets(use_legacy=True)
+    # Countries whose datasets include a CRSV resource
+    countries = ["COD", "ETH", "NGA", "PSE", "SDN", "SSD", "UKR"]
+    with SpreadsheetBuffers() as spreadsheet_buffers:
+        for country in countries:
+            create_spreadsheet(
+                "insecurity-insight-crsv-incidents",
+                country_filter=country,
+                spreadsheet_buffers=spreadsheet_buffers,
+            )
+        tasks = [
+            Task(
+                country,
+                create_datasets_in_hdx,
+                args=("insecurity-insight-country-dataset",),
+                kwargs={
+                    "country_filter": country,
+                    "dataset_cache": dataset_cache,
+                    "dataset_date": "[2020-01-01T00:00:00 TO 2025-01-27T23:59:59]",
+                    "countries_group": [{"name": country.lower()}],
+                    "spreadsheet_buffers": spreadsheet_buffers,
+                },
+            )
+            for country in countries
+        ]
+        fake_ckan.reset_call_counts()
+        results, _ = benchmark.pedantic(
+            run_task_graph, args=(tasks,), kwargs={"max_workers": max_workers}, rounds=2
+        )
+    benchmark.extra_info["hdx_calls"] = dict(fake_ckan.call_counts)
+    assert len(results) == len(countries)
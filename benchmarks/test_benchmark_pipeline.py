@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Benchmarks for the stages which scale with the size of the API response, run with
+`make benchmark`. These need the optional pytest-benchmark package.
+"""
+
+import pytest
+
+from hdx_scraper_insecurity_insight.create_datasets import (
+    get_countries_group_from_api_response,
+    get_date_range_from_api_response,
+    get_date_range_from_resource_file,
+)
+from hdx_scraper_insecurity_insight.create_spreadsheets import (
+    build_typed_dataframe,
+    compile_row_transformer,
+    create_spreadsheet,
+    date_range_from_json,
+)
+from hdx_scraper_insecurity_insight.utilities import (
+    censor_event_description,
+    censor_location,
+    filter_json_rows,
+    read_schema,
+)
+
+pytest.importorskip("pytest_benchmark")
+
+
+def test_filter_json_rows_by_country(benchmark, api_response):
+    filtered_rows = benchmark(filter_json_rows, "SDN", "", api_response)
+    assert len(filtered_rows) < len(api_response)
+
+
+def test_filter_json_rows_by_year(benchmark, api_response):
+    filtered_rows = benchmark(filter_json_rows, "", "2024", api_response)
+    assert len(filtered_rows) < len(api_response)
+
+
+def test_censor_location(benchmark, api_response):
+    censored_rows = benchmark(censor_location, ["PSE"], api_response)
+    assert len(censored_rows) == len(api_response)
+
+
+def test_censor_event_description(benchmark, api_response):
+    censored_rows = benchmark(censor_event_description, api_response)
+    assert len(censored_rows) == len(api_response)
+
+
+def test_transform_to_typed_dataframe(benchmark, dataset_name, api_response):
+    # The transform create_spreadsheet makes: API rows to columns, then the typed DataFrame
+    hdx_row, row_template = read_schema(dataset_name)
+
+    def transform():
+        row_transformer = compile_row_transformer(row_template)
+        return build_typed_dataframe(hdx_row, row_transformer(api_response))
+
+    output_dataframe, _ = benchmark(transform)
+    assert len(output_dataframe) == len(api_response)
+
+
+def test_date_range_from_json(benchmark, api_response):
+    start_year, end_year = benchmark(date_range_from_json, api_response)
+    assert start_year <= end_year
+
+
+def test_get_date_range_from_api_response(benchmark, api_response):
+    start_date, end_date = benchmark(get_date_range_from_api_response, api_response, "SDN")
+    assert start_date <= end_date
+
+
+def test_get_countries_group_from_api_response(benchmark, api_response):
+    countries_group = benchmark(get_countries_group_from_api_response, api_response)
+    assert len(countries_group) > 1
+
+
+def test_create_spreadsheet(benchmark, tmp_path, dataset_name, api_response):
+    # Writing XLSX is slow at the larger scales so this is run once rather than calibrated
+    status = benchmark.pedantic(
+        create_spreadsheet,
+        args=(dataset_name,),
+        kwargs={"api_response": api_response, "output_directory": str(tmp_path)},
+        rounds=1,
+        iterations=1,
+    )
+    assert "Output filename" in status
+
+
+def test_get_date_range_from_resource_file(benchmark, tmp_path, dataset_name, api_response):
+    if "overview" in dataset_name:
+        pytest.skip("Date ranges are read from the incident spreadsheet")
+    create_spreadsheet(dataset_name, api_response=api_response, output_directory=str(tmp_path))
+    resource_filepath = str(next(tmp_path.iterdir()))
+
+    start_date, end_date = benchmark.pedantic(
+        get_date_range_from_resource_file, args=(resource_filepath,), rounds=1, iterations=1
+    )
+    assert start_date <= end_date
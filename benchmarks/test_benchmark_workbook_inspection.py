@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Benchmarks of reading the header and HXL tag rows of the legacy workbooks in spreadsheet-samples
+with workbook_inspection.py against reading the whole sheet with pandas.read_excel.
+"""
+
+import glob
+import os
+
+import pandas
+import pytest
+
+from hdx_scraper_insecurity_insight.workbook_inspection import (
+    read_workbook_column,
+    read_workbook_rows,
+)
+
+pytest.importorskip("pytest_benchmark")
+
+SPREADSHEET_SAMPLES = sorted(
+    glob.glob(
+        os.path.join(
+            os.path.dirname(__file__),
+            "..",
+            "src",
+            "hdx_scraper_insecurity_insight",
+            "spreadsheet-samples",
+            "*.xlsx",
+        )
+    )
+)
+
+
+@pytest.fixture(params=SPREADSHEET_SAMPLES, ids=os.path.basename)
+def workbook_filepath(request) -> str:
+    return request.param
+
+
+def test_read_excel_whole_sheet(benchmark, workbook_filepath):
+    sheet_df = benchmark.pedantic(pandas.read_excel, args=(workbook_filepath,), rounds=2)
+    assert len(sheet_df.columns) != 0
+
+
+def test_read_workbook_rows(benchmark, workbook_filepath):
+    rows = benchmark.pedantic(read_workbook_rows, args=(workbook_filepath,), rounds=5)
+    assert len(rows) == 2
+
+
+def test_read_workbook_column(benchmark, workbook_filepath):
+    column_name = read_workbook_rows(workbook_filepath, n_rows=1)[0][0]
+    values = benchmark.pedantic(
+        read_workbook_column, args=(workbook_filepath, column_name), rounds=2
+    )
+    assert len(values) != 0
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+A plan of the changes an update would make to HDX, computed from the API cache and the dataset
+cache without generating spreadsheets or writing to HDX, so that a scheduled run can stop early
+when there is nothing to publish.
+
+Each API response is partitioned once by (country, year) and each partition is hashed. The
+content hash of a spreadsheet combines the hashes of the partitions it would contain, so the
+filename and content of every topic and country spreadsheet are known without a transform. The
+hashes of the spreadsheets last published are kept in content-hashes.json. A spreadsheet is planned
+for regeneration if its hash has changed or it is not a resource of the dataset on HDX.
+
+The dataset fields set by create_datasets_in_hdx, dataset_date, groups, title and description,
+are compared with the datasets read from HDX. Country dataset dates depend on which topics are
+updated so are not compared.
+
+A run only updates the topics chosen by run.decide_which_resources_have_fresh_data, and all of
+the country datasets if any topic is chosen, so given those items_to_update the plan only counts
+changes to the datasets the run would update. Other datasets which differ from HDX, i.e. content
+changed without new dates, are listed as not_updated and do not set has_changes, so the
+scheduled job does not run again and again without publishing anything.
+
+plan = make_change_plan(api_cache, dataset_cache, items_to_update=items_to_update)
+if not plan["has_changes"]:
+    ... nothing to publish ...
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+
+from typing import Optional
+
+from hdx_scraper_insecurity_insight.checkpoints import load_checkpoint, save_checkpoint
+from hdx_scraper_insecurity_insight.create_datasets import (
+    get_countries_group_from_api_response,
+    get_date_range_from_api_response,
+)
+from hdx_scraper_insecurity_insight.create_spreadsheets import make_spreadsheet_filename
+from hdx_scraper_insecurity_insight.utilities import (
+    list_entities,
+    partition_api_response,
+    read_attributes,
+    read_countries,
+    read_insecurity_insight_attributes_pages,
+    read_insecurity_insight_resource_attributes,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+CONTENT_HASHES_DIRECTORY = os.path.dirname(__file__)
+CONTENT_HASHES_CHECKPOINT = "content-hashes"
+COUNTRY_DATASET_BASENAME = "insecurity-insight-country-dataset"
+
+CONTENT_HASHES_LOCK = threading.Lock()
+
+
+def hash_rows(rows: list[dict]) -> str:
+    content = json.dumps(rows, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+
+def make_content_index(api_response: list[dict]) -> dict[tuple[str, str], str]:
+    return {key: hash_rows(rows) for key, rows in partition_api_response(api_response).items()}
+
+
+def plan_spreadsheet(
+    resource_name: str, content_index: dict[tuple[str, str], str], country_filter: str = ""
+) -> Optional[dict]:
+    # The filename and content hash of the spreadsheet create_spreadsheet would write, or None if
+    # it would have no rows
+    attributes = read_attributes(resource_name)
+    year_filter = attributes.get("year_filter", "")
+    if year_filter == "current year":
+        year_filter = datetime.datetime.now().isoformat()[0:4]
+
+    keys = sorted(
+        key
+        for key in content_index
+        if (not country_filter or key[0] == country_filter)
+        and (not year_filter or key[1] == year_filter)
+    )
+    if len(keys) == 0:
+        return None
+
+    years = [key[1] for key in keys]
+    content_hash = hashlib.sha256()
+    for key in keys:
+        content_hash.update(f"{key[0]}:{key[1]}:{content_index[key]}".encode("utf-8"))
+    return {
+        "resource": resource_name,
+        "filename": make_spreadsheet_filename(country_filter, attributes, min(years), max(years)),
+        "hash": content_hash.hexdigest(),
+    }
+
+
+def plan_dataset_spreadsheets(
+    dataset_name: str,
+    api_cache: dict,
+    content_indexes: dict,
+    country_filter: str = "",
+) -> list[dict]:
+    if country_filter:
+        resource_names = read_attributes(COUNTRY_DATASET_BASENAME)["resource"]
+    else:
+        resource_names = [
+            x["ih_name"] for x in read_insecurity_insight_resource_attributes(dataset_name)
+        ]
+
+    spreadsheets = []
+    for resource_name in resource_names:
+        if resource_name not in api_cache or not read_attributes(resource_name):
+            continue
+        if resource_name not in content_indexes:
+            content_indexes[resource_name] = make_content_index(api_cache[resource_name])
+        spreadsheet = plan_spreadsheet(
+            resource_name, content_indexes[resource_name], country_filter=country_filter
+        )
+        if spreadsheet is not None:
+            spreadsheets.append(spreadsheet)
+    return spreadsheets
+
+
+def list_datasets_to_plan(
+    topics: Optional[list[str]] = None, countries: Optional[list[str]] = None
+) -> list[tuple[str, str, str]]:
+    # (dataset cache key, dataset name, country filter) as in run.list_datasets_to_cache
+    datasets = []
+    for dataset_name in list_entities(type_="dataset"):
+        if dataset_name == COUNTRY_DATASET_BASENAME:
+            continue
+        if topics is not None and not any(x in dataset_name for x in topics):
+            continue
+        datasets.append((dataset_name, dataset_name, ""))
+    if countries is None:
+        countries = list(read_countries().keys())
+    for country in countries:
+        cache_key = COUNTRY_DATASET_BASENAME.replace("country", country.lower())
+        datasets.append((cache_key, COUNTRY_DATASET_BASENAME, country))
+    return datasets
+
+
+def list_spreadsheet_hashes(
+    api_cache: dict, topics: Optional[list[str]] = None, countries: Optional[list[str]] = None
+) -> dict[str, str]:
+    content_indexes = {}
+    hashes = {}
+    for _, dataset_name, country_filter in list_datasets_to_plan(topics, countries):
+        for spreadsheet in plan_dataset_spreadsheets(
+            dataset_name, api_cache, content_indexes, country_filter=country_filter
+        ):
+            hashes[spreadsheet["filename"]] = spreadsheet["hash"]
+    return hashes
+
+
+def plan_dataset_fields(
+    dataset: dict, dataset_name: str, api_cache: dict, country_filter: str = ""
+) -> dict:
+    planned = {}
+    if country_filter:
+        dataset_name = dataset_name.replace("country", country_filter.lower())
+        planned["groups"] = [country_filter.lower()]
+    else:
+        incidents_response = api_cache.get(dataset_name.replace("-dataset", "-incidents"))
+        if incidents_response:
+            start_date, end_date = get_date_range_from_api_response(incidents_response)
+            planned["dataset_date"] = f"[{start_date} TO {end_date}]"
+            planned["groups"] = sorted(
+                x["name"] for x in get_countries_group_from_api_response(incidents_response)
+            )
+    ii_metadata = read_insecurity_insight_attributes_pages(dataset_name)
+    if ii_metadata:
+        planned["title"] = ii_metadata["Page"]
+        planned["description"] = ii_metadata["Page description"]
+
+    changed_fields = {}
+    for field, planned_value in planned.items():
+        current_value = dataset.get(field)
+        if field == "groups":
+            current_groups = {x["name"] for x in current_value or []}
+            added = sorted(set(planned_value).difference(current_groups))
+            removed = sorted(current_groups.difference(planned_value))
+            if len(added) != 0 or len(removed) != 0:
+                changed_fields[field] = {"added": added, "removed": removed}
+            continue
+        if field == "dataset_date":
+            is_changed = re.findall(r"\d{4}-\d{2}-\d{2}", current_value or "") != re.findall(
+                r"\d{4}-\d{2}-\d{2}", planned_value
+            )
+        else:
+            # HDX holds the dataset description as notes
+            if field == "description" and current_value is None:
+                current_value = dataset.get("notes")
+            is_changed = current_value != planned_value
+        if is_changed:
+            changed_fields[field] = {"current": current_value, "planned": planned_value}
+    return changed_fields
+
+
+def list_resource_names(dataset: dict) -> list[str]:
+    # Datasets read from HDX hold their resources apart from the dataset dictionary
+    if hasattr(dataset, "get_resources"):
+        resources = dataset.get_resources()
+    else:
+        resources = dataset.get("resources", [])
+    return [x["name"] for x in resources]
+
+
+def make_change_plan(
+    api_cache: dict,
+    dataset_cache: dict,
+    topics: Optional[list[str]] = None,
+    countries: Optional[list[str]] = None,
+    content_hashes: Optional[dict[str, str]] = None,
+    items_to_update: Optional[list[tuple[str, str, str]]] = None,
+) -> dict:
+    # If items_to_update is None every dataset is treated as one the run would update
+    if content_hashes is None:
+        content_hashes = load_content_hashes()
+
+    plan = {
+        "generated_at": datetime.datetime.now().isoformat(),
+        "has_changes": False,
+        "n_datasets": 0,
+        "n_spreadsheets": 0,
+        "topics": [],
+        "countries": [],
+        "not_updated": [],
+    }
+    content_indexes = {}
+    for cache_key, dataset_name, country_filter in list_datasets_to_plan(topics, countries):
+        if cache_key not in dataset_cache:
+            LOGGER.info(f"{cache_key} is not in the dataset cache, not planned")
+            continue
+        dataset = dataset_cache[cache_key]
+        plan["n_datasets"] += 1
+        resource_names = list_resource_names(dataset)
+        files = []
+        for spreadsheet in plan_dataset_spreadsheets(
+            dataset_name, api_cache, content_indexes, country_filter=country_filter
+        ):
+            plan["n_spreadsheets"] += 1
+            if spreadsheet["filename"] not in resource_names:
+                spreadsheet["reason"] = "not on HDX"
+            elif spreadsheet["filename"] not in content_hashes:
+                spreadsheet["reason"] = "not published by this scraper"
+            elif content_hashes[spreadsheet["filename"]] != spreadsheet["hash"]:
+                spreadsheet["reason"] = "content changed"
+            else:
+                continue
+            files.append(spreadsheet)
+
+        fields = plan_dataset_fields(dataset, dataset_name, api_cache, country_filter)
+        if len(files) == 0 and len(fields) == 0:
+            continue
+        entry = {
+            "dataset": cache_key,
+            "name": dataset.get("name"),
+            "fields": fields,
+            "files": files,
+        }
+        if not is_updated_by_run(dataset_name, country_filter, items_to_update):
+            plan["not_updated"].append(entry)
+        elif country_filter:
+            plan["has_changes"] = True
+            plan["countries"].append({"country": country_filter, **entry})
+        else:
+            plan["has_changes"] = True
+            plan["topics"].append(entry)
+
+    return plan
+
+
+def is_updated_by_run(
+    dataset_name: str, country_filter: str, items_to_update: Optional[list[tuple[str, str, str]]]
+) -> bool:
+    # As run.update_datasets_whose_resources_have_changed, which updates the datasets of each
+    # item and every country dataset if there is any item
+    if items_to_update is None:
+        return True
+    if country_filter:
+        return len(items_to_update) != 0
+    return any(x[0] in dataset_name for x in items_to_update)
+
+
+def log_change_plan(plan: dict):
+    LOGGER.info(
+        f"{len(plan['topics'])} topic and {len(plan['countries'])} country datasets of "
+        f"{plan['n_datasets']} would change"
+    )
+    for entry in plan["topics"] + plan["countries"]:
+        LOGGER.info(f"{entry['dataset']}:")
+        for field, values in entry["fields"].items():
+            if field == "groups":
+                LOGGER.info(f"    groups: added {values['added']}, removed {values['removed']}")
+            else:
+                LOGGER.info(f"    {field}: {values['current']} -> {values['planned']}")
+        for spreadsheet in entry["files"]:
+            LOGGER.info(f"    regenerate `{spreadsheet['filename']}`, {spreadsheet['reason']}")
+    for entry in plan.get("not_updated", []):
+        LOGGER.info(
+            f"{entry['dataset']} differs from HDX but has no new dates so would not be updated: "
+            f"fields {sorted(entry['fields'])}, {len(entry['files'])} files"
+        )
+
+
+def write_change_plan(plan: dict, output_directory: str) -> str:
+    timestamp = plan["generated_at"][0:19].replace(":", "").replace("-", "")
+    output_filepath = os.path.join(output_directory, f"plan-{timestamp}.json")
+    os.makedirs(output_directory, exist_ok=True)
+    with open(output_filepath, "w", encoding="utf-8") as plan_file:
+        json.dump(plan, plan_file, indent=2)
+
+    LOGGER.info(f"Change plan written to {output_filepath}")
+    return output_filepath
+
+
+def load_content_hashes(hashes_directory: Optional[str] = None) -> dict[str, str]:
+    if hashes_directory is None:
+        hashes_directory = CONTENT_HASHES_DIRECTORY
+    content_hashes = load_checkpoint(hashes_directory, CONTENT_HASHES_CHECKPOINT)
+    return content_hashes if content_hashes is not None else {}
+
+
+def record_published_spreadsheets(
+    api_cache: dict,
+    hashes_directory: Optional[str],
+    topics: Optional[list[str]] = None,
+    countries: Optional[list[str]] = None,
+):
+    # Called once datasets have been updated in HDX so that the next plan compares against them
+    if hashes_directory is None:
+        return
+    hashes = list_spreadsheet_hashes(api_cache, topics=topics, countries=countries)
+    with CONTENT_HASHES_LOCK:
+        content_hashes = load_content_hashes(hashes_directory)
+        content_hashes.update(hashes)
+        save_checkpoint(hashes_directory, CONTENT_HASHES_CHECKPOINT, content_hashes)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Checkpoints which allow an interrupted run to be resumed without repeating completed work.
+
+Each checkpoint is a JSON file in a state directory, written to a temporary file and renamed into
+place so an interrupted write never leaves a partial checkpoint. Checkpoints are:
+
+api-cache/{resource}.json - the censored API response for each resource
+api-profile/{resource}.json - the schema profile of each API response, see schema_profile.py
+items-to-update.json - the output of decide_which_resources_have_fresh_data
+spreadsheets.json - the topics and countries whose spreadsheets have been generated, with the
+    spreadsheet filenames so that a unit is only skipped if its files are still present
+uploads.json - the datasets which have been updated in HDX
+
+The state directory is cleared at the end of a successful run. State older than
+MAX_STATE_AGE_HOURS, which can be set with the INSECURITY_INSIGHT_MAX_STATE_AGE_HOURS environment
+variable, is discarded rather than resumed.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from typing import Any, Optional
+
+LOGGER = logging.getLogger(__name__)
+
+STATE_DIRECTORY = os.path.join(os.path.dirname(__file__), "run-state")
+MAX_STATE_AGE_VARIABLE = "INSECURITY_INSIGHT_MAX_STATE_AGE_HOURS"
+MAX_STATE_AGE_HOURS = float(os.environ.get(MAX_STATE_AGE_VARIABLE) or 24)
+STARTED_CHECKPOINT = "started"
+
+CHECKPOINT_LOCK = threading.Lock()
+
+
+def checkpoint_filepath(state_directory: str, name: str) -> str:
+    return os.path.join(state_directory, f"{name}.json")
+
+
+def save_checkpoint(state_directory: str, name: str, data: Any):
+    filepath = checkpoint_filepath(state_directory, name)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", dir=os.path.dirname(filepath), suffix=".tmp", delete=False
+    ) as temp_file:
+        json.dump(data, temp_file)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.replace(temp_file.name, filepath)
+
+
+def load_checkpoint(state_directory: str, name: str) -> Optional[Any]:
+    filepath = checkpoint_filepath(state_directory, name)
+    if not os.path.exists(filepath):
+        return None
+    with open(filepath, "r", encoding="utf-8") as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def clear_checkpoint(state_directory: str, name: str):
+    filepath = checkpoint_filepath(state_directory, name)
+    if os.path.exists(filepath):
+        os.remove(filepath)
+
+
+def start_run_state(
+    state_directory: str, resume: bool = False, max_age_hours: Optional[float] = None
+) -> bool:
+    """Prepares the state directory for a run, returning True if checkpoints from an earlier
+    run are to be used. State is discarded if resume is False or it is older than max_age_hours,
+    so a failed run is not resumed using a stale API snapshot.
+    """
+    if max_age_hours is None:
+        max_age_hours = MAX_STATE_AGE_HOURS
+    started = load_checkpoint(state_directory, STARTED_CHECKPOINT)
+    if resume and started is not None:
+        age_hours = (time.time() - started["timestamp"]) / 3600.0
+        if age_hours <= max_age_hours:
+            LOGGER.info(f"Resuming run started {age_hours:0.1f} hours ago from {state_directory}")
+            return True
+        LOGGER.info(f"Run state in {state_directory} is {age_hours:0.1f} hours old, discarding")
+
+    clear_run_state(state_directory)
+    save_checkpoint(state_directory, STARTED_CHECKPOINT, {"timestamp": time.time()})
+    return False
+
+
+def clear_run_state(state_directory: str):
+    if os.path.exists(state_directory):
+        shutil.rmtree(state_directory)
+
+
+def list_completed(state_directory: Optional[str], name: str) -> list[str]:
+    if state_directory is None:
+        return []
+    completed = load_checkpoint(state_directory, name)
+    return completed if completed is not None else []
+
+
+def mark_completed(state_directory: Optional[str], name: str, key: str):
+    if state_directory is None:
+        return
+    with CHECKPOINT_LOCK:
+        completed = list_completed(state_directory, name)
+        if key not in completed:
+            completed.append(key)
+            save_checkpoint(state_directory, name, completed)
+
+
+def read_completed_outputs(state_directory: Optional[str], name: str) -> dict[str, list[str]]:
+    if state_directory is None:
+        return {}
+    completed = load_checkpoint(state_directory, name)
+    return completed if completed is not None else {}
+
+
+def mark_completed_with_outputs(
+    state_directory: Optional[str], name: str, key: str, outputs: list[str]
+):
+    if state_directory is None:
+        return
+    with CHECKPOINT_LOCK:
+        completed = read_completed_outputs(state_directory, name)
+        completed[key] = outputs
+        save_checkpoint(state_directory, name, completed)
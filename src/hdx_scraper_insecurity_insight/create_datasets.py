@@ -1,19 +1,24 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import copy
 import datetime
 import logging
 import os
 import re
-import time
+import threading
 import traceback
 
 from pathlib import Path
+from typing import Optional
 
 import pandas
 
+from hdx.utilities.dateparse import now_utc_notz
 from hdx.utilities.easy_logging import setup_logging
+from hdx.utilities.file_hashing import get_size_and_hash
 from hdx.api.configuration import Configuration, ConfigurationError
+from hdx.api.utilities.filestore_helper import FilestoreHelper
 from hdx.data.dataset import Dataset
 from hdx.data.resource import Resource
 from hdx.location.country import Country
@@ -29,11 +34,26 @@ from hdx_scraper_insecurity_insight.utilities import (
     print_banner_to_log,
     read_countries,
 )
+from hdx_scraper_insecurity_insight.create_spreadsheets import change_filename_format
+from hdx_scraper_insecurity_insight.spreadsheet_buffers import SpreadsheetBuffers
+from hdx_scraper_insecurity_insight.metrics import span
+from hdx_scraper_insecurity_insight.profiling import profile_run
+from hdx_scraper_insecurity_insight.workbook_inspection import (
+    open_worksheet,
+    read_column,
+    read_rows,
+)
 
 setup_logging()
 LOGGER = logging.getLogger(__name__)
 
 COUNTRIES = read_countries()
+HDX_CONFIGURATION_LOCK = threading.Lock()
+RESOURCE_FILE_READERS = {
+    ".csv": pandas.read_csv,
+    ".parquet": pandas.read_parquet,
+    ".arrow": pandas.read_feather,
+}
 
 
 def marshall_datasets(dataset_name_pattern: str, country_pattern: str, hdx_site: str = "stage"):
@@ -59,7 +79,16 @@ def create_datasets_in_hdx(
     use_legacy: bool = False,
     dataset_date: str = None,
     countries_group: list[str] = None,
+    spreadsheet_buffers: SpreadsheetBuffers = None,
+    file_formats: list[str] = None,
 ) -> Dataset:
+    """Each resource is uploaded in file_formats, which defaults to the file_format attribute of
+    the resource. Further formats, i.e. a CSV companion to an XLSX spreadsheet, are uploaded as
+    separate resources and the first format is used to read the date range for descriptions.
+
+    A dataset which exists in HDX is updated by revise_dataset_in_hdx, which sends only what has
+    changed, otherwise the dataset is created.
+    """
     print_banner_to_log(LOGGER, "Create dataset")
     configure_hdx_connection(hdx_site)
     LOGGER.info(f"Dataset name: {dataset_name}")
@@ -67,7 +96,6 @@ def create_datasets_in_hdx(
     LOGGER.info(f"Dataset date provided: {dataset_date}")
     if countries_group is not None:
         LOGGER.info(f"Length of countries group provided: {len(countries_group)}")
-    t0 = time.time()
 
     if dataset_cache is None:
         dataset, _ = create_or_fetch_base_dataset(
@@ -82,6 +110,9 @@ def create_datasets_in_hdx(
         dataset_name = dataset_name.replace("country", country_filter.lower())
     LOGGER.info(f"Dataset name (used): {dataset['name']}")
     LOGGER.info(f"Dataset title: {dataset['title']}")
+    # The dataset as it is in HDX, to compare with once it has been updated
+    hdx_dataset_data = copy.deepcopy(dataset.data)
+    hdx_resources = [copy.deepcopy(x.data) for x in dataset.get_resources()]
     # This is where we get title, description and potentially name
     # from New-HDX-APIs-1-HDX-Home-Page.csv
     ii_metadata = read_insecurity_insight_attributes_pages(dataset_name)
@@ -112,6 +143,7 @@ def create_datasets_in_hdx(
     )  # Insecurity Insight 648d346e-3995-44cc-a559-29f8192a3010
 
     resource_list = []
+    upload_bytes = 0
 
     n_missing_resources = 0
     LOGGER.info("Resources:")
@@ -120,13 +152,26 @@ def create_datasets_in_hdx(
         # This skips the current year spreadsheet resources which have no dataset_name (yet)
         if not attributes:
             continue
-        resource_filepath = find_resource_filepath(
-            resource_name, attributes, country_filter=country_filter
-        )
+        resource_formats = file_formats
+        if resource_formats is None:
+            resource_formats = [attributes.get("file_format", "XLSX")]
+        resource_filepaths = {}
+        for file_format in resource_formats:
+            resource_filepath = find_resource_filepath(
+                resource_name,
+                attributes,
+                country_filter=country_filter,
+                spreadsheet_buffers=spreadsheet_buffers,
+                file_format=file_format,
+            )
+            if resource_filepath is None:
+                n_missing_resources += 1
+            else:
+                resource_filepaths[file_format.upper()] = resource_filepath
 
-        if resource_filepath is None:
-            n_missing_resources += 1
+        if len(resource_filepaths) == 0:
             continue
+        resource_filepath = list(resource_filepaths.values())[0]
 
         # Update resource_description
         resource_description = resource_descriptions[resource_name]
@@ -142,7 +187,12 @@ def create_datasets_in_hdx(
 
         # This is where we would get start and end dates for an actual dataset
         if "[to date]" in resource_description:
-            _, end_date = get_date_range_from_resource_file(resource_filepath)
+            _, end_date = get_date_range_from_resource_file(
+                find_dates_filepath(
+                    resource_name, resource_filepath, country_filter, spreadsheet_buffers
+                ),
+                spreadsheet_buffers=spreadsheet_buffers,
+            )
             # date_regex = re.findall(r"\d{4}-\d{2}-\d{2}", dataset_date)
             # if len(date_regex) == 2:
             #     most_recent_iso = date_regex[1]
@@ -158,15 +208,22 @@ def create_datasets_in_hdx(
             resource_description = resource_description.replace("[to date]", end_date_human)
             print(resource_description, flush=True)
 
-        resource = Resource(
-            {
-                "name": os.path.basename(resource_filepath),
-                "description": resource_description,
-                "format": attributes.get("file_format", "XLSX"),
-            }
-        )
-        resource.set_file_to_upload(resource_filepath)
-        resource_list.append(resource)
+        for file_format, resource_filepath in resource_filepaths.items():
+            resource = Resource(
+                {
+                    "name": os.path.basename(resource_filepath),
+                    "description": resource_description,
+                    "format": file_format,
+                }
+            )
+            if spreadsheet_buffers is None:
+                resource.set_file_to_upload(resource_filepath)
+            else:
+                resource.set_file_to_upload(
+                    spreadsheet_buffers.get_filepath(os.path.basename(resource_filepath))
+                )
+            upload_bytes += os.path.getsize(resource.get_file_to_upload())
+            resource_list.append(resource)
 
     resource_list_names = [x["name"] for x in resource_list]
 
@@ -174,36 +231,187 @@ def create_datasets_in_hdx(
     if not dry_run:
         LOGGER.info("Dry_run flag not set so data written to HDX")
         dataset_name = dataset["name"]
-        dataset.create_in_hdx(hxl_update=False)
-        # Reorder resources so that the datasets from the API come first - code from hdx-cli-toolkit
-        revised_dataset = Dataset.read_from_hdx(dataset_name)
-        resources_check = revised_dataset.get_resources()
-
-        reordered_resource_ids = [
-            x["id"] for x in resources_check if x["name"] in resource_list_names
-        ]
-        reordered_resource_ids.extend(
-            [x["id"] for x in resources_check if x["name"] not in resource_list_names]
-        )
-
-        revised_dataset.reorder_resources(hxl_update=False, resource_ids=reordered_resource_ids)
+        with span("upload", resource=dataset_name, country=country_filter) as upload_metrics:
+            upload_metrics["records"] = len(resource_list)
+            upload_metrics["bytes"] = upload_bytes
+            try:
+                if "id" in hdx_dataset_data:
+                    n_uploads, upload_metrics["bytes"] = revise_dataset_in_hdx(
+                        dataset, hdx_dataset_data, hdx_resources, resource_list
+                    )
+                    upload_metrics["records"] = n_uploads
+                else:
+                    create_dataset_in_hdx(dataset, resource_list_names)
+            except Exception:
+                # The dataset is put back as it was read from HDX so that a retry of the upload
+                # compares with HDX and sends the same changes
+                restore_dataset(dataset, hdx_dataset_data, hdx_resources)
+                raise
+        LOGGER.info(f"Upload took {upload_metrics['wall_time']:0.2f} seconds")
 
     else:
         LOGGER.info("Dry_run flag set so no data written to HDX")
     LOGGER.info(f"{n_missing_resources} of {len(resource_names)} resources missing")
     LOGGER.info(f"Processing finished at {datetime.datetime.now().isoformat()}")
-    LOGGER.info(f"Elapsed time: {time.time() - t0: 0.2f} seconds")
 
     return dataset, n_missing_resources
 
 
+def restore_dataset(dataset: Dataset, dataset_data: dict, resources: list[dict]):
+    dataset.data = copy.deepcopy(dataset_data)
+    dataset.data["resources"] = [copy.deepcopy(x) for x in resources]
+    dataset.init_resources()
+    dataset.separate_resources()
+
+
+def create_dataset_in_hdx(dataset: Dataset, resource_list_names: list[str]):
+    dataset.create_in_hdx(hxl_update=False)
+    # Reorder resources so that the datasets from the API come first - code from
+    # hdx-cli-toolkit. The resources and their ids are those returned by the create call so the
+    # dataset is not read back from HDX
+    resources = dataset.get_resources()
+    resource_ids = [x["id"] for x in resources]
+    reordered_resource_ids = order_resource_ids(resources, resource_list_names)
+    if reordered_resource_ids == resource_ids:
+        LOGGER.info("Resources are already in order, no reorder made")
+        return
+    dataset.reorder_resources(reordered_resource_ids)
+
+
+def order_resource_ids(resources: list[dict], resource_list_names: list[str]) -> list[str]:
+    reordered_resource_ids = [x["id"] for x in resources if x["name"] in resource_list_names]
+    reordered_resource_ids.extend(
+        [x["id"] for x in resources if x["name"] not in resource_list_names]
+    )
+    return reordered_resource_ids
+
+
+def revise_dataset_in_hdx(
+    dataset: Dataset,
+    hdx_dataset_data: dict,
+    hdx_resources: list[dict],
+    resource_list: list[Resource],
+) -> tuple[int, int]:
+    """Updates a dataset which exists in HDX with one package_revise call holding only the fields
+    which differ from hdx_dataset_data and hdx_resources, the dataset as read from HDX. If any
+    resource has changed the resources are sent in their new order, those in resource_list first,
+    so no reorder call is needed. A file is only uploaded if its content hash differs from the
+    hash of the resource in HDX. No call is made if nothing has changed. Returns the number of
+    files and bytes uploaded.
+    """
+    dataset_patch = make_dataset_patch(hdx_dataset_data, dataset.data)
+    resource_payloads, files_to_upload = make_resource_payloads(hdx_resources, resource_list)
+    n_unchanged = len(resource_list) - len(files_to_upload)
+    LOGGER.info(
+        f"Uploading {len(files_to_upload)} changed files, {n_unchanged} files unchanged, "
+        f"dataset fields changed: {sorted(dataset_patch.keys())}"
+    )
+
+    revise_filter = []
+    if resource_payloads != hdx_resources or len(files_to_upload) != 0:
+        # The resources are replaced as a whole so that they take the order of the list
+        revise_filter.append("-resources")
+        dataset_patch["resources"] = resource_payloads
+    if len(dataset_patch) == 0:
+        LOGGER.info(f"{dataset['name']} is unchanged in HDX, no update made")
+        return 0, 0
+
+    dataset_patch["updated_by_script"] = (
+        f"{dataset.configuration.get_user_agent()} "
+        f"({now_utc_notz().isoformat(timespec='microseconds')})"
+    )
+    revised_dataset = Dataset.revise(
+        {"id": hdx_dataset_data["id"]},
+        filter=revise_filter,
+        update=dataset_patch,
+        files_to_upload=files_to_upload,
+    )
+    # The dataset, which may be in the dataset cache, is brought up to date with HDX
+    dataset_data = revised_dataset.data
+    dataset_data["resources"] = [x.data for x in revised_dataset.get_resources()]
+    dataset.data = dataset_data
+    dataset.init_resources()
+    dataset.separate_resources()
+    LOGGER.info(f"Updated {dataset.get_hdx_url()}")
+
+    return len(files_to_upload), sum(os.path.getsize(x) for x in files_to_upload.values())
+
+
+def make_dataset_patch(hdx_dataset_data: dict, dataset_data: dict) -> dict:
+    # HDX returns groups with more than their names and dataset dates with times, so these are
+    # compared by name and by date
+    dataset_patch = {}
+    for key, value in dataset_data.items():
+        hdx_value = hdx_dataset_data.get(key)
+        if key == "resources":
+            continue
+        if key == "groups":
+            is_changed = sorted(x["name"] for x in value or []) != sorted(
+                x["name"] for x in hdx_value or []
+            )
+        elif key == "dataset_date":
+            is_changed = re.findall(r"\d{4}-\d{2}-\d{2}", value or "") != re.findall(
+                r"\d{4}-\d{2}-\d{2}", hdx_value or ""
+            )
+        else:
+            is_changed = value != hdx_value
+        if is_changed:
+            dataset_patch[key] = value
+    return dataset_patch
+
+
+def make_resource_payloads(
+    hdx_resources: list[dict], resource_list: list[Resource]
+) -> tuple[list[dict], dict[str, str]]:
+    # The resources of resource_list are matched to those in HDX by name and come first, followed
+    # by any other resources in HDX in their current order. Files to upload are keyed by the
+    # package_revise field for the position of their resource.
+    hdx_resources_by_name = {x["name"]: x for x in hdx_resources}
+    resource_payloads = []
+    files_to_upload = {}
+    for resource in resource_list:
+        hdx_resource = hdx_resources_by_name.get(resource["name"])
+        if hdx_resource is None:
+            resource_payload = copy.deepcopy(resource.data)
+        else:
+            resource_payload = copy.deepcopy(hdx_resource)
+            resource_payload.update(resource.data)
+        # HDX holds formats as mapped by hdx-python-api, i.e. XLSX as xlsx
+        resource.correct_format(resource_payload)
+        file_to_upload = resource.get_file_to_upload()
+        size, content_hash = get_size_and_hash(file_to_upload, resource["format"].lower())
+        if hdx_resource is None or hdx_resource.get("hash") != content_hash:
+            resource_payload.pop("last_modified", None)
+            resource_payload.pop("tracking_summary", None)
+            resource_payload.update(
+                {
+                    "url": FilestoreHelper.temporary_url,
+                    "url_type": "upload",
+                    "resource_type": "file.upload",
+                    "size": size,
+                    "hash": content_hash,
+                }
+            )
+            files_to_upload[f"update__resources__{len(resource_payloads)}__upload"] = file_to_upload
+        resource_payloads.append(resource_payload)
+
+    resource_list_names = [x["name"] for x in resource_list]
+    resource_payloads.extend(
+        copy.deepcopy(x) for x in hdx_resources if x["name"] not in resource_list_names
+    )
+    return resource_payloads, files_to_upload
+
+
 def create_or_fetch_base_dataset(
     dataset_name: str,
     country_filter: str = "",
     force_create: bool = False,
     use_legacy: bool = False,
     hdx_site: str = "stage",
+    inventory: Optional[dict] = None,
 ) -> tuple[dict, bool]:
+    # With an organization inventory from read_insecurity_insight_hdx.py the dataset is taken
+    # from the inventory rather than read from HDX
     is_new = True
     dataset_attributes = read_attributes(dataset_name)
     configure_hdx_connection(hdx_site)
@@ -211,12 +419,13 @@ def create_or_fetch_base_dataset(
         dataset_name = dataset_name.replace("country", country_filter.lower())
 
     if use_legacy:
-        legacy_dataset_name = get_legacy_dataset_name(dataset_name, country_filter=country_filter)
-        dataset = Dataset.read_from_hdx(legacy_dataset_name)
-        dataset_label = legacy_dataset_name
+        dataset_label = get_legacy_dataset_name(dataset_name, country_filter=country_filter)
     else:
-        dataset = Dataset.read_from_hdx(dataset_name)
         dataset_label = dataset_name
+    if inventory is not None:
+        dataset = dataset_from_inventory(inventory, dataset_label)
+    else:
+        dataset = Dataset.read_from_hdx(dataset_label)
 
     if dataset is not None and not force_create:
         is_new = False
@@ -240,48 +449,57 @@ def create_or_fetch_base_dataset(
     return dataset, is_new
 
 
+def dataset_from_inventory(inventory: dict, dataset_name: str) -> Optional[Dataset]:
+    inventory_entry = inventory["datasets"].get(dataset_name)
+    if inventory_entry is None:
+        return None
+    return Dataset(copy.deepcopy(inventory_entry))
+
+
 def find_resource_filepath(
     resource_name: list[str],
     attributes: dict,
     country_filter: str = "",
     spreadsheet_directory: str = None,
+    spreadsheet_buffers: SpreadsheetBuffers = None,
+    file_format: str = None,
 ):
     if spreadsheet_directory is None:
         spreadsheet_directory = os.path.join(os.path.dirname(__file__), "output-spreadsheets")
-    file_list = Path(spreadsheet_directory)
+    if file_format is None:
+        file_format = attributes.get("file_format", "XLSX")
+    # Spreadsheets held in memory are matched by name rather than scanning the directory
+    if spreadsheet_buffers is None:
+        file_list = list(Path(spreadsheet_directory).iterdir())
+    else:
+        file_list = [
+            Path(spreadsheet_directory, filename) for filename in spreadsheet_buffers.filenames()
+        ]
     files = []
 
     year_filter = attributes.get("year_filter", "")
     # Finds year range files
     country_iso = ""
+    if (country_filter is not None) and (len(country_filter) != 0):
+        country_iso = f"-{country_filter}"
     spreadsheet_regex_range = ""
     if len(year_filter) == 0:
-        if (country_filter is not None) and (len(country_filter) != 0):
-            country_iso = f"-{country_filter}"
-        spreadsheet_regex_range = (
-            attributes["filename_template"]
-            .replace("{start_year}", "[0-9]{4}")
-            .replace("{end_year}", "[0-9]{4}")
-            .replace("{country_iso}", country_iso)
+        spreadsheet_regex_range = make_spreadsheet_regex(
+            attributes["filename_template"], file_format, country_iso
         )
-        for file_ in file_list.iterdir():
-            matching_files = re.search(spreadsheet_regex_range, str(file_))
+        for file_ in file_list:
+            matching_files = re.fullmatch(spreadsheet_regex_range, os.path.basename(file_))
             if matching_files is not None:
                 files.append(matching_files.group())
 
     # Finds single year range files
     spreadsheet_regex_single_year = ""
     if len(files) == 0:
-        spreadsheet_regex_single_year = (
-            attributes["filename_template"]
-            .replace("{start_year}", "[0-9]{4}")
-            .replace("-{end_year}", "")
-            .replace("{country_iso}", country_iso)
+        spreadsheet_regex_single_year = make_spreadsheet_regex(
+            attributes["filename_template"], file_format, country_iso, single_year=True
         )
-        for file_ in file_list.iterdir():
-            matching_files = re.search(
-                "^" + spreadsheet_regex_single_year, str(os.path.basename(file_))
-            )
+        for file_ in file_list:
+            matching_files = re.fullmatch(spreadsheet_regex_single_year, os.path.basename(file_))
             if matching_files is not None:
                 files.append(matching_files.group())
 
@@ -302,6 +520,42 @@ def find_resource_filepath(
     return filepath
 
 
+def find_dates_filepath(
+    resource_name: str,
+    resource_filepath: str,
+    country_filter: str = "",
+    spreadsheet_buffers: SpreadsheetBuffers = None,
+) -> str:
+    # Overview spreadsheets have years rather than dates so dates are read from the incidents
+    # spreadsheet, which may cover more years than the overview so is found by its own name
+    if not resource_name.endswith("-overview"):
+        return resource_filepath
+    incidents_name = resource_name.replace("-overview", "-incidents")
+    incidents_filepath = find_resource_filepath(
+        incidents_name,
+        read_attributes(incidents_name),
+        country_filter=country_filter,
+        spreadsheet_buffers=spreadsheet_buffers,
+    )
+    return incidents_filepath if incidents_filepath is not None else resource_filepath
+
+
+def make_spreadsheet_regex(
+    filename_template: str, file_format: str, country_iso: str, single_year: bool = False
+) -> str:
+    # filename_template has an .xlsx extension whatever the file_format so it is swapped for the
+    # extension of file_format, and the rest of the template is escaped so that it matches
+    # literally
+    spreadsheet_regex = re.escape(change_filename_format(filename_template, file_format))
+    if single_year:
+        spreadsheet_regex = spreadsheet_regex.replace(re.escape("-{end_year}"), "")
+    return (
+        spreadsheet_regex.replace(re.escape("{start_year}"), "[0-9]{4}")
+        .replace(re.escape("{end_year}"), "[0-9]{4}")
+        .replace(re.escape("{country_iso}"), re.escape(country_iso))
+    )
+
+
 def get_date_and_country_ranges_from_resources(
     resource_names: list[str], country_filter: str = "", use_sample=False
 ):
@@ -351,20 +605,33 @@ def get_date_range_from_api_response(
     return start_date, end_date
 
 
-def get_date_range_from_resource_file(resource_filepath: str) -> str:
+def get_date_range_from_resource_file(
+    resource_filepath: str, spreadsheet_buffers: SpreadsheetBuffers = None
+) -> str:
     if "Overview" in resource_filepath:
         resource_filepath = resource_filepath.replace("Overview", "Incident")
+    if spreadsheet_buffers is not None:
+        resource_filepath = spreadsheet_buffers.get_filepath(os.path.basename(resource_filepath))
 
     start_date = None
     end_date = None
 
-    sheets_df = pandas.read_excel(resource_filepath)
-    # sheets_df.drop(sheets_df.head(1).index, inplace=True)
-    first_row = sheets_df.to_dict(orient="records")[0]
+    resource_file_reader = RESOURCE_FILE_READERS.get(os.path.splitext(resource_filepath)[1].lower())
+    if resource_file_reader is None:
+        # Only the date column of a workbook is read, rather than the whole sheet
+        with open_worksheet(resource_filepath) as worksheet:
+            date_field, _ = pick_date_and_iso_country_fields(
+                dict.fromkeys(read_rows(worksheet, 1)[0])
+            )
+            dates = [x for x in read_column(worksheet, date_field) if x is not None]
+    else:
+        sheets_df = resource_file_reader(resource_filepath)
+        # sheets_df.drop(sheets_df.head(1).index, inplace=True)
+        first_row = sheets_df.to_dict(orient="records")[0]
 
-    date_field, _ = pick_date_and_iso_country_fields(first_row)
+        date_field, _ = pick_date_and_iso_country_fields(first_row)
 
-    dates = sheets_df[date_field].to_list()
+        dates = sheets_df[date_field].to_list()
     start_date = str(min(dates))  # .replace("Z", "")
     end_date = str(max(dates))  # .replace("Z", "")
     print(start_date, end_date, flush=True)
@@ -401,6 +668,22 @@ def get_legacy_dataset_name(dataset_name: str, country_filter: str = "") -> str
 
 
 def configure_hdx_connection(hdx_site: str = "stage"):
+    # Datasets may be updated from several threads so the shared configuration is only replaced
+    # when the site changes. A configuration for a custom HDX url, such as the local stand-in in
+    # fake_ckan.py, is kept whatever site is requested
+    with HDX_CONFIGURATION_LOCK:
+        try:
+            current_site = Configuration.read().hdx_site
+            if current_site == "hdx_custom_site":
+                return
+            if hdx_site is not None and current_site == f"hdx_{hdx_site}_site":
+                return
+        except ConfigurationError:
+            pass
+        _configure_hdx_connection(hdx_site)
+
+
+def _configure_hdx_connection(hdx_site: str = "stage"):
     try:
         Configuration.delete()
         Configuration.create(
@@ -420,4 +703,5 @@ def configure_hdx_connection(hdx_site: str = "stage"):
 if __name__ == "__main__":
     HDX_SITE = "stage"
     DATASET_NAME, COUNTRY_CODE = parse_commandline_arguments()
-    marshall_datasets(DATASET_NAME, COUNTRY_CODE, HDX_SITE)
+    with profile_run("create_datasets"):
+        marshall_datasets(DATASET_NAME, COUNTRY_CODE, HDX_SITE)
@@ -3,12 +3,29 @@
 
 """
 This code generates an Excel file from the API response
+
+The incidents spreadsheet for a topic and its current-year spreadsheet read the same API endpoint.
+Given a spreadsheet_indexes dictionary, create_spreadsheet transforms the incidents API response
+once into a spreadsheet index: the typed DataFrame of all rows, sorted by date, with the row
+positions of each (country, year) partition. Since the rows are sorted by date each year is a
+contiguous range, so the current-year spreadsheet is a slice of the DataFrame made for the
+incidents spreadsheet, with no second filter_json_rows scan and no second transform.
+
+spreadsheet_indexes = {}
+create_spreadsheet("insecurity-insight-crsv-incidents", spreadsheet_indexes=spreadsheet_indexes)
+create_spreadsheet(
+    "insecurity-insight-crsv-incidents-current-year", spreadsheet_indexes=spreadsheet_indexes
+)
 """
 
 import datetime
+import io
 import logging
+import operator
 import os
-import time
+import re
+
+from typing import Callable, Optional
 
 import pandas
 from pandas.io.formats import excel
@@ -24,6 +41,15 @@ from hdx_scraper_insecurity_insight.utilities import (
     parse_commandline_arguments,
     pick_date_and_iso_country_fields,
 )
+from hdx_scraper_insecurity_insight.spreadsheet_buffers import SpreadsheetBuffers
+from hdx_scraper_insecurity_insight.profiling import profile_run
+from hdx_scraper_insecurity_insight.metrics import (
+    configure_memory_tracking,
+    log_metrics_summary,
+    make_metrics_report,
+    reset_metrics,
+    span,
+)
 
 setup_logging()
 LOGGER = logging.getLogger(__name__)
@@ -41,7 +67,7 @@ def marshall_spreadsheets(dataset_name_pattern: str, country_pattern: str) -> li
     LOGGER.info(f"Output directory: {OUTPUT_DIRECTORY}")
     status_list = []
 
-    t0 = time.time()
+    reset_metrics()
     if dataset_name_pattern.lower() != "all":
         status = create_spreadsheet(dataset_name_pattern)
         status_list.append(status)
@@ -50,13 +76,16 @@ def marshall_spreadsheets(dataset_name_pattern: str, country_pattern: str) -> li
 
         LOGGER.info(f"Attributes file contains {len(dataset_names)} resource names")
 
+        spreadsheet_indexes = {}
         for dataset_name in dataset_names:
-            status = create_spreadsheet(dataset_name, country_pattern)
+            status = create_spreadsheet(
+                dataset_name, country_pattern, spreadsheet_indexes=spreadsheet_indexes
+            )
             status_list.append(status)
 
     LOGGER.info("\n")
     LOGGER.info("Processing complete")
-    LOGGER.info(f"Processing took {time.time() - t0:0.2f} seconds")
+    log_metrics_summary(make_metrics_report())
     return status_list
 
 
@@ -66,13 +95,17 @@ def create_spreadsheet(
     year_filter: str = None,
     api_response: list[dict] = None,
     output_directory: str = None,
+    file_formats: list[str] = None,
+    spreadsheet_buffers: SpreadsheetBuffers = None,
+    spreadsheet_indexes: Optional[dict] = None,
 ) -> str:
     LOGGER.info(f"Processing {dataset_name}")
     if output_directory is None:
         output_directory = OUTPUT_DIRECTORY
-    output_rows = []
 
     attributes = read_attributes(dataset_name)
+    if file_formats is None:
+        file_formats = [attributes.get("file_format", "XLSX")]
 
     if not year_filter:
         year_filter = attributes.get("year_filter", "")
@@ -96,9 +129,28 @@ def create_spreadsheet(
 
     # output_rows.append(hdx_row)
 
-    filtered_rows = filter_json_rows(country_filter, year_filter, api_response)
+    # Only incident rows are indexed, overview rows are ordered by country rather than by date
+    use_index = (
+        spreadsheet_indexes is not None and "-incidents" in dataset_name and len(api_response) != 0
+    )
+    if use_index:
+        # The index is shared by the resources which read the same endpoint with the same schema
+        index_key = (modified_dataset_name, attributes.get("api_url", ""))
+        if index_key not in spreadsheet_indexes:
+            spreadsheet_indexes[index_key] = make_spreadsheet_index(
+                modified_dataset_name, api_response, hdx_row, row_template
+            )
+        with span("partition", resource=dataset_name, country=country_filter) as partition_metrics:
+            output_dataframe, years = select_from_spreadsheet_index(
+                spreadsheet_indexes[index_key], country_filter, year_filter
+            )
+            n_rows = partition_metrics["records"] = len(output_dataframe)
+    else:
+        with span("partition", resource=dataset_name, country=country_filter) as partition_metrics:
+            filtered_rows = filter_json_rows(country_filter, year_filter, api_response)
+            n_rows = partition_metrics["records"] = len(filtered_rows)
 
-    if len(filtered_rows) == 0:
+    if n_rows == 0:
         status = (
             f"API reponse for `{dataset_name}` with country_filter {country_filter} "
             "contained no data"
@@ -106,16 +158,10 @@ def create_spreadsheet(
         LOGGER.info(status)
         return status
 
-    output_rows.extend(transform_input_rows(row_template, filtered_rows))
-
-    output_dataframe = pandas.DataFrame.from_dict(output_rows)
-
-    # Type conversions
-    type_dict = make_type_dict(hdx_row)
-    output_dataframe = output_dataframe.astype(type_dict, errors="ignore")
-    for key, value in type_dict.items():
-        if value == "datetime64[ns, UTC]":
-            output_dataframe[key] = output_dataframe[key].dt.date
+    if not use_index:
+        output_dataframe = transform_api_rows(
+            dataset_name, filtered_rows, hdx_row, row_template, country_filter=country_filter
+        )
 
     # Add hdx_row
     # hdx_row_df = pandas.DataFrame(hdx_row, index=[0])
@@ -125,37 +171,185 @@ def create_spreadsheet(
     # print(output_dataframe, flush=True)
 
     # Generate filename
-    filename = generate_spreadsheet_filename(country_filter, attributes, filtered_rows)
+    if use_index:
+        filename = make_spreadsheet_filename(country_filter, attributes, min(years), max(years))
+    else:
+        filename = generate_spreadsheet_filename(country_filter, attributes, filtered_rows)
+
+    # All formats are written from the same DataFrame so there is no second transform
+    filenames = []
+    for file_format in file_formats:
+        output_filename = change_filename_format(filename, file_format)
+        with span("write", resource=dataset_name, country=country_filter) as write_metrics:
+            write_metrics["records"] = len(output_dataframe)
+            if spreadsheet_buffers is None:
+                output_filepath = os.path.join(output_directory, output_filename)
+                SPREADSHEET_WRITERS[file_format.upper()](output_dataframe, output_filepath)
+                write_metrics["bytes"] = os.path.getsize(output_filepath)
+            else:
+                output_buffer = io.BytesIO()
+                SPREADSHEET_WRITERS[file_format.upper()](output_dataframe, output_buffer)
+                spreadsheet_buffers.add(output_filename, output_buffer.getvalue())
+                write_metrics["bytes"] = output_buffer.getbuffer().nbytes
+        filenames.append(output_filename)
+
+    status = f"Output filename `{'`, `'.join(filenames)}`"
+    return status
+
 
+def transform_api_rows(
+    dataset_name: str,
+    api_rows: list[dict],
+    hdx_row: dict,
+    row_template: dict,
+    country_filter: str = None,
+) -> pandas.DataFrame:
+    with span("transform", resource=dataset_name, country=country_filter) as transform_metrics:
+        row_transformer = compile_row_transformer(row_template)
+        output_dataframe, cast_failures = build_typed_dataframe(hdx_row, row_transformer(api_rows))
+        transform_metrics["records"] = len(output_dataframe)
+    for key, failed_rows in cast_failures.items():
+        LOGGER.warning(
+            f"{len(failed_rows)} values in `{key}` for `{dataset_name}` could not be converted "
+            f"to {make_type_dict(hdx_row)[key]} and were left empty, first rows: {failed_rows[0:5]}"
+        )
+    return output_dataframe
+
+
+def make_spreadsheet_index(
+    dataset_name: str, api_response: list[dict], hdx_row: dict, row_template: dict
+) -> dict:
+    """Transforms api_response once into {"dataframe": ..., "partitions": {(country, year):
+    [row positions]}, "year_ranges": {year: (start, stop)}}. Rows are sorted by date, newest
+    first as the API returns them, so each year is a contiguous range of the DataFrame.
+    """
+    date_field, iso_country_field = pick_date_and_iso_country_fields(api_response[0])
+    # The sort is stable so rows with the same date keep their API order
+    sorted_rows = sorted(api_response, key=lambda x: str(x[date_field]), reverse=True)
+
+    partitions = {}
+    year_ranges = {}
+    for i, api_row in enumerate(sorted_rows):
+        year = str(api_row[date_field])[0:4]
+        partitions.setdefault((api_row[iso_country_field], year), []).append(i)
+        start, _ = year_ranges.get(year, (i, i))
+        year_ranges[year] = (start, i + 1)
+
+    return {
+        "dataframe": transform_api_rows(dataset_name, sorted_rows, hdx_row, row_template),
+        "partitions": partitions,
+        "year_ranges": year_ranges,
+    }
+
+
+def select_from_spreadsheet_index(
+    spreadsheet_index: dict, country_filter: str = None, year_filter: str = None
+) -> tuple[pandas.DataFrame, list[str]]:
+    # Returns the rows for a country and/or year, in date order, and the years they cover
+    dataframe = spreadsheet_index["dataframe"]
+    if not country_filter:
+        if not year_filter:
+            return dataframe, sorted(spreadsheet_index["year_ranges"])
+        if year_filter not in spreadsheet_index["year_ranges"]:
+            return dataframe.iloc[0:0], []
+        start, stop = spreadsheet_index["year_ranges"][year_filter]
+        return dataframe.iloc[start:stop].reset_index(drop=True), [year_filter]
+
+    keys = [
+        key
+        for key in spreadsheet_index["partitions"]
+        if key[0] == country_filter and (not year_filter or key[1] == year_filter)
+    ]
+    positions = sorted(x for key in keys for x in spreadsheet_index["partitions"][key])
+    return dataframe.take(positions).reset_index(drop=True), sorted(key[1] for key in keys)
+
+
+def list_output_filenames(status: str) -> list[str]:
+    # The filenames written by create_spreadsheet, read back from its status message
+    if not status.startswith("Output filename"):
+        return []
+    return re.findall(r"`([^`]+)`", status)
+
+
+def write_xlsx(output_dataframe: pandas.DataFrame, output_filepath: str | io.BytesIO):
     # We can make the output an Excel table:
     # https://stackoverflow.com/questions/58326392/how-to-create-excel-table-with-pandas-to-excel
     excel.ExcelFormatter.header_style = None
-
-    output_filepath = os.path.join(output_directory, filename)
     output_dataframe.to_excel(
         output_filepath,
         index=False,
     )
 
-    status = f"Output filename `{filename}`"
-    return status
 
+def write_csv(output_dataframe: pandas.DataFrame, output_filepath: str | io.BytesIO):
+    output_dataframe.to_csv(output_filepath, index=False, encoding="utf-8")
+
+
+def write_parquet(output_dataframe: pandas.DataFrame, output_filepath: str | io.BytesIO):
+    # Parquet and Arrow outputs need the optional pyarrow package
+    output_dataframe.to_parquet(output_filepath, index=False)
 
-def transform_input_rows(row_template: dict, filtered_rows: list[dict]) -> list[dict]:
-    transformed_rows = []
-    for api_row in filtered_rows:
-        transformed_row = row_template.copy()
-        for key, value in row_template.items():
-            transformed_row[key] = api_row.get(value, "")
-        transformed_rows.append(transformed_row)
 
-    return transformed_rows
+def write_arrow(output_dataframe: pandas.DataFrame, output_filepath: str | io.BytesIO):
+    output_dataframe.to_feather(output_filepath)
+
+
+SPREADSHEET_WRITERS = {
+    "XLSX": write_xlsx,
+    "CSV": write_csv,
+    "PARQUET": write_parquet,
+    "ARROW": write_arrow,
+}
+
+FILE_EXTENSIONS = {
+    "XLSX": ".xlsx",
+    "CSV": ".csv",
+    "PARQUET": ".parquet",
+    "ARROW": ".arrow",
+}
+
+
+def change_filename_format(filename: str, file_format: str) -> str:
+    return os.path.splitext(filename)[0] + FILE_EXTENSIONS[file_format.upper()]
+
+
+def compile_row_transformer(row_template: dict) -> Callable[[list[dict]], dict[str, list]]:
+    # Returns a function which converts API rows directly to spreadsheet columns, avoiding a
+    # dictionary per row. Records missing an upstream field fall back to an empty string
+    field_names = list(row_template.keys())
+    upstream_fields = list(row_template.values())
+    if len(upstream_fields) == 0:
+        return lambda api_rows: {}
+    row_getter = operator.itemgetter(*upstream_fields)
+
+    def row_transformer(api_rows: list[dict]) -> dict[str, list]:
+        try:
+            row_values = [row_getter(api_row) for api_row in api_rows]
+        except KeyError:
+            return {
+                key: [api_row.get(value, "") for api_row in api_rows]
+                for key, value in row_template.items()
+            }
+
+        if len(upstream_fields) == 1:
+            return {field_names[0]: row_values}
+        if len(row_values) == 0:
+            return {key: [] for key in field_names}
+        return {key: list(column) for key, column in zip(field_names, zip(*row_values))}
+
+    return row_transformer
 
 
 def generate_spreadsheet_filename(
     country_filter: str, attributes: dict, json_response: list[dict]
 ) -> str:
     start_year, end_year = date_range_from_json(json_response)
+    return make_spreadsheet_filename(country_filter, attributes, start_year, end_year)
+
+
+def make_spreadsheet_filename(
+    country_filter: str, attributes: dict, start_year: str, end_year: str
+) -> str:
     country_iso = ""
     if (country_filter is not None) and (len(country_filter) != 0):
         country_iso = f"-{country_filter}"
@@ -178,6 +372,46 @@ def date_range_from_json(json_response: list[dict]) -> tuple[str, str]:
     return start_year, end_year
 
 
+def build_typed_dataframe(
+    hdx_row: dict, columns: dict[str, list]
+) -> tuple[pandas.DataFrame, dict[str, list[int]]]:
+    # Converts each column once using the types from the HXL tags in the schema. Empty strings and
+    # None are treated as missing values, other values which cannot be converted are returned
+    # as row numbers by column name rather than silently leaving the column as strings
+    type_dict = make_type_dict(hdx_row)
+    typed_columns = {}
+    cast_failures = {}
+    for key, values in columns.items():
+        typed_columns[key], failed_rows = cast_column(values, type_dict.get(key, str))
+        if len(failed_rows) != 0:
+            cast_failures[key] = failed_rows
+
+    return pandas.DataFrame(typed_columns), cast_failures
+
+
+def cast_column(values: list, column_type) -> tuple[pandas.Series, list[int]]:
+    column = pandas.Series(values, dtype=object)
+    if column_type == str:
+        return column.astype(str), []
+
+    is_missing = column.isna() | (column == "")
+    present_values = column.where(~is_missing)
+    if column_type == "datetime64[ns, UTC]":
+        converted = pandas.to_datetime(present_values, utc=True, errors="coerce", format="ISO8601")
+        is_failed = converted.isna() & ~is_missing
+        typed_column = converted.dt.date
+    else:
+        converted = pandas.to_numeric(present_values, errors="coerce")
+        is_failed = converted.isna() & ~is_missing
+        if column_type == "Int64":
+            is_failed = is_failed | (converted.notna() & (converted % 1 != 0))
+            typed_column = converted.where(~is_failed).astype("Int64")
+        else:
+            typed_column = converted.where(~is_failed).astype(column_type)
+
+    return typed_column, column.index[is_failed].tolist()
+
+
 def make_type_dict(row_template: dict) -> dict:
     type_dict = {}
 
@@ -200,4 +434,6 @@ def make_type_dict(row_template: dict) -> dict:
 
 if __name__ == "__main__":
     DATASET_NAME, COUNTRY_CODE = parse_commandline_arguments()
-    STATUS_LIST = marshall_spreadsheets(DATASET_NAME, COUNTRY_CODE)
+    configure_memory_tracking()
+    with profile_run("create_spreadsheets"):
+        STATUS_LIST = marshall_spreadsheets(DATASET_NAME, COUNTRY_CODE)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+A local, in-process stand-in for the Insecurity Insight API used to benchmark and regression test
+fetching without network access.
+
+FakeInsecurityInsightAPI runs a threaded HTTP server on localhost which serves each endpoint at
+the path of its api_url attribute, i.e. /hdx/v1/sv. Responses are the api-samples files or, if a
+scale is given or there is no sample, synthetic responses from synthetic_data.py. Setting
+INSECURITY_INSIGHT_API_BASE_URL to the server url makes fetch_json_from_api use it.
+
+Latency can be a fixed value, a value per dataset or a list of values which is replayed in
+request order so that a recorded latency profile gives the same timings on every run. Bandwidth
+limits the rate at which responses are written. Bursts of failures, optionally with a
+Retry-After header, can be injected for an endpoint. Responses have an ETag and requests with a
+matching If-None-Match header get a 304 response. Requests are counted per dataset.
+
+with FakeInsecurityInsightAPI(latency=[0.5, 0.1, 0.1]) as server:
+    os.environ["INSECURITY_INSIGHT_API_BASE_URL"] = server.url
+    ... run pipeline functions ...
+    print(server.call_counts)
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import urlparse
+
+from hdx_scraper_insecurity_insight.synthetic_data import generate_scaled_api_response
+from hdx_scraper_insecurity_insight.utilities import list_entities, read_attributes
+
+LOGGER = logging.getLogger(__name__)
+
+API_SAMPLES_DIRECTORY = os.path.join(os.path.dirname(__file__), "api-samples")
+WRITE_CHUNK_SIZE = 65536
+
+
+class FakeInsecurityInsightAPI:
+    def __init__(
+        self,
+        scale: Optional[int] = None,
+        countries: Optional[list[str]] = None,
+        latency: float | dict[str, float] | list[float] = 0.0,
+        bandwidth: Optional[float] = None,
+        seed: int = 0,
+    ):
+        self.scale = scale
+        self.countries = countries
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.seed = seed
+        self.call_counts = collections.Counter()
+        self.endpoints = list_endpoints()
+        self._responses: dict[str, tuple[bytes, str]] = {}
+        self._failures: dict[str, list[tuple[int, Optional[int]]]] = collections.defaultdict(list)
+        self._n_requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        if self._server is None:
+            raise RuntimeError("FakeInsecurityInsightAPI has not been started")
+        host, port = self._server.server_address[0:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> str:
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), make_request_handler(self))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        )
+        self._thread.start()
+        LOGGER.info(f"Fake Insecurity Insight API listening at {self.url}")
+        return self.url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self) -> "FakeInsecurityInsightAPI":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def fail_next(
+        self,
+        dataset_name: str,
+        count: int = 1,
+        status: int = 503,
+        retry_after: Optional[int] = None,
+    ):
+        with self._lock:
+            self._failures[dataset_name].extend([(status, retry_after)] * count)
+
+    def reset_call_counts(self):
+        with self._lock:
+            self.call_counts.clear()
+            self._n_requests = 0
+
+    def read_response(self, dataset_name: str) -> tuple[bytes, str]:
+        # Responses are built on first request and then kept so that ETags are stable
+        with self._lock:
+            if dataset_name not in self._responses:
+                content = make_api_response(dataset_name, self.scale, self.countries, self.seed)
+                etag = f'"{hashlib.sha1(content).hexdigest()}"'
+                self._responses[dataset_name] = (content, etag)
+            return self._responses[dataset_name]
+
+    def handle_request(
+        self, path: str
+    ) -> tuple[Optional[str], Optional[tuple[int, Optional[int]]]]:
+        dataset_name = self.endpoints.get(path.rstrip("/"))
+        with self._lock:
+            request_index = self._n_requests
+            self._n_requests += 1
+            failure = None
+            if dataset_name is not None:
+                self.call_counts[dataset_name] += 1
+                if len(self._failures[dataset_name]) != 0:
+                    failure = self._failures[dataset_name].pop(0)
+
+        if isinstance(self.latency, dict):
+            latency = self.latency.get(dataset_name, 0.0)
+        elif isinstance(self.latency, list):
+            latency = self.latency[request_index % len(self.latency)]
+        else:
+            latency = self.latency
+        if latency > 0:
+            time.sleep(latency)
+
+        return dataset_name, failure
+
+
+def list_endpoints() -> dict[str, str]:
+    # The current-year resources share an endpoint with the full resource
+    endpoints = {}
+    for dataset_name in list_entities(type_="resource"):
+        if dataset_name.endswith("-current-year"):
+            continue
+        api_url = read_attributes(dataset_name).get("api_url")
+        if api_url is not None:
+            endpoints[urlparse(api_url).path.rstrip("/")] = dataset_name
+    return endpoints
+
+
+def make_api_response(
+    dataset_name: str,
+    scale: Optional[int] = None,
+    countries: Optional[list[str]] = None,
+    seed: int = 0,
+) -> bytes:
+    sample_filepath = os.path.join(
+        API_SAMPLES_DIRECTORY, read_attributes(dataset_name).get("api_response_filename", "")
+    )
+    if scale is None and os.path.isfile(sample_filepath):
+        with open(sample_filepath, "rb") as sample_file:
+            return sample_file.read()
+
+    api_response = generate_scaled_api_response(
+        dataset_name, scale or 1, countries=countries, seed=seed
+    )
+    return json.dumps(api_response).encode("utf-8")
+
+
+def make_request_handler(fake_server: FakeInsecurityInsightAPI) -> type:
+    class FakeAPIRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            dataset_name, failure = fake_server.handle_request(urlparse(self.path).path)
+            if dataset_name is None:
+                self._send(404, b"Not found", "text/plain")
+                return
+            if failure is not None:
+                status, retry_after = failure
+                headers = {} if retry_after is None else {"Retry-After": str(retry_after)}
+                self._send(status, b"Service Unavailable", "text/plain", headers)
+                return
+
+            content, etag = fake_server.read_response(dataset_name)
+            if self.headers.get("If-None-Match") == etag:
+                self._send(304, b"", "application/json", {"ETag": etag})
+                return
+            self._send(200, content, "application/json", {"ETag": etag})
+
+        def _send(
+            self,
+            status: int,
+            content: bytes,
+            content_type: str,
+            headers: Optional[dict[str, str]] = None,
+        ):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            if status != 304:
+                self.send_header("Content-Length", str(len(content)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            if fake_server.bandwidth is None:
+                self.wfile.write(content)
+                return
+            # Write in chunks, sleeping so that the average rate matches bandwidth in bytes/s
+            for start in range(0, len(content), WRITE_CHUNK_SIZE):
+                end = start + WRITE_CHUNK_SIZE
+                chunk = content[start:end]
+                self.wfile.write(chunk)
+                time.sleep(len(chunk) / fake_server.bandwidth)
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            LOGGER.debug(format % args)
+
+    return FakeAPIRequestHandler
@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+A local, in-process stand-in for the HDX CKAN API used for integration and load testing without
+network access or credentials.
+
+FakeCKANServer runs a threaded HTTP server on localhost which implements the CKAN actions used
+by hdx-python-api for this pipeline: package_show, package_create, package_update,
+package_revise (including file uploads), package_resource_reorder, package_list,
+package_search, organization_list, organization_show and vocabulary_show. Uploaded files are kept
+in memory and can be downloaded from the resource url.
+
+Latency can be set for all actions or per action, and failures can be injected either at random
+with a failure rate or for the next calls to an action. Calls are counted per action.
+
+with FakeCKANServer(latency=0.05) as server:
+    server.configure_hdx()
+    ... run pipeline functions ...
+    print(server.call_counts)
+"""
+
+import collections
+import copy
+import datetime
+import email.parser
+import email.policy
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional
+from urllib.parse import parse_qs, urlparse
+
+from hdx.api.configuration import Configuration
+from hdx.data.resource import Resource
+from hdx.location.country import Country
+from hdx.data.vocabulary import Vocabulary
+
+LOGGER = logging.getLogger(__name__)
+
+INSECURITY_INSIGHT_ORGANIZATION = {
+    "id": "648d346e-3995-44cc-a559-29f8192a3010",
+    "name": "insecurity-insight",
+    "title": "Insecurity Insight",
+}
+APPROVED_TAGS_VOCABULARY = "Topics"
+DEFAULT_APPROVED_TAGS = [
+    "aid workers",
+    "conflict-violence",
+    "education",
+    "food security",
+    "health facilities",
+    "hxl",
+    "incidents",
+    "protection",
+    "security incidents",
+    "violence and conflict",
+]
+# HDX resource formats as [format, description, mimetype, [file extensions]]
+RESOURCE_FORMATS = [
+    ["XLSX", "Excel", "application/vnd.ms-excel", ["xlsx", "xls"]],
+    ["CSV", "CSV", "text/csv", ["csv"]],
+    ["Parquet", "Apache Parquet", "application/vnd.apache.parquet", ["parquet"]],
+    ["Arrow", "Apache Arrow", "application/vnd.apache.arrow.file", ["arrow", "feather"]],
+    ["JSON", "JSON", "application/json", ["json"]],
+]
+
+
+class FakeCKANError(Exception):
+    def __init__(self, status: int, error_type: str, message: str):
+        super().__init__(message)
+        self.status = status
+        self.error_type = error_type
+        self.message = message
+
+
+class FakeCKANServer:
+    def __init__(
+        self,
+        latency: float | dict[str, float] = 0.0,
+        failure_rate: float = 0.0,
+        failure_status: int = 503,
+        seed: int = 0,
+        approved_tags: Optional[list[str]] = None,
+    ):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.approved_tags = list(
+            approved_tags if approved_tags is not None else DEFAULT_APPROVED_TAGS
+        )
+        self.call_counts = collections.Counter()
+        self.datasets: dict[str, dict] = {}
+        self.organizations: dict[str, dict] = {}
+        self.uploads: dict[str, bytes] = {}
+        self._failures: dict[str, list[int]] = collections.defaultdict(list)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+        self.add_organization(INSECURITY_INSIGHT_ORGANIZATION)
+
+    @property
+    def url(self) -> str:
+        if self._server is None:
+            raise RuntimeError("FakeCKANServer has not been started")
+        host, port = self._server.server_address[0:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> str:
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), make_request_handler(self))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        )
+        self._thread.start()
+        LOGGER.info(f"Fake CKAN server listening at {self.url}")
+        return self.url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self) -> "FakeCKANServer":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def configure_hdx(self, hdx_key: str = "fake-hdx-key"):
+        # Replaces the global HDX configuration with one pointing at this server. The tag and
+        # format lists which hdx-python-api normally downloads are also served locally.
+        Configuration.delete()
+        Configuration.create(
+            hdx_url=self.url,
+            hdx_key=hdx_key,
+            user_agent="hdx-scraper-insecurity-insight-fake-ckan",
+            project_config_dict={
+                "tags_list_url": f"{self.url}/tags/approved.csv",
+                "tags_mapping_url": f"{self.url}/tags/mappings.csv",
+                "formats_mapping_url": f"{self.url}/formats.json",
+            },
+        )
+        Resource._formats_dict = None  # pylint: disable=protected-access
+        # Country names are read from the copy bundled with hdx-python-country
+        Country.countriesdata(use_live=False)
+        Vocabulary._approved_vocabulary = None  # pylint: disable=protected-access
+        Vocabulary._tags_dict = None  # pylint: disable=protected-access
+
+    def add_organization(self, organization: dict):
+        with self._lock:
+            self.organizations[organization["id"]] = copy.deepcopy(organization)
+
+    def add_dataset(self, dataset: dict) -> dict:
+        with self._lock:
+            return copy.deepcopy(self._save_package(copy.deepcopy(dataset)))
+
+    def fail_next(self, action: str, count: int = 1, status: Optional[int] = None):
+        with self._lock:
+            self._failures[action].extend([status or self.failure_status] * count)
+
+    def reset_call_counts(self):
+        with self._lock:
+            self.call_counts.clear()
+
+    def handle_action(self, action: str, data: dict, files: dict[str, tuple[str, bytes]]) -> Any:
+        with self._lock:
+            self.call_counts[action] += 1
+            failure_status = None
+            if len(self._failures[action]) != 0:
+                failure_status = self._failures[action].pop(0)
+            elif self.failure_rate > 0 and self._random.random() < self.failure_rate:
+                failure_status = self.failure_status
+
+        latency = self.latency.get(action, 0.0) if isinstance(self.latency, dict) else self.latency
+        if latency > 0:
+            time.sleep(latency)
+        if failure_status is not None:
+            raise FakeCKANError(
+                failure_status, "Internal Server Error", f"Injected failure {action}"
+            )
+
+        handler = getattr(self, f"_action_{action}", None)
+        if handler is None:
+            raise FakeCKANError(400, "Bad Request", f"Action name not known: {action}")
+        with self._lock:
+            return copy.deepcopy(handler(data, files))
+
+    def _find_package(self, name_or_id: Optional[str]) -> dict:
+        if name_or_id in self.datasets:
+            return self.datasets[name_or_id]
+        for dataset in self.datasets.values():
+            if dataset["name"] == name_or_id:
+                return dataset
+        raise FakeCKANError(404, "Not Found Error", "Not found")
+
+    def _find_organization(self, name_or_id: Optional[str]) -> dict:
+        for organization in self.organizations.values():
+            if name_or_id in (organization["id"], organization["name"]):
+                return organization
+        raise FakeCKANError(404, "Not Found Error", "Not found")
+
+    def _save_package(self, dataset: dict) -> dict:
+        if "name" not in dataset:
+            raise FakeCKANError(409, "Validation Error", "Missing value: name")
+        dataset.setdefault("id", str(uuid.uuid4()))
+        for existing in self.datasets.values():
+            if existing["name"] == dataset["name"] and existing["id"] != dataset["id"]:
+                raise FakeCKANError(409, "Validation Error", "That URL is already in use.")
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None).isoformat()
+        dataset.setdefault("metadata_created", now)
+        dataset["metadata_modified"] = now
+        dataset.setdefault("state", "active")
+        if "owner_org" in dataset and dataset["owner_org"] in self.organizations:
+            dataset["organization"] = copy.deepcopy(self.organizations[dataset["owner_org"]])
+        dataset["resources"] = dataset.get("resources", [])
+        for position, resource in enumerate(dataset["resources"]):
+            resource.setdefault("id", str(uuid.uuid4()))
+            resource["package_id"] = dataset["id"]
+            resource["position"] = position
+        dataset["num_resources"] = len(dataset["resources"])
+        self.datasets[dataset["id"]] = dataset
+        return dataset
+
+    def _attach_upload(self, dataset: dict, resource_index: int, filename: str, content: bytes):
+        resource = dataset["resources"][resource_index]
+        resource["url_type"] = "upload"
+        resource[
+            "url"
+        ] = f"{self.url}/dataset/{dataset['id']}/resource/{resource['id']}/download/{filename}"
+        resource["size"] = len(content)
+        resource.setdefault("hash", hashlib.md5(content).hexdigest())
+        resource["last_modified"] = dataset["metadata_modified"]
+        self.uploads[resource["id"]] = content
+
+    def _action_package_show(self, data: dict, _files: dict) -> dict:
+        return self._find_package(data.get("id"))
+
+    def _action_package_create(self, data: dict, files: dict) -> dict:
+        data.pop("id", None)
+        dataset = self._save_package(data)
+        self._save_uploads(dataset, files)
+        return dataset
+
+    def _action_package_update(self, data: dict, files: dict) -> dict:
+        existing = self._find_package(data.get("id", data.get("name")))
+        data["id"] = existing["id"]
+        data["metadata_created"] = existing["metadata_created"]
+        dataset = self._save_package(data)
+        self._save_uploads(dataset, files)
+        return dataset
+
+    def _action_package_revise(self, data: dict, files: dict) -> dict:
+        match = load_json_field(data["match"])
+        dataset = copy.deepcopy(self._find_package(match.get("id", match.get("name"))))
+        for filter_key in load_json_field(data.get("filter", "[]")):
+            apply_revise_filter(dataset, filter_key)
+        merge_revise_update(dataset, load_json_field(data.get("update", "{}")))
+        dataset = self._save_package(dataset)
+        self._save_uploads(dataset, files)
+        return {"package": dataset}
+
+    def _save_uploads(self, dataset: dict, files: dict[str, tuple[str, bytes]]):
+        for field_name, (filename, content) in files.items():
+            # Fields are of the form update__resources__{index}__upload
+            parts = field_name.split("__")
+            if len(parts) == 4 and parts[1] == "resources" and parts[3] == "upload":
+                self._attach_upload(dataset, int(parts[2]), filename, content)
+
+    def _action_package_resource_reorder(self, data: dict, _files: dict) -> dict:
+        dataset = self._find_package(data.get("id"))
+        order = data.get("order", [])
+        resources_by_id = {x["id"]: x for x in dataset["resources"]}
+        for resource_id in order:
+            if resource_id not in resources_by_id:
+                raise FakeCKANError(409, "Validation Error", f"Resource {resource_id} not found")
+        reordered = [resources_by_id[x] for x in order]
+        reordered.extend(x for x in dataset["resources"] if x["id"] not in order)
+        dataset["resources"] = reordered
+        self._save_package(dataset)
+        return {"id": dataset["id"], "order": [x["id"] for x in reordered]}
+
+    def _action_package_create_default_resource_views(self, _data: dict, _files: dict) -> list:
+        return []
+
+    def _action_package_list(self, _data: dict, _files: dict) -> list[str]:
+        return sorted(x["name"] for x in self.datasets.values())
+
+    def _action_package_search(self, data: dict, _files: dict) -> dict:
+        results = list(self.datasets.values())
+        for query in str(data.get("fq", "")).split():
+            if query.startswith("organization:"):
+                organization = query.split(":", 1)[1]
+                results = [
+                    x for x in results if x.get("organization", {}).get("name") == organization
+                ]
+        results = sorted(results, key=lambda x: x["name"])
+        start = int(data.get("start", 0))
+        end = start + int(data.get("rows", 10))
+        return {"count": len(results), "results": results[start:end]}
+
+    def _action_organization_list(self, data: dict, _files: dict) -> list:
+        organizations = sorted(self.organizations.values(), key=lambda x: x["name"])
+        offset = int(data.get("offset", 0))
+        end = offset + int(data.get("limit", len(organizations)))
+        organizations = organizations[offset:end]
+        if str(data.get("all_fields", "")).lower() == "true":
+            return organizations
+        return [x["name"] for x in organizations]
+
+    def _action_organization_show(self, data: dict, _files: dict) -> dict:
+        organization = copy.deepcopy(self._find_organization(data.get("id")))
+        datasets = [x for x in self.datasets.values() if x.get("owner_org") == organization["id"]]
+        organization["package_count"] = len(datasets)
+        if str(data.get("include_datasets", "")).lower() == "true":
+            organization["packages"] = datasets
+        return organization
+
+    def _action_vocabulary_show(self, data: dict, _files: dict) -> dict:
+        if data.get("id") != APPROVED_TAGS_VOCABULARY:
+            raise FakeCKANError(404, "Not Found Error", "Not found")
+        return {
+            "id": APPROVED_TAGS_VOCABULARY,
+            "name": APPROVED_TAGS_VOCABULARY,
+            "tags": [{"name": x} for x in self.approved_tags],
+        }
+
+    def read_static(self, path: str) -> Optional[tuple[str, bytes]]:
+        if path == "/tags/approved.csv":
+            return "text/csv", "\n".join(self.approved_tags).encode("utf-8")
+        if path == "/tags/mappings.csv":
+            return "text/csv", b"Current Tag,Action to Take,New Tag(s)\n"
+        if path == "/formats.json":
+            return "application/json", json.dumps(RESOURCE_FORMATS).encode("utf-8")
+        # Resource downloads are /dataset/{id}/resource/{resource id}/download/{filename}
+        parts = path.strip("/").split("/")
+        if len(parts) == 6 and parts[0] == "dataset" and parts[2] == "resource":
+            with self._lock:
+                content = self.uploads.get(parts[3])
+            if content is not None:
+                return "application/octet-stream", content
+        return None
+
+
+def load_json_field(value: Any) -> Any:
+    return json.loads(value) if isinstance(value, str) else value
+
+
+def apply_revise_filter(dataset: dict, filter_key: str):
+    # Only removals are supported, of the form -key or -resources__{index}
+    if not filter_key.startswith("-"):
+        return
+    keys = filter_key[1:].split("__")
+    if len(keys) == 1:
+        dataset.pop(keys[0], None)
+    elif len(keys) == 2 and keys[1].isdigit():
+        values = dataset.get(keys[0], [])
+        if int(keys[1]) < len(values):
+            del values[int(keys[1])]
+
+
+def merge_revise_update(original: dict, update: dict):
+    # Dictionaries are merged, lists of dictionaries are merged item by item by position with any
+    # additional items appended, other values are replaced
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(original.get(key), dict):
+            merge_revise_update(original[key], value)
+        elif (
+            isinstance(value, list)
+            and isinstance(original.get(key), list)
+            and all(isinstance(x, dict) for x in value + original[key])
+        ):
+            for index, item in enumerate(value):
+                if index < len(original[key]) and item.get(
+                    "id", original[key][index].get("id")
+                ) == (original[key][index].get("id")):
+                    merge_revise_update(original[key][index], item)
+                elif index < len(original[key]):
+                    original[key][index] = item
+                else:
+                    original[key].append(item)
+        else:
+            original[key] = value
+
+
+def parse_multipart(content_type: str, body: bytes) -> tuple[dict, dict[str, tuple[str, bytes]]]:
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + body
+    )
+    data = {}
+    files = {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        filename = part.get_filename()
+        content = part.get_payload(decode=True) or b""
+        if filename is not None:
+            files[name] = (filename, content)
+        else:
+            data[name] = content.decode("utf-8")
+    return data, files
+
+
+def make_request_handler(fake_server: FakeCKANServer) -> type:
+    class FakeCKANRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):  # pylint: disable=invalid-name
+            parsed_url = urlparse(self.path)
+            static = fake_server.read_static(parsed_url.path)
+            if static is not None:
+                self._send(200, static[1], static[0])
+                return
+            data = {key: values[-1] for key, values in parse_qs(parsed_url.query).items()}
+            self._call_action(parsed_url.path, data, {})
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            content_type = self.headers.get("Content-Type", "")
+            files = {}
+            if content_type.startswith("multipart/form-data"):
+                data, files = parse_multipart(content_type, body)
+            elif len(body) != 0:
+                data = json.loads(body)
+            else:
+                data = {}
+            self._call_action(urlparse(self.path).path, data, files)
+
+        def _call_action(self, path: str, data: dict, files: dict):
+            # Actions are at /api/action/{action} or /api/3/action/{action}
+            parts = path.strip("/").split("/")
+            if len(parts) < 3 or parts[0] != "api" or parts[-2] != "action":
+                self._send(404, b"Not found", "text/plain")
+                return
+            try:
+                result = fake_server.handle_action(parts[-1], data, files)
+                response = {"success": True, "result": result}
+                status = 200
+            except FakeCKANError as error:
+                response = {
+                    "success": False,
+                    "error": {"__type": error.error_type, "message": error.message},
+                }
+                status = error.status
+            self._send(status, json.dumps(response).encode("utf-8"), "application/json")
+
+        def _send(self, status: int, content: bytes, content_type: str):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            LOGGER.debug(format % args)
+
+    return FakeCKANRequestHandler
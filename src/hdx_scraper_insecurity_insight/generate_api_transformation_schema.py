@@ -4,14 +4,24 @@
 """
 This code is for establishing field mappings and HXL codes for the existing data to the new API
 Ian Hopkinson 2023-11-18
+
+It also maintains metadata/api-fingerprints.json, a fingerprint of each API sample holding its
+ordered keys, the types seen for each key, a hash of the keys and a schema profile. The
+fingerprints are used by compare_api_to_samples and compare_api_profiles_to_samples so that the
+multi-megabyte samples are not read on each run. They are regenerated from the samples with:
+
+python generate_api_transformation_schema.py --fingerprints
 """
 
 import datetime
+import functools
+import hashlib
+import json
 import logging
 import os
 import sys
 
-import pandas as pd
+from typing import Optional
 
 from hdx.utilities.easy_logging import setup_logging
 from hdx.api.configuration import Configuration, ConfigurationError
@@ -19,6 +29,7 @@ from hdx.api.configuration import Configuration, ConfigurationError
 from hdx_scraper_insecurity_insight.utilities import (
     read_attributes,
     write_schema,
+    write_schemas,
     fetch_json_from_samples,
     # fetch_json_from_api,
     list_entities,
@@ -26,6 +37,16 @@ from hdx_scraper_insecurity_insight.utilities import (
     read_field_mappings,
     read_countries,
 )
+from hdx_scraper_insecurity_insight.pipeline_scheduler import Task, run_task_graph
+from hdx_scraper_insecurity_insight.profiling import profile_run, remove_flag_arguments
+from hdx_scraper_insecurity_insight.workbook_inspection import read_workbook_rows
+from hdx_scraper_insecurity_insight.schema_profile import (
+    compare_schema_profiles,
+    get_schema_profile,
+    start_schema_profile,
+    summarise_schema_profile,
+    update_schema_profile,
+)
 
 setup_logging()
 LOGGER = logging.getLogger(__name__)
@@ -41,6 +62,10 @@ FIELD_MAPPINGS = read_field_mappings()
 
 EXPECTED_COUNTRY_LIST = list(read_countries().keys())
 
+API_FINGERPRINTS_FILEPATH = os.path.join(
+    os.path.dirname(__file__), "metadata", "api-fingerprints.json"
+)
+
 # Datamesh style schema file
 SCHEMA_TEMPLATE = {
     "dataset_name": None,
@@ -54,7 +79,7 @@ SCHEMA_TEMPLATE = {
 }
 
 
-def marshall_datasets(dataset_name_pattern: str):
+def marshall_datasets(dataset_name_pattern: str, max_processes: Optional[int] = None):
     print("*********************************************", flush=True)
     print("* Insecurity Insight - Generate schema.csv  *", flush=True)
     print(f"* Invoked at: {datetime.datetime.now().isoformat(): <23} *", flush=True)
@@ -69,17 +94,47 @@ def marshall_datasets(dataset_name_pattern: str):
 
         LOGGER.info(f"Attributes file contains {len(dataset_names)} resource names")
 
+        # Schema rows are made in a process pool but only written here, in one rewrite of
+        # schema.csv, so rows from different datasets cannot interleave
+        tasks = [
+            Task(
+                x,
+                make_schema_rows,
+                args=(x,),
+                kwargs={"api_fields_basis": True},
+                executor="process",
+            )
+            for x in dataset_names
+        ]
+        results, _ = run_task_graph(tasks, max_processes=max_processes)
+
+        schemas = {}
         for dataset_name in dataset_names:
             LOGGER.info(f"Processing {dataset_name}")
-            status = generate_schema(dataset_name, api_fields_basis=True)
+            output_rows, status = results[dataset_name]
+            print_schema_rows(dataset_name, output_rows)
+            schemas[dataset_name] = output_rows
             status_list.append(status)
 
+        file_statuses = write_schemas({x: y for x, y in schemas.items() if len(y) != 0})
+        for file_status in file_statuses.values():
+            print(file_status, flush=True)
+
     return status_list
 
 
-def generate_schema(dataset_name: str, api_fields_basis: bool = False) -> str:
+def generate_schema(dataset_name: str, api_fields_basis: bool = False) -> dict:
+    output_rows, status = make_schema_rows(dataset_name, api_fields_basis=api_fields_basis)
+    if len(output_rows) != 0:
+        print_schema_rows(dataset_name, output_rows)
+        file_status = write_schema(dataset_name, output_rows)
+        print(file_status, flush=True)
+    return status
+
+
+def make_schema_rows(dataset_name: str, api_fields_basis: bool = False) -> tuple[list, dict]:
     # api_fields_basis sets whether we use the API as the soruce for column names or the
-    # sample spreadsheets
+    # sample spreadsheets. Nothing is written so this can run in a worker process
     status = {
         "dataset_name": dataset_name,
         "n_api_fields": "",
@@ -88,27 +143,26 @@ def generate_schema(dataset_name: str, api_fields_basis: bool = False) -> str:
     }
     if "overview" in dataset_name:
         print("Overview files should be updated manually in schema-overview.csv", flush=True)
-        return status
+        return [], status
     attributes = read_attributes(dataset_name)
     # Get relevant cached API response
     api_response = fetch_json_from_samples(dataset_name)
     api_fields = list(api_response[0].keys())
 
     try:
-        resource_df = pd.read_excel(
+        # Only the column names and the HXL tag row below them are needed
+        column_names, hxl_tags = read_workbook_rows(
             os.path.join(
                 os.path.dirname(__file__),
                 "spreadsheet-samples",
                 attributes["legacy_resource_filename"],
-            )
+            ),
+            n_rows=2,
         )
-        column_names = resource_df.columns.tolist()
         # Get HXL tags
-        hxl_tags = resource_df.loc[0, :].values.flatten().tolist()
-        hxl_tags = ["" if isinstance(x, float) else x for x in hxl_tags]
+        hxl_tags = ["" if x is None or isinstance(x, float) else x for x in hxl_tags]
     except (FileNotFoundError, IsADirectoryError):
         print(f"No example spreadsheet provided for {dataset_name}", flush=True)
-        resource_df = None
         column_names = api_fields
         hxl_tags = [""] * len(api_fields)
 
@@ -116,7 +170,6 @@ def generate_schema(dataset_name: str, api_fields_basis: bool = False) -> str:
         hxl_tag_dict = {column_names[i]: hxl_tags[i] for i in range(len(column_names))}
         column_names = api_fields
         hxl_tags = [hxl_tag_dict.get(x, "") for x in api_fields]
-        resource_df = None
     #
     # Display Original fields, HXL and matching API field
     columns = zip(column_names, hxl_tags)
@@ -127,16 +180,11 @@ def generate_schema(dataset_name: str, api_fields_basis: bool = False) -> str:
 
     # timestamp = datetime.datetime.now().isoformat()
 
-    print(f"\nEntries for the '{dataset_name}' endpoint", flush=True)
-    print(f"{ '':<2}   {'Spreadsheet column':<50},{'HXL tag':<50}, {'api_field':<50}", flush=True)
     for i, column in enumerate(columns):
-        if column[0].endswith(".1"):
-            print(f"Column {column} is a duplicate", flush=True)
         # if i not in [50, 58]:
         #     continue
         api_field = find_corresponding_api_field(dataset_name, api_fields, column)
 
-        print(f"{i:<2}.  {column[0]:<50.50},{column[1]:<50.50}, {api_field:<50.50}", flush=True)
         output_row = SCHEMA_TEMPLATE.copy()
         output_row["dataset_name"] = dataset_name
         # output_row["timestamp"] = timestamp
@@ -150,8 +198,6 @@ def generate_schema(dataset_name: str, api_fields_basis: bool = False) -> str:
 
         output_rows.append(output_row)
 
-    file_status = write_schema(dataset_name, output_rows)
-    print(file_status, flush=True)
     n_hxl_tags = len([x for x in hxl_tags if x != ""])
     status = {
         "dataset_name": dataset_name,
@@ -159,7 +205,22 @@ def generate_schema(dataset_name: str, api_fields_basis: bool = False) -> str:
         "n_spreadsheet_fields": len(column_names),
         "n_hxl_tags": n_hxl_tags,
     }
-    return status
+    return output_rows, status
+
+
+def print_schema_rows(dataset_name: str, output_rows: list[dict]):
+    if len(output_rows) == 0:
+        return
+    print(f"\nEntries for the '{dataset_name}' endpoint", flush=True)
+    print(f"{ '':<2}   {'Spreadsheet column':<50},{'HXL tag':<50}, {'api_field':<50}", flush=True)
+    for output_row in output_rows:
+        if output_row["field_name"].endswith(".1"):
+            print(f"Column {output_row['field_name']} is a duplicate", flush=True)
+        print(
+            f"{output_row['field_number']:<2}.  {output_row['field_name']:<50.50},"
+            f"{output_row['terms']:<50.50}, {output_row['upstream']:<50.50}",
+            flush=True,
+        )
 
 
 # Collect the set of country ISO codes - this is repeated in the create_datasets code
@@ -198,29 +259,36 @@ def compare_api_to_samples(
 
     LOGGER.info(f"Found {len(dataset_names)} endpoints")
 
+    api_fingerprints = read_api_fingerprints()
     api_changed = False
     changed_list = []
     for dataset_name in dataset_names:
         attributes = read_attributes(dataset_name)
 
-        samples_response = fetch_json_from_samples(dataset_name)
+        sample_fingerprint = api_fingerprints.get(attributes["api_response_filename"])
+        if sample_fingerprint is None:
+            LOGGER.info(f"No fingerprint for {attributes['api_response_filename']}, reading sample")
+            sample_fingerprint = make_api_fingerprint(fetch_json_from_samples(dataset_name))
         api_response = api_cache[dataset_name]
 
-        sample_keys = samples_response[0].keys()
+        sample_keys = sample_fingerprint["keys"]
         if len(api_response) != 0:
-            api_keys = api_response[0].keys()
+            api_keys = list(api_response[0].keys())
         else:
             api_keys = []
 
-        if sample_keys == api_keys:
+        # Keys in a different order are not a change since fields are read by name
+        if hash_keys(api_keys) == sample_fingerprint["hash"]:
             LOGGER.info(f"{dataset_name} matches")
+        elif set(api_keys) == set(sample_keys):
+            LOGGER.info(f"{dataset_name} matches, with keys in a different order")
         else:
             changed_list.append(dataset_name)
             LOGGER.info(f"**MISMATCH between API and sample for {dataset_name}")
             LOGGER.info(f"API endpoint: {attributes['api_url']}")
             LOGGER.info(f"API sample: {attributes['api_response_filename']}")
             LOGGER.info(f"Number of API records: {len(api_response)}")
-            LOGGER.info(f"Number of sample records: {len(samples_response)}")
+            LOGGER.info(f"Number of sample records: {sample_fingerprint['n_records']}")
             LOGGER.info(f"Number of API endpoint record keys: {len(api_keys)}")
             LOGGER.info(f"Number of sample record keys: {len(sample_keys)}")
             LOGGER.info(f"API keys: {api_keys}")
@@ -232,6 +300,88 @@ def compare_api_to_samples(
     return api_changed, changed_list
 
 
+def hash_keys(keys: list[str]) -> str:
+    return hashlib.sha256("\n".join(keys).encode("utf-8")).hexdigest()
+
+
+def compare_api_profiles_to_samples(
+    dataset_names: list = None, tolerances: dict = None
+) -> dict[str, list[str]]:
+    # Compares the profiles recorded as responses were fetched, so no response is traversed again
+    print_banner_to_log(LOGGER, "Compare API profiles")
+
+    if dataset_names is None:
+        dataset_names = list_entities(type_="resource")
+
+    api_fingerprints = read_api_fingerprints()
+    drift_report = {}
+    for dataset_name in dataset_names:
+        schema_profile = get_schema_profile(dataset_name)
+        sample_filename = read_attributes(dataset_name)["api_response_filename"]
+        sample_profile = api_fingerprints.get(sample_filename, {}).get("profile")
+        if schema_profile is None or sample_profile is None:
+            LOGGER.info(f"No profile to compare for {dataset_name}")
+            continue
+        drift_report[dataset_name] = compare_schema_profiles(
+            schema_profile, sample_profile, tolerances=tolerances
+        )
+        if len(drift_report[dataset_name]) == 0:
+            LOGGER.info(f"{dataset_name} profile matches")
+
+    return drift_report
+
+
+def make_api_fingerprint(api_response: list[dict]) -> dict:
+    keys = list(api_response[0].keys()) if len(api_response) != 0 else []
+    schema_profile = start_schema_profile()
+    for api_row in api_response:
+        update_schema_profile(schema_profile, api_row)
+    types = {}
+    for key, field in schema_profile["fields"].items():
+        types[key] = sorted(list(field["types"]) + (["NoneType"] if field["n_null"] != 0 else []))
+    return {
+        "keys": keys,
+        "types": types,
+        "n_records": len(api_response),
+        "hash": hash_keys(keys),
+        "profile": summarise_schema_profile(schema_profile),
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def read_api_fingerprints(fingerprints_filepath: str = API_FINGERPRINTS_FILEPATH) -> dict:
+    if not os.path.exists(fingerprints_filepath):
+        return {}
+    with open(fingerprints_filepath, "r", encoding="utf-8") as fingerprints_file:
+        return json.load(fingerprints_file)
+
+
+def write_api_fingerprints(
+    dataset_names: list[str] = None, fingerprints_filepath: str = API_FINGERPRINTS_FILEPATH
+) -> dict:
+    if dataset_names is None:
+        dataset_names = list_entities(type_="resource")
+
+    api_fingerprints = {}
+    for dataset_name in dataset_names:
+        sample_filename = read_attributes(dataset_name)["api_response_filename"]
+        if sample_filename in api_fingerprints:
+            continue
+        try:
+            api_response = fetch_json_from_samples(dataset_name)
+        except FileNotFoundError:
+            LOGGER.info(f"No API sample {sample_filename} for {dataset_name}")
+            continue
+        api_fingerprints[sample_filename] = make_api_fingerprint(api_response)
+
+    with open(fingerprints_filepath, "w", encoding="utf-8") as fingerprints_file:
+        json.dump(api_fingerprints, fingerprints_file, indent=2, sort_keys=True)
+        fingerprints_file.write("\n")
+    read_api_fingerprints.cache_clear()
+    LOGGER.info(f"Wrote {len(api_fingerprints)} API fingerprints to {fingerprints_filepath}")
+    return api_fingerprints
+
+
 def show_response_overlap(api_keys: list[dict], sample_keys: list[dict]):
     LOGGER.info("Keys in API data but not in sample")
     LOGGER.info(set(api_keys).difference(set(sample_keys)))
@@ -241,10 +391,15 @@ def show_response_overlap(api_keys: list[dict], sample_keys: list[dict]):
 
 
 if __name__ == "__main__":
+    if "--fingerprints" in sys.argv:
+        write_api_fingerprints()
+        sys.exit()
     DATASET_NAME = "all"
-    if len(sys.argv) == 2:
-        DATASET_NAME = sys.argv[1]
-    STATUS_LIST = marshall_datasets(DATASET_NAME)
+    ARGUMENTS = remove_flag_arguments(sys.argv)
+    if len(ARGUMENTS) == 2:
+        DATASET_NAME = ARGUMENTS[1]
+    with profile_run("generate_api_transformation_schema"):
+        STATUS_LIST = marshall_datasets(DATASET_NAME)
     print(
         f"{'dataset_name':<50},{'n_api_fields':<20},{'n_spreadsheet_fields':<30},{'n_hxl_tags':<20}"
     )
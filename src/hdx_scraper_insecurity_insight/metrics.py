@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Instrumentation for the stages of a run: fetch, parse, censor, partition, transform, write and
+upload.
+
+Stages are wrapped in the `span` context manager which records wall time, CPU time and peak RSS
+along with optional record and byte counts. The caller sets counts on the dictionary yielded by
+the span. Spans are kept in memory for the process and written out at the end of a run as a JSON
+report, with a summary table in the log, so that runs can be compared week to week.
+
+CPU time is measured per thread so spans running concurrently in the task graph are not
+double counted. Spans recorded in a process pool worker are not collected.
+
+Memory is recorded as the process RSS at the end of each span and the peak RSS so far. Setting
+INSECURITY_INSIGHT_TRACEMALLOC traces Python allocations with tracemalloc, adding the traced
+peak and change in traced memory to each span and the top allocation sites at the memory high
+water mark to the report. Tracing slows a run considerably so it is off by default.
+INSECURITY_INSIGHT_MEMORY_BUDGET_MB sets a budget for peak RSS, checked at the end of each span.
+Exceeding it logs a warning, or fails the run with MemoryBudgetExceeded if
+INSECURITY_INSIGHT_MEMORY_BUDGET_ACTION is "fail".
+"""
+
+import datetime
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+try:
+    import resource as resource_usage
+except ImportError:  # resource is not available on Windows
+    resource_usage = None
+
+LOGGER = logging.getLogger(__name__)
+
+METRICS_DIRECTORY = os.path.join(os.path.dirname(__file__), "run-metrics")
+STAGES = ["fetch", "parse", "censor", "partition", "transform", "write", "upload"]
+
+TRACEMALLOC_VARIABLE = "INSECURITY_INSIGHT_TRACEMALLOC"
+MEMORY_BUDGET_VARIABLE = "INSECURITY_INSIGHT_MEMORY_BUDGET_MB"
+MEMORY_BUDGET_ACTION_VARIABLE = "INSECURITY_INSIGHT_MEMORY_BUDGET_ACTION"
+N_ALLOCATION_SITES = 10
+
+METRICS_LOCK = threading.Lock()
+SPANS: list[dict] = []
+ACTIVE_SPANS: list[dict] = []
+RUN_START = {"wall_time": time.perf_counter(), "cpu_time": time.process_time()}
+MEMORY_SETTINGS = {"budget_bytes": None, "budget_action": "warn", "budget_exceeded": False}
+HIGH_WATER_MARK = {"traced_bytes": 0, "span": None, "allocation_sites": []}
+
+
+class MemoryBudgetExceeded(RuntimeError):
+    pass
+
+
+@contextmanager
+def span(
+    stage: str, resource: Optional[str] = None, country: Optional[str] = None
+) -> Iterator[dict]:
+    record = {
+        "stage": stage,
+        "resource": resource,
+        "country": country,
+        "records": None,
+        "bytes": None,
+    }
+    start_wall_time = time.perf_counter()
+    start_cpu_time = time.thread_time()
+    record["start"] = start_wall_time - RUN_START["wall_time"]
+    start_tracing(record)
+    failed = False
+    try:
+        yield record
+    except BaseException:
+        record["failed"] = True
+        failed = True
+        raise
+    finally:
+        record["wall_time"] = time.perf_counter() - start_wall_time
+        record["cpu_time"] = time.thread_time() - start_cpu_time
+        record["rss_bytes"] = read_current_rss()
+        record["peak_rss_bytes"] = read_peak_rss()
+        stop_tracing(record)
+        with METRICS_LOCK:
+            SPANS.append(record)
+        # A budget failure is not raised over an exception from the span itself
+        if not failed:
+            check_memory_budget(record)
+
+
+def start_tracing(record: dict):
+    # tracemalloc has a single peak for the process, so when a span resets it the peak so far
+    # is first credited to all open spans. Spans running concurrently share peaks.
+    if not tracemalloc.is_tracing():
+        return
+    with METRICS_LOCK:
+        current, peak = tracemalloc.get_traced_memory()
+        for active_record in ACTIVE_SPANS:
+            active_record["traced_peak_bytes"] = max(active_record["traced_peak_bytes"], peak)
+        tracemalloc.reset_peak()
+        record["traced_start_bytes"] = current
+        record["traced_peak_bytes"] = current
+        ACTIVE_SPANS.append(record)
+
+
+def stop_tracing(record: dict):
+    if "traced_start_bytes" not in record:
+        return
+    with METRICS_LOCK:
+        ACTIVE_SPANS.remove(record)
+        if not tracemalloc.is_tracing():
+            del record["traced_start_bytes"]
+            del record["traced_peak_bytes"]
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        for active_record in ACTIVE_SPANS + [record]:
+            active_record["traced_peak_bytes"] = max(active_record["traced_peak_bytes"], peak)
+        record["traced_delta_bytes"] = current - record.pop("traced_start_bytes")
+        new_high_water_mark = current > HIGH_WATER_MARK["traced_bytes"]
+        if new_high_water_mark:
+            HIGH_WATER_MARK["traced_bytes"] = current
+            HIGH_WATER_MARK["span"] = {
+                key: record[key] for key in ["stage", "resource", "country", "start"]
+            }
+    # Snapshots are slow so they are only taken when memory in use is at a new high
+    if new_high_water_mark:
+        allocation_sites = read_allocation_sites()
+        with METRICS_LOCK:
+            HIGH_WATER_MARK["allocation_sites"] = allocation_sites
+
+
+def read_allocation_sites(n_sites: int = N_ALLOCATION_SITES) -> list[dict]:
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    )
+    return [
+        {
+            "site": f"{x.traceback[0].filename}:{x.traceback[0].lineno}",
+            "size_bytes": x.size,
+            "blocks": x.count,
+        }
+        for x in snapshot.statistics("lineno")[0:n_sites]
+    ]
+
+
+def configure_memory_tracking(
+    trace: Optional[bool] = None,
+    budget_bytes: Optional[int] = None,
+    budget_action: Optional[str] = None,
+):
+    """Sets up memory tracking, with each argument defaulting to its environment variable."""
+    if trace is None:
+        trace = os.environ.get(TRACEMALLOC_VARIABLE, "").lower() in ["1", "true", "yes"]
+    if budget_bytes is None and len(os.environ.get(MEMORY_BUDGET_VARIABLE, "")) != 0:
+        budget_bytes = int(float(os.environ[MEMORY_BUDGET_VARIABLE]) * 1e6)
+    if budget_action is None:
+        budget_action = os.environ.get(MEMORY_BUDGET_ACTION_VARIABLE, "warn").lower()
+    if budget_action not in ["warn", "fail"]:
+        raise ValueError(f"Memory budget action should be warn or fail, not {budget_action}")
+
+    if trace and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not trace and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    with METRICS_LOCK:
+        MEMORY_SETTINGS["budget_bytes"] = budget_bytes
+        MEMORY_SETTINGS["budget_action"] = budget_action
+        MEMORY_SETTINGS["budget_exceeded"] = False
+    if trace:
+        LOGGER.info("Tracing memory allocations with tracemalloc")
+    if budget_bytes is not None:
+        LOGGER.info(f"Memory budget is {budget_bytes / 1e6:0.0f}MB peak RSS ({budget_action})")
+
+
+def check_memory_budget(record: dict):
+    budget_bytes = MEMORY_SETTINGS["budget_bytes"]
+    if budget_bytes is None:
+        return
+    used_bytes = record["peak_rss_bytes"]
+    if used_bytes is None:
+        used_bytes = record.get("traced_peak_bytes")
+    if used_bytes is None or used_bytes <= budget_bytes:
+        return
+
+    location = " ".join(x for x in [record["resource"], record["country"]] if x is not None)
+    message = (
+        f"Memory budget of {budget_bytes / 1e6:0.0f}MB exceeded, {used_bytes / 1e6:0.0f}MB "
+        f"used at the end of {record['stage']} for {location}"
+    )
+    if MEMORY_SETTINGS["budget_action"] == "fail":
+        raise MemoryBudgetExceeded(message)
+    # Only the first span over budget is logged, the report shows the rest
+    with METRICS_LOCK:
+        already_exceeded = MEMORY_SETTINGS["budget_exceeded"]
+        MEMORY_SETTINGS["budget_exceeded"] = True
+    if not already_exceeded:
+        LOGGER.warning(message)
+
+
+def read_current_rss() -> Optional[int]:
+    # /proc is only available on Linux
+    try:
+        with open("/proc/self/statm", encoding="utf-8") as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def read_peak_rss() -> Optional[int]:
+    if resource_usage is None:
+        return None
+    peak_rss = resource_usage.getrusage(resource_usage.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    if sys.platform == "darwin":
+        return peak_rss
+    return peak_rss * 1024
+
+
+def reset_metrics():
+    with METRICS_LOCK:
+        SPANS.clear()
+        MEMORY_SETTINGS["budget_exceeded"] = False
+        HIGH_WATER_MARK.update({"traced_bytes": 0, "span": None, "allocation_sites": []})
+        RUN_START["wall_time"] = time.perf_counter()
+        RUN_START["cpu_time"] = time.process_time()
+
+
+def get_spans() -> list[dict]:
+    with METRICS_LOCK:
+        return [dict(x) for x in SPANS]
+
+
+def summarise_spans(spans: list[dict]) -> list[dict]:
+    # Totals by stage, listed in pipeline order with any other stages at the end
+    stage_names = [x for x in STAGES if any(y["stage"] == x for y in spans)]
+    stage_names.extend(sorted({x["stage"] for x in spans} - set(stage_names)))
+    summary = []
+    for stage_name in stage_names:
+        stage_spans = [x for x in spans if x["stage"] == stage_name]
+        summary.append(
+            {
+                "stage": stage_name,
+                "spans": len(stage_spans),
+                "wall_time": sum(x["wall_time"] for x in stage_spans),
+                "cpu_time": sum(x["cpu_time"] for x in stage_spans),
+                "records": sum(x["records"] or 0 for x in stage_spans),
+                "bytes": sum(x["bytes"] or 0 for x in stage_spans),
+                "peak_rss_bytes": max_of(stage_spans, "peak_rss_bytes"),
+                "traced_peak_bytes": max_of(stage_spans, "traced_peak_bytes"),
+            }
+        )
+    return summary
+
+
+def summarise_memory_by_resource(spans: list[dict]) -> list[dict]:
+    # Memory at the end of the spans for each resource, largest first
+    resource_names = {x["resource"] for x in spans if x["resource"] is not None}
+    summary = []
+    for resource_name in resource_names:
+        resource_spans = [x for x in spans if x["resource"] == resource_name]
+        summary.append(
+            {
+                "resource": resource_name,
+                "rss_bytes": max_of(resource_spans, "rss_bytes"),
+                "traced_peak_bytes": max_of(resource_spans, "traced_peak_bytes"),
+                "traced_delta_bytes": sum(x.get("traced_delta_bytes", 0) for x in resource_spans),
+            }
+        )
+    summary.sort(key=lambda x: (x["traced_peak_bytes"] or 0, x["rss_bytes"] or 0), reverse=True)
+    return summary
+
+
+def max_of(spans: list[dict], key: str) -> Optional[int]:
+    return max([x[key] for x in spans if x.get(key) is not None], default=None)
+
+
+def make_metrics_report(spans: Optional[list[dict]] = None) -> dict:
+    if spans is None:
+        spans = get_spans()
+    return {
+        "generated_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "wall_time": time.perf_counter() - RUN_START["wall_time"],
+        "cpu_time": time.process_time() - RUN_START["cpu_time"],
+        "peak_rss_bytes": read_peak_rss(),
+        "memory_budget_bytes": MEMORY_SETTINGS["budget_bytes"],
+        "memory_budget_exceeded": MEMORY_SETTINGS["budget_exceeded"],
+        "stages": summarise_spans(spans),
+        "resources": summarise_memory_by_resource(spans),
+        "high_water_mark": dict(HIGH_WATER_MARK),
+        "spans": spans,
+    }
+
+
+def write_metrics_report(
+    report: dict,
+    output_filepath: Optional[str] = None,
+    output_directory: Optional[str] = None,
+    name: str = "metrics",
+) -> str:
+    if output_filepath is None:
+        timestamp = report["generated_at"][0:19].replace(":", "").replace("-", "")
+        output_filepath = os.path.join(
+            output_directory or METRICS_DIRECTORY, f"{name}-{timestamp}.json"
+        )
+    os.makedirs(os.path.dirname(output_filepath), exist_ok=True)
+    with open(output_filepath, "w", encoding="utf-8") as report_file:
+        json.dump(report, report_file, indent=2)
+
+    LOGGER.info(f"Metrics report written to {output_filepath}")
+    return output_filepath
+
+
+def log_metrics_summary(report: dict):
+    LOGGER.info(
+        f"{'stage':<12} {'spans':>6} {'wall (s)':>10} {'cpu (s)':>10} "
+        f"{'records':>10} {'MB':>10} {'peak RSS (MB)':>14} {'traced (MB)':>12}"
+    )
+    for stage in report["stages"]:
+        peak_rss = format_megabytes(stage["peak_rss_bytes"])
+        traced_peak = format_megabytes(stage.get("traced_peak_bytes"))
+        LOGGER.info(
+            f"{stage['stage']:<12} {stage['spans']:>6} {stage['wall_time']:>10.2f} "
+            f"{stage['cpu_time']:>10.2f} {stage['records']:>10} {stage['bytes'] / 1e6:>10.2f} "
+            f"{peak_rss:>14} {traced_peak:>12}"
+        )
+    high_water_mark = report.get("high_water_mark", {})
+    if high_water_mark.get("span") is not None:
+        LOGGER.info(
+            f"Traced memory high water mark {high_water_mark['traced_bytes'] / 1e6:0.1f}MB "
+            f"after {high_water_mark['span']['stage']} for {high_water_mark['span']['resource']}, "
+            "top allocation sites:"
+        )
+        for site in high_water_mark["allocation_sites"]:
+            LOGGER.info(f"{site['size_bytes'] / 1e6:>10.1f}MB {site['site']}")
+    LOGGER.info(
+        f"Total run time: {report['wall_time']:0.0f} seconds "
+        f"({report['cpu_time']:0.0f} seconds CPU)"
+    )
+
+
+def format_megabytes(n_bytes: Optional[int]) -> str:
+    return f"{n_bytes / 1e6:0.1f}" if n_bytes is not None else "-"
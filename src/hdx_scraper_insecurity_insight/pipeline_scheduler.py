@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+A small task graph scheduler used by run.py to overlap independent stages of the pipeline.
+
+Tasks declare the names of the tasks they depend on, tasks whose dependencies are complete are
+run concurrently on a thread pool or, where executor="process", a process pool. Results of
+dependencies can be passed to a task as keyword arguments via `inputs`.
+"""
+
+import logging
+import time
+
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from typing import Any, Callable, Optional
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Task:
+    def __init__(
+        self,
+        name: str,
+        function: Callable,
+        args: tuple = (),
+        kwargs: Optional[dict] = None,
+        dependencies: Optional[list[str]] = None,
+        inputs: Optional[dict[str, str]] = None,
+        executor: str = "thread",
+    ):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs if kwargs is not None else {}
+        # inputs maps a keyword argument to the name of the task whose result it receives
+        self.inputs = inputs if inputs is not None else {}
+        self.dependencies = list(dependencies) if dependencies is not None else []
+        for dependency in self.inputs.values():
+            if dependency not in self.dependencies:
+                self.dependencies.append(dependency)
+        if executor not in ("thread", "process"):
+            raise ValueError(f"Task `{name}` executor must be `thread` or `process`")
+        self.executor = executor
+
+    def __repr__(self):
+        return f"Task({self.name!r}, dependencies={self.dependencies!r})"
+
+
+def order_tasks(tasks: list[Task]) -> list[str]:
+    task_names = [x.name for x in tasks]
+    if len(set(task_names)) != len(task_names):
+        raise ValueError("Task names in a task graph must be unique")
+
+    dependents = {x.name: [] for x in tasks}
+    n_dependencies = {}
+    for task in tasks:
+        for dependency in task.dependencies:
+            if dependency not in dependents:
+                raise ValueError(f"Task `{task.name}` depends on unknown task `{dependency}`")
+            dependents[dependency].append(task.name)
+        n_dependencies[task.name] = len(task.dependencies)
+
+    ordered_names = []
+    ready = [x for x in task_names if n_dependencies[x] == 0]
+    while len(ready) != 0:
+        task_name = ready.pop(0)
+        ordered_names.append(task_name)
+        for dependent in dependents[task_name]:
+            n_dependencies[dependent] -= 1
+            if n_dependencies[dependent] == 0:
+                ready.append(dependent)
+
+    if len(ordered_names) != len(tasks):
+        cycle = [x for x in task_names if x not in ordered_names]
+        raise ValueError(f"Task graph contains a cycle involving {cycle}")
+
+    return ordered_names
+
+
+def run_task_graph(
+    tasks: list[Task], max_workers: int = 4, max_processes: Optional[int] = None
+) -> tuple[dict[str, Any], dict[str, tuple[float, float]]]:
+    """Runs a list of tasks respecting their dependencies, returning a dictionary of results and
+    a dictionary of (start, end) times relative to the start of the run, both keyed by task name.
+    The first task to raise an exception stops the run and the exception is re-raised once
+    running tasks have finished.
+    """
+    order_tasks(tasks)
+    tasks_by_name = {x.name: x for x in tasks}
+    pending = {x.name for x in tasks}
+    results = {}
+    timings = {}
+    running: dict[Future, str] = {}
+    failure = None
+
+    t0 = time.perf_counter()
+    thread_pool = ThreadPoolExecutor(max_workers=max_workers)
+    process_pool = None
+    if any(x.executor == "process" for x in tasks):
+        process_pool = ProcessPoolExecutor(max_workers=max_processes)
+    try:
+        while (len(pending) != 0 and failure is None) or len(running) != 0:
+            if failure is None:
+                ready = [
+                    tasks_by_name[x]
+                    for x in pending
+                    if all(y in results for y in tasks_by_name[x].dependencies)
+                ]
+                for task in sorted(ready, key=lambda x: x.name):
+                    kwargs = dict(task.kwargs)
+                    for argument, dependency in task.inputs.items():
+                        kwargs[argument] = results[dependency]
+                    pool = process_pool if task.executor == "process" else thread_pool
+                    start = time.perf_counter() - t0
+                    future = pool.submit(task.function, *task.args, **kwargs)
+                    running[future] = task.name
+                    timings[task.name] = (start, start)
+                    pending.remove(task.name)
+
+            done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                task_name = running.pop(future)
+                timings[task_name] = (timings[task_name][0], time.perf_counter() - t0)
+                try:
+                    results[task_name] = future.result()
+                except Exception as exception:  # pylint: disable=broad-exception-caught
+                    LOGGER.error(f"Task `{task_name}` failed: {exception!r}")
+                    if failure is None:
+                        failure = exception
+    finally:
+        thread_pool.shutdown(wait=True)
+        if process_pool is not None:
+            process_pool.shutdown(wait=True)
+
+    if failure is not None:
+        raise failure
+
+    return results, timings
+
+
+def find_critical_path(
+    tasks: list[Task], timings: dict[str, tuple[float, float]]
+) -> tuple[list[str], float]:
+    # The critical path is the chain of dependent tasks with the longest total duration
+    tasks_by_name = {x.name: x for x in tasks}
+    path_duration = {}
+    path_previous = {}
+    for task_name in order_tasks(tasks):
+        duration = timings[task_name][1] - timings[task_name][0]
+        path_previous[task_name] = None
+        path_duration[task_name] = duration
+        for dependency in tasks_by_name[task_name].dependencies:
+            if path_duration[dependency] + duration > path_duration[task_name]:
+                path_duration[task_name] = path_duration[dependency] + duration
+                path_previous[task_name] = dependency
+
+    if len(path_duration) == 0:
+        return [], 0.0
+
+    task_name = max(path_duration, key=path_duration.get)
+    total_duration = path_duration[task_name]
+    critical_path = []
+    while task_name is not None:
+        critical_path.insert(0, task_name)
+        task_name = path_previous[task_name]
+
+    return critical_path, total_duration
+
+
+def log_task_graph_report(tasks: list[Task], timings: dict[str, tuple[float, float]]):
+    critical_path, critical_duration = find_critical_path(tasks, timings)
+    wall_time = max([x[1] for x in timings.values()], default=0.0)
+    task_time = sum(x[1] - x[0] for x in timings.values())
+    LOGGER.info(f"{'task':<60} {'start':>8} {'end':>8} {'duration':>9}")
+    for task_name, (start, end) in sorted(timings.items(), key=lambda x: x[1][0]):
+        marker = "*" if task_name in critical_path else ""
+        LOGGER.info(f"{task_name:<60.60} {start:>8.2f} {end:>8.2f} {end - start:>9.2f}{marker}")
+    LOGGER.info(f"Wall time {wall_time:0.2f} seconds for {task_time:0.2f} seconds of tasks")
+    LOGGER.info(f"Critical path ({critical_duration:0.2f} seconds): {' -> '.join(critical_path)}")
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Optional profiling of the entry points: run.py, create_spreadsheets.py, create_datasets.py and
+generate_api_transformation_schema.py.
+
+Profiling is switched on with the INSECURITY_INSIGHT_PROFILE environment variable or a
+--profile command line flag. Either takes the profiler to use, given as --profile=pyinstrument or
+--profile pyinstrument: "cprofile" (the default for a bare
+--profile) writes a .prof file for snakeviz or pstats, "pyinstrument" writes a sampling profile as
+an HTML flamegraph. pyinstrument is an optional dependency, if it is not installed cProfile is used.
+
+Profiles are written to run-metrics/ next to the metrics report, so they are uploaded with it
+by the GitHub workflow.
+
+with profile_run("create_spreadsheets"):
+    ... stage to profile ...
+"""
+
+import cProfile
+import datetime
+import logging
+import os
+import pstats
+import sys
+
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from hdx_scraper_insecurity_insight.metrics import METRICS_DIRECTORY
+
+LOGGER = logging.getLogger(__name__)
+
+PROFILE_VARIABLE = "INSECURITY_INSIGHT_PROFILE"
+PROFILERS = ["cprofile", "pyinstrument"]
+N_STATS_TO_LOG = 20
+
+
+def read_profiler_setting(argv: Optional[list[str]] = None) -> Optional[str]:
+    # The command line flag takes precedence over the environment variable
+    if argv is None:
+        argv = sys.argv
+    profiler = os.environ.get(PROFILE_VARIABLE, "")
+    arguments = argv[1:]
+    for i, argument in enumerate(arguments):
+        if argument == "--profile":
+            profiler = "cprofile"
+            if i + 1 < len(arguments) and arguments[i + 1].lower() in PROFILERS:
+                profiler = arguments[i + 1]
+        elif argument.startswith("--profile="):
+            profiler = argument.split("=", 1)[1]
+
+    profiler = profiler.strip().lower()
+    if profiler in ["", "0", "false", "none"]:
+        return None
+    if profiler in ["1", "true"]:
+        return "cprofile"
+    if profiler not in PROFILERS:
+        raise ValueError(f"Unknown profiler {profiler}, expected one of {PROFILERS}")
+    return profiler
+
+
+def remove_flag_arguments(argv: list[str]) -> list[str]:
+    # Positional arguments only, without --flags or the profiler name after a bare --profile
+    arguments = []
+    previous_argument = None
+    for argument in argv:
+        is_profiler_name = previous_argument == "--profile" and argument.lower() in PROFILERS
+        if not argument.startswith("--") and not is_profiler_name:
+            arguments.append(argument)
+        previous_argument = argument
+    return arguments
+
+
+@contextmanager
+def profile_run(
+    name: str, profiler: Optional[str] = None, output_directory: Optional[str] = None
+) -> Iterator[dict]:
+    """Profiles the enclosed block with profiler, which defaults to read_profiler_setting(). The
+    dictionary yielded has the output filepath set on exit, or None if profiling is off.
+    """
+    if profiler is None:
+        profiler = read_profiler_setting()
+    if output_directory is None:
+        output_directory = METRICS_DIRECTORY
+    profile_result = {"profiler": profiler, "output_filepath": None}
+    if profiler is None:
+        yield profile_result
+        return
+
+    if profiler == "pyinstrument":
+        try:
+            import pyinstrument  # pylint: disable=import-outside-toplevel
+        except ImportError:
+            LOGGER.warning("pyinstrument is not installed, profiling with cProfile instead")
+            profiler = "cprofile"
+            profile_result["profiler"] = profiler
+
+    timestamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+    os.makedirs(output_directory, exist_ok=True)
+    LOGGER.info(f"Profiling {name} with {profiler}")
+    if profiler == "pyinstrument":
+        sampling_profiler = pyinstrument.Profiler()
+        sampling_profiler.start()
+        try:
+            yield profile_result
+        finally:
+            sampling_profiler.stop()
+            output_filepath = os.path.join(output_directory, f"profile-{name}-{timestamp}.html")
+            with open(output_filepath, "w", encoding="utf-8") as profile_file:
+                profile_file.write(sampling_profiler.output_html())
+            profile_result["output_filepath"] = output_filepath
+            LOGGER.info(f"Profile written to {output_filepath}")
+    else:
+        deterministic_profiler = cProfile.Profile()
+        deterministic_profiler.enable()
+        try:
+            yield profile_result
+        finally:
+            deterministic_profiler.disable()
+            output_filepath = os.path.join(output_directory, f"profile-{name}-{timestamp}.prof")
+            deterministic_profiler.dump_stats(output_filepath)
+            profile_result["output_filepath"] = output_filepath
+            LOGGER.info(f"Profile written to {output_filepath}")
+            log_profile_summary(output_filepath)
+
+
+def log_profile_summary(profile_filepath: str, n_stats: int = N_STATS_TO_LOG):
+    stats = pstats.Stats(profile_filepath)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE)
+    LOGGER.info(f"Top {n_stats} functions by cumulative time:")
+    for function_key in stats.fcn_list[0:n_stats]:
+        _, n_calls, _, cumulative_time, _ = stats.stats[function_key]
+        filename, line_number, function_name = function_key
+        LOGGER.info(
+            f"{cumulative_time:>10.3f}s {n_calls:>10} "
+            f"{os.path.basename(filename)}:{line_number}({function_name})"
+        )
@@ -4,64 +4,202 @@
 """
 This code is for exploring what data from Insecurity Insight is available in HDX
 Ian Hopkinson 2023-11-18
+
+The inventory of the organization's datasets is built by listing the datasets with one search and
+then reading the details of each dataset, with its resources, concurrently on a bounded thread
+pool. It is cached on disk as JSON in hdx-inventory/, one file per HDX site, and reused until it
+is older than INVENTORY_TTL_HOURS, which can be set with the
+INSECURITY_INSIGHT_INVENTORY_TTL_HOURS environment variable. run.py --use-inventory reads the
+dataset cache from it rather than reading each dataset separately, and discards it once datasets
+have been updated.
+
+python read_insecurity_insight_hdx.py --hdx-site prod --csv inventory.csv --refresh
 """
-import os
+import argparse
+import datetime
+import json
 import logging
+import os
+import re
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 from hdx.utilities.easy_logging import setup_logging
-from hdx.api.configuration import Configuration, ConfigurationError
+from hdx.api.configuration import Configuration
 from hdx.data.dataset import Dataset
 from hdx.data.organization import Organization
 
+from hdx_scraper_insecurity_insight.checkpoints import (
+    checkpoint_filepath,
+    clear_checkpoint,
+    load_checkpoint,
+    save_checkpoint,
+)
+from hdx_scraper_insecurity_insight.create_datasets import configure_hdx_connection
+from hdx_scraper_insecurity_insight.utilities import write_dictionary
+
 setup_logging()
 LOGGER = logging.getLogger(__name__)
 
-try:
-    Configuration.create(
-        user_agent_config_yaml=os.path.join(os.path.expanduser("~"), ".useragents.yaml"),
-        user_agent_lookup="hdx-scraper-insecurity-insight",
-    )
-except ConfigurationError:
-    LOGGER.info("Configuration already exists when trying to create in `create_datasets.py`")
+ORGANIZATION_NAME = "insecurity-insight"
+INVENTORY_DIRECTORY = os.path.join(os.path.dirname(__file__), "hdx-inventory")
+INVENTORY_TTL_VARIABLE = "INSECURITY_INSIGHT_INVENTORY_TTL_HOURS"
+INVENTORY_TTL_HOURS = float(os.environ.get(INVENTORY_TTL_VARIABLE) or 6)
+INVENTORY_MAX_WORKERS = 8
 
 
-def create_insecurity_insight_resource_list():
-    organization = Organization.read_from_hdx("insecurity-insight")
-    datasets = organization.get_datasets()
+def create_insecurity_insight_resource_list(
+    hdx_site: str = "stage", inventory: Optional[dict] = None
+):
+    if inventory is None:
+        inventory = read_organization_inventory(hdx_site=hdx_site)
 
-    n_datasets = len(datasets)
-    n_resources = 0
-    summary = []
-    resources_dict = {}
-    for dataset in datasets:
-        latest_date = dataset["dataset_date"][24:34]
-        resources = Dataset.get_resources(dataset)
-        for resource in resources:
-            if dataset["name"] not in resources_dict:
-                resources_dict[dataset["name"]] = [resource["name"]]
-            else:
-                resources_dict[dataset["name"]].append(resource["name"])
-        n_resources += dataset["num_resources"]
-        summary.append([dataset["title"], dataset["name"], latest_date, dataset["num_resources"]])
-        # dataset.save_to_json(
-        #     os.path.join(
-        #         os.path.dirname(__file__), "legacy-dataset-json", f"{dataset['name']}.json"
-        #     )
-        # )
-
-    summary.sort(key=lambda x: x[2], reverse=True)
+    summary = make_inventory_summary(inventory)
+    summary.sort(key=lambda x: x["latest_date"], reverse=True)
 
     for entry in summary:
-        print(f"\n{entry[0]}", flush=True)
-        print(f"{entry[1]}:{entry[2]}({entry[3]})", flush=True)
-        for resource in resources_dict[entry[1]]:
+        print(f"\n{entry['title']}", flush=True)
+        print(f"{entry['name']}:{entry['latest_date']}({entry['num_resources']})", flush=True)
+        for resource in entry["resources"]:
             print(f"\t{resource}", flush=True)
 
+    n_datasets = len(summary)
+    n_resources = sum(x["num_resources"] for x in summary)
     LOGGER.info(f"Number of datasets: {n_datasets}")
     LOGGER.info(f"Number of resources: {n_resources}")
 
     return n_datasets, n_resources
 
 
+def read_organization_inventory(
+    hdx_site: str = "stage",
+    inventory_directory: str = INVENTORY_DIRECTORY,
+    ttl_hours: float = INVENTORY_TTL_HOURS,
+    refresh: bool = False,
+    max_workers: int = INVENTORY_MAX_WORKERS,
+) -> dict:
+    # An inventory is only reused for the HDX url it was read from, which differs from the
+    # site name for a custom url such as the local stand-in in fake_ckan.py
+    configure_hdx_connection(hdx_site)
+    hdx_site_url = Configuration.read().get_hdx_site_url()
+    inventory_name = f"inventory-{hdx_site}"
+    if not refresh:
+        inventory = load_checkpoint(inventory_directory, inventory_name)
+        if inventory is not None and inventory.get("hdx_site_url") == hdx_site_url:
+            age_hours = (
+                datetime.datetime.now(datetime.timezone.utc)
+                - datetime.datetime.fromisoformat(inventory["created_at"])
+            ).total_seconds() / 3600
+            if age_hours < ttl_hours:
+                LOGGER.info(
+                    f"Using inventory of {len(inventory['datasets'])} datasets from "
+                    f"{checkpoint_filepath(inventory_directory, inventory_name)}, "
+                    f"{age_hours:.1f} hours old"
+                )
+                return inventory
+            LOGGER.info(f"Inventory is {age_hours:.1f} hours old, older than {ttl_hours} hours")
+
+    inventory = fetch_organization_inventory(hdx_site=hdx_site, max_workers=max_workers)
+    save_checkpoint(inventory_directory, inventory_name, inventory)
+    return inventory
+
+
+def clear_organization_inventory(
+    hdx_site: str = "stage", inventory_directory: str = INVENTORY_DIRECTORY
+):
+    # Called after datasets are updated so the next run does not see their old metadata
+    clear_checkpoint(inventory_directory, f"inventory-{hdx_site}")
+
+
+def fetch_organization_inventory(
+    hdx_site: str = "stage", max_workers: int = INVENTORY_MAX_WORKERS
+) -> dict:
+    configure_hdx_connection(hdx_site)
+    organization = Organization.read_from_hdx(ORGANIZATION_NAME)
+    # The search lists the datasets, details are read from each dataset since the search index
+    # can lag behind recent updates
+    dataset_names = sorted(x["name"] for x in organization.get_datasets(fl="name"))
+    LOGGER.info(f"Reading {len(dataset_names)} datasets with {max_workers} workers")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        datasets = list(executor.map(Dataset.read_from_hdx, dataset_names))
+
+    return {
+        "organization": ORGANIZATION_NAME,
+        "hdx_site": hdx_site,
+        "hdx_site_url": Configuration.read().get_hdx_site_url(),
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "datasets": {
+            x: make_inventory_entry(y) for x, y in zip(dataset_names, datasets) if y is not None
+        },
+    }
+
+
+def make_inventory_entry(dataset: Dataset) -> dict:
+    inventory_entry = dict(dataset.data)
+    inventory_entry["resources"] = [dict(x.data) for x in dataset.get_resources()]
+    return inventory_entry
+
+
+def make_inventory_summary(inventory: dict) -> list[dict]:
+    summary = []
+    for dataset_name, dataset in inventory["datasets"].items():
+        summary.append(
+            {
+                "title": dataset.get("title", ""),
+                "name": dataset_name,
+                "latest_date": get_latest_date(dataset.get("dataset_date", "")),
+                "num_resources": len(dataset["resources"]),
+                "resources": [x["name"] for x in dataset["resources"]],
+            }
+        )
+    return summary
+
+
+def get_latest_date(dataset_date: str) -> str:
+    # dataset_date is a range, i.e. [2020-01-01T00:00:00 TO 2024-05-28T23:59:59]
+    dates = re.findall(r"\d{4}-\d{2}-\d{2}", dataset_date or "")
+    return dates[-1] if len(dates) != 0 else ""
+
+
+def write_inventory_csv(inventory: dict, output_filepath: str) -> str:
+    output_rows = []
+    for entry in make_inventory_summary(inventory):
+        resources = inventory["datasets"][entry["name"]]["resources"] or [{}]
+        for resource in resources:
+            output_rows.append(
+                {
+                    "dataset_name": entry["name"],
+                    "dataset_title": entry["title"],
+                    "latest_date": entry["latest_date"],
+                    "num_resources": entry["num_resources"],
+                    "resource_name": resource.get("name", ""),
+                    "resource_format": resource.get("format", ""),
+                    "resource_last_modified": resource.get("last_modified", ""),
+                }
+            )
+    return write_dictionary(output_filepath, output_rows, append=False)
+
+
+def write_inventory_json(inventory: dict, output_filepath: str):
+    with open(output_filepath, "w", encoding="utf-8") as output_file:
+        json.dump(inventory, output_file, indent=2)
+
+
 if __name__ == "__main__":
-    N_DATASETS, N_RESOURCES = create_insecurity_insight_resource_list()
+    PARSER = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    PARSER.add_argument("--hdx-site", default="stage", choices=["prod", "stage"])
+    PARSER.add_argument("--refresh", action="store_true", help="ignore the cached inventory")
+    PARSER.add_argument("--max-workers", type=int, default=INVENTORY_MAX_WORKERS)
+    PARSER.add_argument("--json", help="write the inventory to this JSON file")
+    PARSER.add_argument("--csv", help="write a row per resource to this CSV file")
+    ARGUMENTS = PARSER.parse_args(sys.argv[1:])
+    INVENTORY = read_organization_inventory(
+        hdx_site=ARGUMENTS.hdx_site, refresh=ARGUMENTS.refresh, max_workers=ARGUMENTS.max_workers
+    )
+    N_DATASETS, N_RESOURCES = create_insecurity_insight_resource_list(inventory=INVENTORY)
+    if ARGUMENTS.json is not None:
+        write_inventory_json(INVENTORY, ARGUMENTS.json)
+    if ARGUMENTS.csv is not None:
+        print(write_inventory_csv(INVENTORY, ARGUMENTS.csv), flush=True)
@@ -1,24 +1,34 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import argparse
 import json
 import logging
 import os
 import re
+import sys
 import time
 from typing import Optional
 
 from hdx.utilities.easy_logging import setup_logging
 
 from hdx_scraper_insecurity_insight.generate_api_transformation_schema import (
+    compare_api_profiles_to_samples,
     compare_api_to_samples,
 )
+from hdx_scraper_insecurity_insight.schema_profile import (
+    get_schema_profile,
+    handle_schema_drift,
+    record_schema_profile,
+)
 
 from hdx_scraper_insecurity_insight.utilities import (
+    API_BASE_URL_VARIABLE,
     list_entities,
     read_attributes,
     fetch_json,
     print_banner_to_log,
+    project_api_response,
     read_countries,
 )
 
@@ -29,7 +39,62 @@ from hdx_scraper_insecurity_insight.create_datasets import (
     create_datasets_in_hdx,
 )
 
-from hdx_scraper_insecurity_insight.create_spreadsheets import create_spreadsheet
+from hdx_scraper_insecurity_insight import create_spreadsheets
+from hdx_scraper_insecurity_insight.create_spreadsheets import (
+    create_spreadsheet,
+    list_output_filenames,
+)
+from hdx_scraper_insecurity_insight.spreadsheet_buffers import SpreadsheetBuffers
+from hdx_scraper_insecurity_insight.change_plan import (
+    CONTENT_HASHES_DIRECTORY,
+    load_content_hashes,
+    log_change_plan,
+    make_change_plan,
+    record_published_spreadsheets,
+    write_change_plan,
+)
+from hdx_scraper_insecurity_insight.fake_api import FakeInsecurityInsightAPI
+from hdx_scraper_insecurity_insight.fake_ckan import FakeCKANServer
+from hdx_scraper_insecurity_insight.read_insecurity_insight_hdx import (
+    clear_organization_inventory,
+    read_organization_inventory,
+)
+from hdx_scraper_insecurity_insight.checkpoints import (
+    STATE_DIRECTORY,
+    clear_checkpoint,
+    clear_run_state,
+    list_completed,
+    load_checkpoint,
+    mark_completed,
+    mark_completed_with_outputs,
+    read_completed_outputs,
+    save_checkpoint,
+    start_run_state,
+)
+from hdx_scraper_insecurity_insight.metrics import (
+    METRICS_DIRECTORY,
+    configure_memory_tracking,
+    log_metrics_summary,
+    make_metrics_report,
+    reset_metrics,
+    write_metrics_report,
+)
+from hdx_scraper_insecurity_insight.profiling import PROFILERS, profile_run
+from hdx_scraper_insecurity_insight.upload_queue import (
+    UPLOAD_MAX_WORKERS,
+    UploadFailed,
+    UploadQueue,
+    list_uploads,
+    make_upload_report_rows,
+    reset_uploads,
+    run_upload,
+    summarise_uploads,
+)
+from hdx_scraper_insecurity_insight.pipeline_scheduler import (
+    Task,
+    run_task_graph,
+    log_task_graph_report,
+)
 
 setup_logging()
 LOGGER = logging.getLogger(__name__)
@@ -47,16 +112,21 @@ TOPICS = [
 
 
 def fetch_and_cache_api_responses(
-    save_response: bool = False, use_sample: bool = False, refresh: Optional[list] = None
+    save_response: bool = False,
+    use_sample: bool = False,
+    refresh: Optional[list] = None,
+    state_directory: Optional[str] = None,
 ) -> dict:
     if refresh is None:
         refresh = ["all"]
     api_cache = {}
+    # The resource first read from each endpoint, the current-year resources read the same
+    # endpoint as their incidents resource so are not fetched again
+    endpoints = {}
     print_banner_to_log(LOGGER, "Populate API cache")
 
     resource_list = list_entities(type_="resource")
     for resource in resource_list:
-        t0 = time.time()
         refresh_flag = False
         for item in refresh:
             if item == "all":
@@ -69,14 +139,37 @@ def fetch_and_cache_api_responses(
             LOGGER.info(f"Skipping {resource} because refresh = {refresh}")
             continue
 
+        attributes = read_attributes(resource)
+        endpoint = (attributes["api_url"], attributes["api_response_filename"])
+        if endpoint in endpoints:
+            LOGGER.info(f"Using the response for {endpoints[endpoint]} for {resource}")
+            api_cache[resource] = api_cache[endpoints[endpoint]]
+            record_schema_profile(resource, get_schema_profile(endpoints[endpoint]))
+            continue
+        endpoints[endpoint] = resource
+
+        if state_directory is not None:
+            checkpoint = load_checkpoint(state_directory, f"api-cache/{resource}")
+            if checkpoint is not None:
+                LOGGER.info(f"Using checkpoint for {resource} from {state_directory}")
+                api_cache[resource] = checkpoint
+                schema_profile = load_checkpoint(state_directory, f"api-profile/{resource}")
+                if schema_profile is not None:
+                    record_schema_profile(resource, schema_profile)
+                continue
+
         if not use_sample:
             LOGGER.info(f"Fetching data for {resource} from API")
         else:
             LOGGER.info(f"Fetching data for {resource} from samples")
         api_cache[resource] = fetch_json(resource, use_sample=use_sample)
+        if state_directory is not None:
+            save_checkpoint(state_directory, f"api-cache/{resource}", api_cache[resource])
+            save_checkpoint(
+                state_directory, f"api-profile/{resource}", get_schema_profile(resource)
+            )
 
         if save_response:
-            attributes = read_attributes(resource)
             with open(
                 os.path.join(
                     os.path.dirname(__file__),
@@ -87,9 +180,7 @@ def fetch_and_cache_api_responses(
                 encoding="UTF-8",
             ) as json_file_handle:
                 json.dump(api_cache[resource], json_file_handle)
-        LOGGER.info(
-            f"... took {time.time()-t0:0.0f} seconds for {len(api_cache[resource])} records"
-        )
+        LOGGER.info(f"... fetched {len(api_cache[resource])} records")
         if not use_sample:
             LOGGER.info(f"Delaying next call for {API_DELAY} seconds\n")
             time.sleep(API_DELAY)
@@ -98,16 +189,61 @@ def fetch_and_cache_api_responses(
     return api_cache
 
 
+def project_api_cache(api_cache: dict) -> dict:
+    print_banner_to_log(LOGGER, "Project API cache")
+    # A response shared by an incidents resource and its current-year resource is projected once
+    projected_responses = {}
+    for resource, api_response in api_cache.items():
+        if id(api_response) not in projected_responses:
+            projected_responses[id(api_response)] = project_api_response(resource, api_response)
+        api_cache[resource] = projected_responses[id(api_response)]
+
+    return api_cache
+
+
 def fetch_and_cache_datasets(
-    use_legacy: bool = False, hdx_site: str = "stage", refresh: Optional[list] = None
+    use_legacy: bool = False,
+    hdx_site: str = "stage",
+    refresh: Optional[list] = None,
+    countries: Optional[list[str]] = None,
+    use_inventory: bool = False,
 ) -> dict:
-    if refresh is None:
-        refresh = ["all"]
     dataset_cache = {}
     print_banner_to_log(LOGGER, "Populate dataset cache")
+    inventory = read_organization_inventory(hdx_site=hdx_site) if use_inventory else None
+    n_topic_datasets = 0
+    n_countries = 0
+    for cache_key, dataset_name, country_filter in list_datasets_to_cache(
+        refresh=refresh, countries=countries
+    ):
+        dataset_cache[cache_key] = fetch_dataset_for_cache(
+            dataset_name,
+            country_filter=country_filter,
+            use_legacy=use_legacy,
+            hdx_site=hdx_site,
+            inventory=inventory,
+        )
+        if country_filter == "":
+            n_topic_datasets += 1
+        else:
+            n_countries += 1
+
+    LOGGER.info(f"Loaded {len(dataset_cache)} datasets to cache")
+
+    LOGGER.info(f"Found {n_topic_datasets}, expected 6 topic datasets")
+    LOGGER.info(f"Found {n_countries}, expected 24 country datasets")
+    return dataset_cache
+
+
+def list_datasets_to_cache(
+    refresh: Optional[list] = None, countries: Optional[list[str]] = None
+) -> list[tuple[str, str, str]]:
+    # Returns (dataset cache key, dataset name, country filter) for each dataset to be cached
+    if refresh is None:
+        refresh = ["all"]
+    datasets_to_cache = []
     dataset_list = list_entities(type_="dataset")
     # load topic datasets
-    n_topic_datasets = 0
     for dataset in dataset_list:
         refresh_flag = False
         for item in refresh:
@@ -120,32 +256,49 @@ def fetch_and_cache_datasets(
         if not refresh_flag:
             LOGGER.info(f"Skipping {dataset} because refresh = {refresh}")
             continue
-        print(dataset, flush=True)
         if dataset == COUNTRY_DATASET_BASENAME:
             continue
-        dataset_cache[dataset], _ = create_or_fetch_base_dataset(
-            dataset, use_legacy=use_legacy, hdx_site=hdx_site
-        )
-        n_topic_datasets += 1
+        datasets_to_cache.append((dataset, dataset, ""))
 
     # Load country datasets
-    countries = read_countries()
-    n_countries = 0
-    for country in countries.keys():
-        dataset_name = COUNTRY_DATASET_BASENAME.replace("country", country.lower())
-        dataset_cache[dataset_name], _ = create_or_fetch_base_dataset(
-            COUNTRY_DATASET_BASENAME,
-            country_filter=country,
-            use_legacy=use_legacy,
-            hdx_site=hdx_site,
-        )
-        n_countries += 1
+    for country in select_countries(countries):
+        cache_key = COUNTRY_DATASET_BASENAME.replace("country", country.lower())
+        datasets_to_cache.append((cache_key, COUNTRY_DATASET_BASENAME, country))
 
-    LOGGER.info(f"Loaded {len(dataset_cache)} datasets to cache")
+    return datasets_to_cache
 
-    LOGGER.info(f"Found {n_topic_datasets}, expected 6 topic datasets")
-    LOGGER.info(f"Found {n_countries}, expected 24 country datasets")
-    return dataset_cache
+
+def fetch_dataset_for_cache(
+    dataset_name: str,
+    country_filter: str = "",
+    use_legacy: bool = False,
+    hdx_site: str = "stage",
+    inventory: Optional[dict] = None,
+) -> dict:
+    dataset, _ = create_or_fetch_base_dataset(
+        dataset_name,
+        country_filter=country_filter,
+        use_legacy=use_legacy,
+        hdx_site=hdx_site,
+        inventory=inventory,
+    )
+    return dataset
+
+
+def collect_dataset_cache(**datasets) -> dict:
+    LOGGER.info(f"Loaded {len(datasets)} datasets to cache")
+    return datasets
+
+
+def select_countries(countries: Optional[list[str]] = None) -> list[str]:
+    # All countries with datasets unless a list of ISO3 codes is given
+    all_countries = list(read_countries().keys())
+    if countries is None:
+        return all_countries
+    unknown_countries = [x for x in countries if x not in all_countries]
+    if len(unknown_countries) != 0:
+        raise ValueError(f"No country datasets for {unknown_countries}")
+    return [x for x in all_countries if x in countries]
 
 
 def check_api_has_not_changed(api_cache: dict, refresh: Optional[list] = None) -> tuple[bool, list]:
@@ -163,6 +316,7 @@ def check_api_has_not_changed(api_cache: dict, refresh: Optional[list] = None) -
         LOGGER.info(dataset_name)
 
     assert not has_changed, "!!One or more of the Insecurity Insight endpoints has changed format"
+    handle_schema_drift(compare_api_profiles_to_samples(dataset_names=dataset_names))
     return has_changed, changed_list
 
 
@@ -173,6 +327,7 @@ def decide_which_resources_have_fresh_data(
     dataset_list: Optional[list[str]] = None,
     resource_list: Optional[list[str]] = None,
     topic_list: Optional[list[str]] = None,
+    state_directory: Optional[str] = None,
 ) -> list[str]:
     """This function returns a list of tuples for datasets that need updating containing:
     (topic, api start date, api end date)
@@ -192,6 +347,11 @@ def decide_which_resources_have_fresh_data(
         list[str] -- _description_
     """
     print_banner_to_log(LOGGER, "Identify updates")
+    if state_directory is not None:
+        checkpoint = load_checkpoint(state_directory, "items-to-update")
+        if checkpoint is not None:
+            LOGGER.info(f"Using checkpoint for items to update from {state_directory}")
+            return [tuple(x) for x in checkpoint]
     if refresh is None:
         refresh = []
     if len(refresh) != 0 and "all" in refresh:
@@ -233,15 +393,7 @@ def decide_which_resources_have_fresh_data(
             resource_start_date[resource] = ""
     # Compare
     if topic_list is None:
-        topic_list = [
-            "crsv",
-            "education",
-            "explosive",
-            "healthcare",
-            "protection",
-            "aidworkerKIKA",
-            "foodsecurity",
-        ]
+        topic_list = TOPICS
 
     items_to_update = []
     LOGGER.info(
@@ -280,6 +432,8 @@ def decide_which_resources_have_fresh_data(
             f"{update_str}"
         )
 
+    if state_directory is not None:
+        save_checkpoint(state_directory, "items-to-update", items_to_update)
     return items_to_update
 
 
@@ -297,43 +451,125 @@ def parse_dates_from_string(date_str: str) -> list[str]:
     return start_date, end_date
 
 
-def refresh_spreadsheets_with_fresh_data(items_to_update: list[str], api_cache: dict):
+def refresh_spreadsheets_with_fresh_data(
+    items_to_update: list[str],
+    api_cache: dict,
+    spreadsheet_buffers: Optional[SpreadsheetBuffers] = None,
+    state_directory: Optional[str] = None,
+    countries: Optional[list[str]] = None,
+):
     print_banner_to_log(LOGGER, "Refresh spreadsheets")
     if len(items_to_update) == 0:
         LOGGER.info("No spreadsheets need to be updated")
         return
 
-    resources = list_entities(type_="resource")
-
     LOGGER.info(f"Refreshing topic spreadsheets for {','.join([x[0] for x in items_to_update])}")
     for item in items_to_update:
-        for resource in resources:
-            if item[0] in resource:
-                # This is where we would create a year spreadsheet
-                try:
-                    status = create_spreadsheet(resource, api_response=api_cache[resource])
-                except KeyError:
-                    pass
-
-                LOGGER.info(status)
-
-    LOGGER.info("Refreshing all country spreadsheets")
-    # LOGGER.info("**ONLY DOING ONE COUNTRY FOR TEST**")
-    countries = read_countries()
-    country_attributes = read_attributes(COUNTRY_DATASET_BASENAME)
-    resource_names = country_attributes["resource"]
-    for country in countries:
-        LOGGER.info(f"Processing for {country}")
-        for resource in resource_names:
+        refresh_topic_spreadsheets(
+            item,
+            api_cache,
+            spreadsheet_buffers=spreadsheet_buffers,
+            state_directory=state_directory,
+        )
+
+    LOGGER.info("Refreshing country spreadsheets")
+    for country in select_countries(countries):
+        refresh_country_spreadsheets(
+            country,
+            api_cache,
+            spreadsheet_buffers=spreadsheet_buffers,
+            state_directory=state_directory,
+        )
+
+        # break  # just do one spreadsheet for testing
+
+
+def refresh_topic_spreadsheets(
+    item: tuple[str, str, str],
+    api_cache: dict,
+    spreadsheet_buffers: Optional[SpreadsheetBuffers] = None,
+    state_directory: Optional[str] = None,
+) -> list[str]:
+    status_list = []
+    if is_spreadsheet_unit_complete(f"topic:{item[0]}", spreadsheet_buffers, state_directory):
+        return status_list
+    # The current-year spreadsheet is a slice of the index made for the incidents spreadsheet
+    spreadsheet_indexes = {}
+    for resource in list_entities(type_="resource"):
+        if item[0] in resource:
             try:
                 status = create_spreadsheet(
-                    resource, country_filter=country, api_response=api_cache[resource]
+                    resource,
+                    api_response=api_cache[resource],
+                    spreadsheet_buffers=spreadsheet_buffers,
+                    spreadsheet_indexes=spreadsheet_indexes,
                 )
             except KeyError:
-                pass
+                continue
+
             LOGGER.info(status)
+            status_list.append(status)
 
-        # break  # just do one spreadsheet for testing
+    mark_completed_with_outputs(
+        state_directory,
+        "spreadsheets",
+        f"topic:{item[0]}",
+        [y for x in status_list for y in list_output_filenames(x)],
+    )
+    return status_list
+
+
+def refresh_country_spreadsheets(
+    country: str,
+    api_cache: dict,
+    spreadsheet_buffers: Optional[SpreadsheetBuffers] = None,
+    state_directory: Optional[str] = None,
+) -> list[str]:
+    LOGGER.info(f"Processing for {country}")
+    status_list = []
+    if is_spreadsheet_unit_complete(f"country:{country}", spreadsheet_buffers, state_directory):
+        return status_list
+    resource_names = read_attributes(COUNTRY_DATASET_BASENAME)["resource"]
+    for resource in resource_names:
+        try:
+            status = create_spreadsheet(
+                resource,
+                country_filter=country,
+                api_response=api_cache[resource],
+                spreadsheet_buffers=spreadsheet_buffers,
+            )
+        except KeyError:
+            continue
+        LOGGER.info(status)
+        status_list.append(status)
+
+    mark_completed_with_outputs(
+        state_directory,
+        "spreadsheets",
+        f"country:{country}",
+        [y for x in status_list for y in list_output_filenames(x)],
+    )
+    return status_list
+
+
+def is_spreadsheet_unit_complete(
+    unit: str, spreadsheet_buffers: Optional[SpreadsheetBuffers], state_directory: Optional[str]
+) -> bool:
+    # Spreadsheets held in memory are lost with the interrupted run so must be regenerated, as
+    # must spreadsheets missing from output-spreadsheets, i.e. when only run-state was restored
+    completed = read_completed_outputs(state_directory, "spreadsheets")
+    if spreadsheet_buffers is not None or unit not in completed:
+        return False
+    missing = [
+        x
+        for x in completed[unit]
+        if not os.path.exists(os.path.join(create_spreadsheets.OUTPUT_DIRECTORY, x))
+    ]
+    if len(missing) != 0:
+        LOGGER.info(f"Spreadsheets for {unit} are missing {missing}, regenerating")
+        return False
+    LOGGER.info(f"Spreadsheets for {unit} already generated, skipping")
+    return True
 
 
 def update_datasets_whose_resources_have_changed(
@@ -343,96 +579,836 @@ def update_datasets_whose_resources_have_changed(
     dry_run: bool = False,
     use_legacy: bool = True,
     hdx_site: str = None,
+    spreadsheet_buffers: Optional[SpreadsheetBuffers] = None,
+    state_directory: Optional[str] = None,
+    countries: Optional[list[str]] = None,
+    hashes_directory: Optional[str] = None,
+    max_workers: int = UPLOAD_MAX_WORKERS,
 ) -> list[list]:
+    # Each dataset is uploaded as a separate item on the upload queue, with retries, so that a
+    # slow or failing upload does not hold up the others
     print_banner_to_log(LOGGER, "Update datasets")
     if len(items_to_update) == 0:
         LOGGER.info("No datasets need to be updated")
         return []
 
-    missing_report = []
-    datasets = list_entities(type_="dataset")
-    n_missing_resources = 0
-    for item in items_to_update:
-        for dataset_name in datasets:
-            if item[0] in dataset_name:
-                countries_group = get_countries_group_from_api_response(
-                    api_cache[f"insecurity-insight-{item[0]}-incidents"]
-                )
-                dataset_date = f"[{item[1]} TO {item[2]}]"
-                dataset, n_missing_resources = create_datasets_in_hdx(
+    with UploadQueue(max_workers=max_workers) as upload_queue:
+        for item in items_to_update:
+            for dataset_name in list_topic_datasets(item):
+                upload_queue.submit(
+                    dataset_name,
+                    update_topic_dataset,
                     dataset_name,
-                    dataset_cache=dataset_cache,
-                    dataset_date=dataset_date,
-                    countries_group=countries_group,
+                    item,
+                    api_cache,
+                    dataset_cache,
                     dry_run=dry_run,
                     use_legacy=use_legacy,
                     hdx_site=hdx_site,
+                    spreadsheet_buffers=spreadsheet_buffers,
+                    state_directory=state_directory,
+                    hashes_directory=hashes_directory,
                 )
-            if n_missing_resources != 0:
-                missing_report.append([dataset["name"], n_missing_resources])
 
-    # If any data has updated we update all of the country datasets
-    # LOGGER.info("**ONLY DOING ONE COUNTRY FOR TEST**")
-    countries = read_countries()
+        # If any data has updated we update all of the country datasets
+        dataset_date = make_default_country_dataset_date(items_to_update)
+        for country in select_countries(countries):
+            upload_queue.submit(
+                COUNTRY_DATASET_BASENAME.replace("country", country.lower()),
+                update_country_dataset,
+                country,
+                dataset_cache,
+                dataset_date,
+                dry_run=dry_run,
+                hdx_site=hdx_site,
+                spreadsheet_buffers=spreadsheet_buffers,
+                state_directory=state_directory,
+                api_cache=api_cache,
+                hashes_directory=hashes_directory,
+            )
+
+    missing_report = []
+    for upload_result in upload_queue.results.values():
+        missing_report.extend(upload_result)
+    return check_uploads(missing_report, list(upload_queue.results) + upload_queue.list_failed())
+
+
+def update_topic_datasets(
+    item: tuple[str, str, str],
+    api_cache: dict,
+    dataset_cache: dict,
+    dry_run: bool = False,
+    use_legacy: bool = True,
+    hdx_site: str = None,
+    spreadsheet_buffers: Optional[SpreadsheetBuffers] = None,
+    state_directory: Optional[str] = None,
+    hashes_directory: Optional[str] = None,
+) -> list[list]:
+    missing_report = []
+    for dataset_name in list_topic_datasets(item):
+        missing_report.extend(
+            update_topic_dataset(
+                dataset_name,
+                item,
+                api_cache,
+                dataset_cache,
+                dry_run=dry_run,
+                use_legacy=use_legacy,
+                hdx_site=hdx_site,
+                spreadsheet_buffers=spreadsheet_buffers,
+                state_directory=state_directory,
+                hashes_directory=hashes_directory,
+            )
+        )
+
+    return missing_report
+
+
+def list_topic_datasets(item: tuple[str, str, str]) -> list[str]:
+    return [x for x in list_entities(type_="dataset") if item[0] in x]
+
+
+def update_topic_dataset(
+    dataset_name: str,
+    item: tuple[str, str, str],
+    api_cache: dict,
+    dataset_cache: dict,
+    dry_run: bool = False,
+    use_legacy: bool = True,
+    hdx_site: str = None,
+    spreadsheet_buffers: Optional[SpreadsheetBuffers] = None,
+    state_directory: Optional[str] = None,
+    hashes_directory: Optional[str] = None,
+) -> list[list]:
+    if dataset_name in list_completed(state_directory, "uploads"):
+        LOGGER.info(f"{dataset_name} already updated in HDX, skipping")
+        return []
+    countries_group = get_countries_group_from_api_response(
+        api_cache[f"insecurity-insight-{item[0]}-incidents"]
+    )
+    dataset_date = f"[{item[1]} TO {item[2]}]"
+    dataset, n_missing_resources = create_datasets_in_hdx(
+        dataset_name,
+        dataset_cache=dataset_cache,
+        dataset_date=dataset_date,
+        countries_group=countries_group,
+        dry_run=dry_run,
+        use_legacy=use_legacy,
+        hdx_site=hdx_site,
+        spreadsheet_buffers=spreadsheet_buffers,
+    )
+    missing_report = []
+    if n_missing_resources != 0:
+        missing_report.append([dataset["name"], n_missing_resources])
+    if not dry_run:
+        mark_completed(state_directory, "uploads", dataset_name)
+        record_published_spreadsheets(api_cache, hashes_directory, topics=[item[0]], countries=[])
+
+    return missing_report
+
+
+def make_default_country_dataset_date(items_to_update: list[str]) -> str:
     # Make a default dataset_date in case a country dataset has no data
     start_date = min([x[1] for x in items_to_update])
     end_date = max([x[2] for x in items_to_update])
-    dataset_date = f"[{start_date} TO {end_date}]"
-    for country in countries:
-        countries_group = [{"name": country.lower()}]
-
-        # start_date, end_date = get_date_range_from_api_response(
-        #     api_cache[f"insecurity-insight-{item[0]}-incidents"], country_filter=country
-        # )
-        # if start_date is not None and end_date is not None:
-        #     dataset_date = f"[{start_date} TO {end_date}]"
-        dataset, n_missing_resources = create_datasets_in_hdx(
-            COUNTRY_DATASET_BASENAME,
-            country_filter=country,
-            dataset_cache=dataset_cache,
-            dataset_date=dataset_date,
-            countries_group=countries_group,
-            dry_run=dry_run,
-            hdx_site=hdx_site,
+    return f"[{start_date} TO {end_date}]"
+
+
+def update_country_dataset(
+    country: str,
+    dataset_cache: dict,
+    dataset_date: str,
+    dry_run: bool = False,
+    hdx_site: str = None,
+    spreadsheet_buffers: Optional[SpreadsheetBuffers] = None,
+    state_directory: Optional[str] = None,
+    api_cache: Optional[dict] = None,
+    hashes_directory: Optional[str] = None,
+) -> list[list]:
+    country_dataset_name = COUNTRY_DATASET_BASENAME.replace("country", country.lower())
+    if country_dataset_name in list_completed(state_directory, "uploads"):
+        LOGGER.info(f"{country_dataset_name} already updated in HDX, skipping")
+        return []
+    countries_group = [{"name": country.lower()}]
+
+    # start_date, end_date = get_date_range_from_api_response(
+    #     api_cache[f"insecurity-insight-{item[0]}-incidents"], country_filter=country
+    # )
+    # if start_date is not None and end_date is not None:
+    #     dataset_date = f"[{start_date} TO {end_date}]"
+    dataset, n_missing_resources = create_datasets_in_hdx(
+        COUNTRY_DATASET_BASENAME,
+        country_filter=country,
+        dataset_cache=dataset_cache,
+        dataset_date=dataset_date,
+        countries_group=countries_group,
+        dry_run=dry_run,
+        hdx_site=hdx_site,
+        spreadsheet_buffers=spreadsheet_buffers,
+    )
+    missing_report = []
+    if n_missing_resources != 0:
+        missing_report.append([dataset["name"], n_missing_resources])
+    if not dry_run:
+        mark_completed(state_directory, "uploads", country_dataset_name)
+        if api_cache is not None:
+            record_published_spreadsheets(
+                api_cache, hashes_directory, topics=[], countries=[country]
+            )
+
+    return missing_report
+
+
+def run_pipeline(
+    use_sample: bool = False,
+    dry_run: bool = False,
+    refresh: Optional[list] = None,
+    use_legacy: bool = True,
+    hdx_site: str = "stage",
+    spreadsheet_buffers: Optional[SpreadsheetBuffers] = None,
+    max_workers: int = 4,
+    state_directory: Optional[str] = None,
+    topics: Optional[list[str]] = None,
+    countries: Optional[list[str]] = None,
+    hashes_directory: Optional[str] = None,
+    use_inventory: bool = False,
+) -> tuple[list, list]:
+    # Runs the same stages as __main__ as a task graph so that the dataset cache is fetched
+    # while the API is read, and spreadsheets for one topic or country are generated while
+    # datasets for others are uploaded. The upload graph depends on which items have fresh data
+    # so the run is made in two graphs.
+    print_banner_to_log(LOGGER, "Pipeline run")
+    fetch_tasks = [
+        Task(
+            "fetch_api",
+            fetch_and_cache_api_responses,
+            kwargs={"use_sample": use_sample, "state_directory": state_directory},
+        ),
+        Task("check_api", check_api_has_not_changed, inputs={"api_cache": "fetch_api"}),
+        # The API check compares full records so it must run before the cache is projected
+        Task(
+            "project_api",
+            project_api_cache,
+            inputs={"api_cache": "fetch_api"},
+            dependencies=["check_api"],
+        ),
+        Task(
+            "decide",
+            decide_which_resources_have_fresh_data,
+            kwargs={
+                "refresh": refresh,
+                "topic_list": topics,
+                "state_directory": state_directory,
+            },
+            inputs={"dataset_cache": "fetch_datasets", "api_cache": "project_api"},
+        ),
+    ]
+    # Each dataset in the dataset cache is read from HDX as a separate task, or taken from the
+    # organization inventory which is read before the graph is run
+    inventory = read_organization_inventory(hdx_site=hdx_site) if use_inventory else None
+    dataset_inputs = {}
+    for cache_key, dataset_name, country_filter in list_datasets_to_cache(countries=countries):
+        fetch_tasks.append(
+            Task(
+                f"dataset:{cache_key}",
+                fetch_dataset_for_cache,
+                args=(dataset_name,),
+                kwargs={
+                    "country_filter": country_filter,
+                    "use_legacy": use_legacy,
+                    "hdx_site": hdx_site,
+                    "inventory": inventory,
+                },
+            )
+        )
+        dataset_inputs[cache_key] = f"dataset:{cache_key}"
+    fetch_tasks.append(Task("fetch_datasets", collect_dataset_cache, inputs=dataset_inputs))
+
+    fetch_results, fetch_timings = run_task_graph(fetch_tasks, max_workers=max_workers)
+    log_task_graph_report(fetch_tasks, fetch_timings)
+
+    api_cache = fetch_results["project_api"]
+    dataset_cache = fetch_results["fetch_datasets"]
+    items_to_update = fetch_results["decide"]
+    if len(items_to_update) == 0:
+        LOGGER.info("No spreadsheets or datasets need to be updated")
+        return items_to_update, []
+
+    update_tasks = make_update_tasks(
+        items_to_update,
+        api_cache,
+        dataset_cache,
+        dry_run=dry_run,
+        use_legacy=use_legacy,
+        hdx_site=hdx_site,
+        spreadsheet_buffers=spreadsheet_buffers,
+        state_directory=state_directory,
+        countries=countries,
+        hashes_directory=hashes_directory,
+    )
+    update_results, update_timings = run_task_graph(update_tasks, max_workers=max_workers)
+    log_task_graph_report(update_tasks, update_timings)
+
+    missing_report = []
+    upload_keys = []
+    for task in update_tasks:
+        if task.name.startswith("upload"):
+            # Uploads which failed on every attempt have no result
+            missing_report.extend(update_results[task.name] or [])
+            upload_keys.append(task.name)
+
+    return items_to_update, check_uploads(missing_report, upload_keys)
+
+
+def make_update_tasks(
+    items_to_update: list[str],
+    api_cache: dict,
+    dataset_cache: dict,
+    dry_run: bool = False,
+    use_legacy: bool = True,
+    hdx_site: str = None,
+    spreadsheet_buffers: Optional[SpreadsheetBuffers] = None,
+    state_directory: Optional[str] = None,
+    countries: Optional[list[str]] = None,
+    hashes_directory: Optional[str] = None,
+) -> list[Task]:
+    tasks = []
+    for item in items_to_update:
+        tasks.append(
+            Task(
+                f"spreadsheets:{item[0]}",
+                refresh_topic_spreadsheets,
+                args=(item, api_cache),
+                kwargs={
+                    "spreadsheet_buffers": spreadsheet_buffers,
+                    "state_directory": state_directory,
+                },
+            )
+        )
+        tasks.append(
+            Task(
+                f"upload:{item[0]}",
+                run_upload,
+                args=(f"upload:{item[0]}", update_topic_datasets, item, api_cache, dataset_cache),
+                kwargs={
+                    "dry_run": dry_run,
+                    "use_legacy": use_legacy,
+                    "hdx_site": hdx_site,
+                    "spreadsheet_buffers": spreadsheet_buffers,
+                    "state_directory": state_directory,
+                    "hashes_directory": hashes_directory,
+                },
+                dependencies=[f"spreadsheets:{item[0]}"],
+            )
+        )
+
+    dataset_date = make_default_country_dataset_date(items_to_update)
+    for country in select_countries(countries):
+        tasks.append(
+            Task(
+                f"spreadsheets:{country}",
+                refresh_country_spreadsheets,
+                args=(country, api_cache),
+                kwargs={
+                    "spreadsheet_buffers": spreadsheet_buffers,
+                    "state_directory": state_directory,
+                },
+            )
+        )
+        tasks.append(
+            Task(
+                f"upload:{country}",
+                run_upload,
+                args=(
+                    f"upload:{country}",
+                    update_country_dataset,
+                    country,
+                    dataset_cache,
+                    dataset_date,
+                ),
+                kwargs={
+                    "dry_run": dry_run,
+                    "hdx_site": hdx_site,
+                    "spreadsheet_buffers": spreadsheet_buffers,
+                    "state_directory": state_directory,
+                    "api_cache": api_cache,
+                    "hashes_directory": hashes_directory,
+                },
+                dependencies=[f"spreadsheets:{country}"],
+            )
+        )
+
+    return tasks
+
+
+def make_argument_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="run.py",
+        description="Update the Insecurity Insight datasets on HDX from the Insecurity Insight API",
+        epilog="With no command the full pipeline is run, as for `run.py all`",
+    )
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument(
+        "--sample", action="store_true", help="read the API samples rather than the live API"
+    )
+    options.add_argument(
+        "--topics", nargs="+", choices=TOPICS, help="topics to consider, default all topics"
+    )
+    options.add_argument(
+        "--countries",
+        nargs="+",
+        type=str.upper,
+        help="ISO3 codes of the country datasets to update, default all countries",
+    )
+    options.add_argument(
+        "--refresh",
+        nargs="+",
+        default=[],
+        choices=TOPICS + ["all"],
+        help="topics to update even if there is no new data",
+    )
+    options.add_argument("--hdx-site", default="prod", choices=["prod", "stage"])
+    options.add_argument(
+        "--no-legacy",
+        dest="use_legacy",
+        action="store_false",
+        help="create datasets from the templates rather than updating the legacy datasets",
+    )
+    options.add_argument("--dry-run", action="store_true", help="make no changes to HDX")
+    options.add_argument(
+        "--use-inventory",
+        action="store_true",
+        help="take the dataset cache from the cached inventory of the organization's datasets",
+    )
+    options.add_argument(
+        "--state-dir",
+        default=STATE_DIRECTORY,
+        help="directory for checkpoints, used to pass results between stages",
+    )
+    options.add_argument(
+        "--parallel",
+        action="store_true",
+        help="generate spreadsheets and upload datasets concurrently",
+    )
+    options.add_argument("--max-workers", type=int, default=4)
+    options.add_argument(
+        "--hashes-dir",
+        default=CONTENT_HASHES_DIRECTORY,
+        help="directory for the content hashes of published spreadsheets, used by diff",
+    )
+    options.add_argument(
+        "--local-hdx", action="store_true", help="use a local in-process stand-in for HDX"
+    )
+    options.add_argument(
+        "--local-api",
+        action="store_true",
+        help="use a local in-process stand-in for the Insecurity Insight API",
+    )
+    options.add_argument(
+        "--profile", nargs="?", const="cprofile", choices=PROFILERS, help="profile the run"
+    )
+    options.add_argument(
+        "--report-dir",
+        default=METRICS_DIRECTORY,
+        help="directory for the metrics report and profiles",
+    )
+    options.add_argument(
+        "--tracemalloc", action="store_true", default=None, help="trace memory allocations"
+    )
+    options.add_argument("--memory-budget-mb", type=float, help="peak RSS budget in MB")
+    options.add_argument("--memory-budget-action", choices=["warn", "fail"])
+
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.add_parser(
+        "fetch", parents=[options], help="fetch API responses, starting a new staged run"
+    )
+    subparsers.add_parser(
+        "check", parents=[options], help="check the API responses match the samples"
+    )
+    subparsers.add_parser(
+        "plan", parents=[options], help="decide which topics have new data to publish"
+    )
+    diff_parser = subparsers.add_parser(
+        "diff",
+        parents=[options],
+        help="list the spreadsheets and dataset fields an update would change, without writing",
+    )
+    diff_parser.add_argument(
+        "--detailed-exitcode",
+        action="store_true",
+        help="exit with status 2 if there are changes, 0 if there are none",
+    )
+    subparsers.add_parser(
+        "spreadsheets", parents=[options], help="generate spreadsheets for the planned updates"
+    )
+    subparsers.add_parser("upload", parents=[options], help="update datasets in HDX")
+    all_parser = subparsers.add_parser("all", parents=[options], help="run the full pipeline")
+    all_parser.add_argument(
+        "--resume", action="store_true", help="skip work completed by an interrupted run"
+    )
+    all_parser.add_argument(
+        "--in-memory", action="store_true", help="keep generated spreadsheets in memory"
+    )
+    all_parser.add_argument(
+        "--persist-dir", help="also write spreadsheets held in memory to this directory"
+    )
+    return parser
+
+
+def main(argv: Optional[list[str]] = None) -> list:
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = make_argument_parser()
+    if len(argv) == 0 or (argv[0] not in COMMANDS and argv[0] not in ["-h", "--help"]):
+        argv = ["all"] + argv
+    arguments = parser.parse_args(argv)
+
+    fake_ckan_server = None
+    if arguments.local_hdx:
+        fake_ckan_server = FakeCKANServer()
+        fake_ckan_server.start()
+        fake_ckan_server.configure_hdx()
+    fake_api_server = None
+    if arguments.local_api:
+        fake_api_server = FakeInsecurityInsightAPI()
+        os.environ[API_BASE_URL_VARIABLE] = fake_api_server.start()
+    reset_metrics()
+    reset_uploads()
+    configure_memory_tracking(
+        trace=arguments.tracemalloc,
+        budget_bytes=(
+            int(arguments.memory_budget_mb * 1e6) if arguments.memory_budget_mb else None
+        ),
+        budget_action=arguments.memory_budget_action,
+    )
+    print_banner_to_log(LOGGER, f"Run {arguments.command}")
+    # A staged run is started by fetch, later stages use its checkpoints
+    resume = arguments.command != "fetch" and getattr(arguments, "resume", True)
+    start_run_state(arguments.state_dir, resume=resume)
+
+    try:
+        with profile_run(
+            f"run-{arguments.command}",
+            profiler=arguments.profile,
+            output_directory=arguments.report_dir,
+        ):
+            result = COMMANDS[arguments.command](arguments)
+    finally:
+        if fake_ckan_server is not None:
+            LOGGER.info(f"Local HDX calls: {dict(fake_ckan_server.call_counts)}")
+            fake_ckan_server.stop()
+        if fake_api_server is not None:
+            LOGGER.info(f"Local API calls: {dict(fake_api_server.call_counts)}")
+            fake_api_server.stop()
+        # Per stage timings, record and byte counts for comparison between runs
+        metrics_report = make_metrics_report()
+        write_metrics_report(
+            metrics_report,
+            output_directory=arguments.report_dir,
+            name=f"metrics-{arguments.command}",
+        )
+        log_metrics_summary(metrics_report)
+
+    return result
+
+
+def run_fetch_command(arguments: argparse.Namespace) -> list:
+    api_cache = fetch_and_cache_api_responses(
+        use_sample=arguments.sample, refresh=arguments.topics, state_directory=arguments.state_dir
+    )
+    return list(api_cache.keys())
+
+
+def run_check_command(arguments: argparse.Namespace) -> list:
+    api_cache = fetch_and_cache_api_responses(
+        use_sample=arguments.sample, refresh=arguments.topics, state_directory=arguments.state_dir
+    )
+    _, changed_list = check_api_has_not_changed(api_cache, refresh=arguments.topics)
+    return changed_list
+
+
+def run_plan_command(arguments: argparse.Namespace) -> list:
+    # A new plan replaces any made earlier in the staged run
+    clear_checkpoint(arguments.state_dir, "items-to-update")
+    items_to_update = plan_updates(arguments, read_api_cache(arguments))
+    log_items_to_update(items_to_update)
+    return items_to_update
+
+
+def run_diff_command(arguments: argparse.Namespace) -> dict:
+    api_cache = read_api_cache(arguments)
+    dataset_cache = fetch_and_cache_datasets(
+        use_legacy=arguments.use_legacy,
+        hdx_site=arguments.hdx_site,
+        refresh=arguments.topics,
+        countries=arguments.countries,
+        use_inventory=arguments.use_inventory,
+    )
+    # The plan counts changes to the datasets the run would update, as decided here. The decision
+    # is saved to the run state so the run which follows makes the same one
+    items_to_update = decide_which_resources_have_fresh_data(
+        dataset_cache,
+        api_cache,
+        refresh=arguments.refresh,
+        topic_list=arguments.topics,
+        state_directory=arguments.state_dir,
+    )
+    plan = make_change_plan(
+        api_cache,
+        dataset_cache,
+        topics=arguments.topics,
+        countries=arguments.countries,
+        content_hashes=load_content_hashes(arguments.hashes_dir),
+        items_to_update=items_to_update,
+    )
+    log_change_plan(plan)
+    write_change_plan(plan, arguments.report_dir)
+    if arguments.detailed_exitcode and plan["has_changes"]:
+        raise SystemExit(2)
+    return plan
+
+
+def run_spreadsheets_command(arguments: argparse.Namespace) -> list:
+    api_cache = read_api_cache(arguments)
+    items_to_update = plan_updates(arguments, api_cache)
+    if arguments.parallel and len(items_to_update) != 0:
+        run_update_stage("spreadsheets", arguments, items_to_update, api_cache, {})
+    else:
+        refresh_spreadsheets_with_fresh_data(
+            items_to_update,
+            api_cache,
+            state_directory=arguments.state_dir,
+            countries=arguments.countries,
         )
-        if n_missing_resources != 0:
-            missing_report.append([dataset["name"], n_missing_resources])
+    return items_to_update
+
 
+def run_upload_command(arguments: argparse.Namespace) -> list:
+    api_cache = read_api_cache(arguments)
+    items_to_update = plan_updates(arguments, api_cache)
+    if len(items_to_update) == 0:
+        LOGGER.info("No datasets need to be updated")
+        return []
+    dataset_cache = fetch_and_cache_datasets(
+        use_legacy=arguments.use_legacy,
+        hdx_site=arguments.hdx_site,
+        countries=arguments.countries,
+        use_inventory=arguments.use_inventory,
+    )
+    if arguments.parallel:
+        missing_report = run_update_stage(
+            "upload", arguments, items_to_update, api_cache, dataset_cache
+        )
+    else:
+        missing_report = update_datasets_whose_resources_have_changed(
+            items_to_update,
+            api_cache,
+            dataset_cache,
+            dry_run=arguments.dry_run,
+            use_legacy=arguments.use_legacy,
+            hdx_site=arguments.hdx_site,
+            state_directory=arguments.state_dir,
+            countries=arguments.countries,
+            hashes_directory=arguments.hashes_dir,
+            max_workers=arguments.max_workers,
+        )
+    discard_updated_inventory(arguments)
+    log_missing_report(missing_report)
     return missing_report
 
 
-if __name__ == "__main__":
-    USE_SAMPLE = False
-    DRY_RUN = False
-    REFRESH = ["foodsecurity"]  # ["all"]
-    COUNTRIES = None  # ["PSE"]
-    USE_LEGACY = True
-    HDX_SITE = "prod"
-    T0 = time.time()
-    print_banner_to_log(LOGGER, "Grand Run")
-    API_CACHE = fetch_and_cache_api_responses(use_sample=USE_SAMPLE)
-    DATASET_CACHE = fetch_and_cache_datasets(use_legacy=USE_LEGACY, hdx_site=HDX_SITE)
-    HAS_CHANGED, CHANGED_LIST = check_api_has_not_changed(API_CACHE)
-    # Using refresh here allows a forced refresh for particular datasets
-    ITEMS_TO_UPDATE = decide_which_resources_have_fresh_data(
-        DATASET_CACHE, API_CACHE, refresh=REFRESH
-    )
-    refresh_spreadsheets_with_fresh_data(ITEMS_TO_UPDATE, API_CACHE)
-    MISSING_REPORT = update_datasets_whose_resources_have_changed(
-        ITEMS_TO_UPDATE,
-        API_CACHE,
-        DATASET_CACHE,
-        dry_run=DRY_RUN,
-        use_legacy=USE_LEGACY,
-        hdx_site=HDX_SITE,
-    )
-
-    LOGGER.info(f"{len(ITEMS_TO_UPDATE)} items updated in API:")
-    for ITEM in ITEMS_TO_UPDATE:
-        LOGGER.info(f"{ITEM[0]:<20.20}:{ITEM[2]}")
+def run_all_command(arguments: argparse.Namespace) -> list:
+    spreadsheet_buffers = None
+    if arguments.in_memory:
+        spreadsheet_buffers = SpreadsheetBuffers(persist_directory=arguments.persist_dir)
+    try:
+        if arguments.parallel:
+            items_to_update, missing_report = run_pipeline(
+                use_sample=arguments.sample,
+                dry_run=arguments.dry_run,
+                refresh=arguments.refresh,
+                use_legacy=arguments.use_legacy,
+                hdx_site=arguments.hdx_site,
+                spreadsheet_buffers=spreadsheet_buffers,
+                max_workers=arguments.max_workers,
+                state_directory=arguments.state_dir,
+                topics=arguments.topics,
+                countries=arguments.countries,
+                hashes_directory=arguments.hashes_dir,
+                use_inventory=arguments.use_inventory,
+            )
+        else:
+            api_cache = fetch_and_cache_api_responses(
+                use_sample=arguments.sample, state_directory=arguments.state_dir
+            )
+            # The API check compares full records so it must run before the cache is projected
+            check_api_has_not_changed(api_cache)
+            api_cache = project_api_cache(api_cache)
+            dataset_cache = fetch_and_cache_datasets(
+                use_legacy=arguments.use_legacy,
+                hdx_site=arguments.hdx_site,
+                countries=arguments.countries,
+                use_inventory=arguments.use_inventory,
+            )
+            # Using refresh here allows a forced refresh for particular datasets
+            items_to_update = decide_which_resources_have_fresh_data(
+                dataset_cache,
+                api_cache,
+                refresh=arguments.refresh,
+                topic_list=arguments.topics,
+                state_directory=arguments.state_dir,
+            )
+            refresh_spreadsheets_with_fresh_data(
+                items_to_update,
+                api_cache,
+                spreadsheet_buffers=spreadsheet_buffers,
+                state_directory=arguments.state_dir,
+                countries=arguments.countries,
+            )
+            missing_report = update_datasets_whose_resources_have_changed(
+                items_to_update,
+                api_cache,
+                dataset_cache,
+                dry_run=arguments.dry_run,
+                use_legacy=arguments.use_legacy,
+                hdx_site=arguments.hdx_site,
+                spreadsheet_buffers=spreadsheet_buffers,
+                state_directory=arguments.state_dir,
+                countries=arguments.countries,
+                hashes_directory=arguments.hashes_dir,
+                max_workers=arguments.max_workers,
+            )
+    finally:
+        if spreadsheet_buffers is not None:
+            spreadsheet_buffers.close()
+    # The run completed so there is nothing to resume
+    clear_run_state(arguments.state_dir)
+    if len(items_to_update) != 0:
+        discard_updated_inventory(arguments)
+
+    log_items_to_update(items_to_update)
+    log_missing_report(missing_report)
+    return missing_report
+
+
+def discard_updated_inventory(arguments: argparse.Namespace):
+    if arguments.use_inventory and not arguments.dry_run:
+        clear_organization_inventory(hdx_site=arguments.hdx_site)
+
+
+def read_api_cache(arguments: argparse.Namespace) -> dict:
+    # Responses saved by an earlier fetch stage are read from the state directory. Country
+    # spreadsheets for topics not fetched are not regenerated.
+    api_cache = fetch_and_cache_api_responses(
+        use_sample=arguments.sample, refresh=arguments.topics, state_directory=arguments.state_dir
+    )
+    return project_api_cache(api_cache)
+
+
+def plan_updates(arguments: argparse.Namespace, api_cache: dict) -> list:
+    items_to_update = load_checkpoint(arguments.state_dir, "items-to-update")
+    if items_to_update is not None:
+        LOGGER.info(f"Using planned updates from {arguments.state_dir}")
+        return [tuple(x) for x in items_to_update]
+    # Only the topic datasets are needed to decide what to update
+    dataset_cache = fetch_and_cache_datasets(
+        use_legacy=arguments.use_legacy,
+        hdx_site=arguments.hdx_site,
+        countries=[],
+        use_inventory=arguments.use_inventory,
+    )
+    return decide_which_resources_have_fresh_data(
+        dataset_cache,
+        api_cache,
+        refresh=arguments.refresh,
+        topic_list=arguments.topics,
+        state_directory=arguments.state_dir,
+    )
+
+
+def run_update_stage(
+    stage: str,
+    arguments: argparse.Namespace,
+    items_to_update: list,
+    api_cache: dict,
+    dataset_cache: dict,
+) -> list:
+    # The spreadsheet or upload tasks from the task graph used by run_pipeline, without the
+    # dependencies between them since the other stage is run separately
+    tasks = make_update_tasks(
+        items_to_update,
+        api_cache,
+        dataset_cache,
+        dry_run=arguments.dry_run,
+        use_legacy=arguments.use_legacy,
+        hdx_site=arguments.hdx_site,
+        state_directory=arguments.state_dir,
+        countries=arguments.countries,
+        hashes_directory=arguments.hashes_dir,
+    )
+    tasks = [x for x in tasks if x.name.startswith(f"{stage}:")]
+    for task in tasks:
+        task.dependencies = []
+    results, timings = run_task_graph(tasks, max_workers=arguments.max_workers)
+    log_task_graph_report(tasks, timings)
+    missing_report = []
+    if stage == "upload":
+        for task in tasks:
+            missing_report.extend(results[task.name] or [])
+        missing_report = check_uploads(missing_report, [x.name for x in tasks])
+    return missing_report
+
+
+def log_items_to_update(items_to_update: list):
+    LOGGER.info(f"{len(items_to_update)} items updated in API:")
+    for item in items_to_update:
+        LOGGER.info(f"{item[0]:<20.20}:{item[2]}")
+
+
+def check_uploads(missing_report: list, upload_keys: list[str]) -> list:
+    # Failed and retried uploads are added to the report. If any upload failed the report is
+    # logged and the run fails, after the other uploads have finished, so that the run state is
+    # kept for --resume
+    uploads = {x: y for x, y in list_uploads().items() if x in upload_keys}
+    missing_report = missing_report + make_upload_report_rows(uploads)
+    failed = [x for x, y in uploads.items() if y["status"] == "failed"]
+    if len(failed) != 0:
+        log_missing_report(missing_report)
+        raise UploadFailed(f"{len(failed)} of {len(uploads)} uploads failed: {failed}")
+    return missing_report
+
+
+def log_missing_report(missing_report: list):
     LOGGER.info("")
     LOGGER.info("Datasets with missing resources:")
-    for MISSING in MISSING_REPORT:
-        LOGGER.info(f"{MISSING[0]:<80.80}: {MISSING[1]}")
+    for missing in missing_report:
+        LOGGER.info(f"{missing[0]:<80.80}: {missing[1]}")
+    upload_summary = summarise_uploads()
+    if upload_summary["n_uploads"] != 0:
+        LOGGER.info(
+            f"Uploads: {upload_summary['n_uploaded']} of {upload_summary['n_uploads']} "
+            f"succeeded, {upload_summary['n_failed']} failed, "
+            f"{upload_summary['n_retried']} retried, {upload_summary['n_attempts']} attempts"
+        )
+        if "mean_seconds" in upload_summary:
+            LOGGER.info(
+                f"Upload latency: mean {upload_summary['mean_seconds']:0.2f}, "
+                f"p95 {upload_summary['p95_seconds']:0.2f}, "
+                f"max {upload_summary['max_seconds']:0.2f} seconds, "
+                f"total {upload_summary['total_seconds']:0.2f} seconds"
+            )
+
 
-    LOGGER.info(f"Total run time: {time.time()-T0:0.0f} seconds")
+COMMANDS = {
+    "fetch": run_fetch_command,
+    "check": run_check_command,
+    "plan": run_plan_command,
+    "diff": run_diff_command,
+    "spreadsheets": run_spreadsheets_command,
+    "upload": run_upload_command,
+    "all": run_all_command,
+}
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Streaming schema profiles of API responses, used to detect drift in the API beyond a change of
+keys: a field changing type, gaining nulls, appearing only in later records or changing
+cardinality.
+
+A profile is built as a response is parsed, by passing make_profiling_hook to json.loads as the
+object_hook, so profiling adds no extra pass over the records. The API records are flat so every
+object the parser sees is a record. The summary of a profile holds, per field, the count of each
+type seen, the rate of nulls, the rate of records with the field and the number of distinct
+values, counted up to CARDINALITY_LIMIT.
+
+Profiles of the responses fetched in a run are recorded in memory, as the metrics spans are, and
+compared to the profiles of the API samples stored in metadata/api-fingerprints.json with
+compare_schema_profiles. Drift beyond the tolerances is logged as a warning, or fails the run with
+SchemaDriftDetected if INSECURITY_INSIGHT_SCHEMA_DRIFT_ACTION is "fail".
+
+schema_profile = start_schema_profile()
+api_response = json.loads(response_text, object_hook=make_profiling_hook(schema_profile))
+drift = compare_schema_profiles(summarise_schema_profile(schema_profile), stored_profile)
+"""
+
+import logging
+import os
+import threading
+
+from typing import Callable, Optional
+
+LOGGER = logging.getLogger(__name__)
+
+SCHEMA_DRIFT_ACTION_VARIABLE = "INSECURITY_INSIGHT_SCHEMA_DRIFT_ACTION"
+CARDINALITY_LIMIT = 10000
+# Absolute differences in a rate allowed between a response and the stored profile
+DEFAULT_TOLERANCES = {"null_rate": 0.05, "presence_rate": 0.0, "distinct_rate": 0.5}
+
+PROFILES_LOCK = threading.Lock()
+PROFILES: dict[str, dict] = {}
+
+
+class SchemaDriftDetected(RuntimeError):
+    pass
+
+
+def start_schema_profile() -> dict:
+    return {"n_records": 0, "fields": {}}
+
+
+def update_schema_profile(schema_profile: dict, record: dict):
+    schema_profile["n_records"] += 1
+    fields = schema_profile["fields"]
+    for key, value in record.items():
+        field = fields.get(key)
+        if field is None:
+            field = {
+                "first_record": schema_profile["n_records"] - 1,
+                "n_present": 0,
+                "n_null": 0,
+                "types": {},
+                "values": set(),
+            }
+            fields[key] = field
+        field["n_present"] += 1
+        if value is None:
+            field["n_null"] += 1
+            continue
+        type_name = type(value).__name__
+        field["types"][type_name] = field["types"].get(type_name, 0) + 1
+        if len(field["values"]) < CARDINALITY_LIMIT:
+            # Lists and dictionaries are counted by their text
+            field["values"].add(value if isinstance(value, (str, int, float, bool)) else str(value))
+
+
+def make_profiling_hook(schema_profile: dict) -> Callable[[dict], dict]:
+    def profile_record(record: dict) -> dict:
+        update_schema_profile(schema_profile, record)
+        return record
+
+    return profile_record
+
+
+def summarise_schema_profile(schema_profile: dict) -> dict:
+    n_records = schema_profile["n_records"]
+    fields = {}
+    for key, field in schema_profile["fields"].items():
+        n_non_null = field["n_present"] - field["n_null"]
+        cardinality = len(field["values"])
+        fields[key] = {
+            "types": dict(sorted(field["types"].items())),
+            "first_record": field["first_record"],
+            "presence_rate": round(field["n_present"] / n_records, 4),
+            "null_rate": round(field["n_null"] / field["n_present"], 4),
+            "cardinality": cardinality,
+            "cardinality_capped": cardinality >= CARDINALITY_LIMIT,
+            "distinct_rate": round(cardinality / n_non_null, 4) if n_non_null != 0 else 0.0,
+        }
+    return {"n_records": n_records, "fields": fields}
+
+
+def compare_schema_profiles(
+    schema_profile: dict, stored_profile: dict, tolerances: Optional[dict] = None
+) -> list[str]:
+    """Lists the differences between a summarised profile and a stored one which are beyond the
+    tolerances, an empty list means no drift.
+    """
+    tolerances = {**DEFAULT_TOLERANCES, **(tolerances or {})}
+    fields = schema_profile["fields"]
+    stored_fields = stored_profile["fields"]
+    drift = []
+    for key in stored_fields:
+        if key not in fields and schema_profile["n_records"] != 0:
+            drift.append(f"{key} is missing")
+    for key, field in fields.items():
+        stored_field = stored_fields.get(key)
+        if stored_field is None:
+            drift.append(f"{key} is new, first seen in record {field['first_record']}")
+            continue
+        new_types = sorted(set(field["types"]) - set(stored_field["types"]))
+        if len(new_types) != 0:
+            drift.append(f"{key} has new types {new_types}, expected {list(stored_field['types'])}")
+        if field["presence_rate"] < stored_field["presence_rate"] - tolerances["presence_rate"]:
+            drift.append(
+                f"{key} is in {field['presence_rate']:.1%} of records, "
+                f"expected {stored_field['presence_rate']:.1%}, "
+                f"first seen in record {field['first_record']}"
+            )
+        if field["null_rate"] > stored_field["null_rate"] + tolerances["null_rate"]:
+            drift.append(
+                f"{key} null rate is {field['null_rate']:.1%}, "
+                f"expected {stored_field['null_rate']:.1%}"
+            )
+        # A capped count is a lower bound so the rates are not comparable
+        if field["cardinality_capped"] or stored_field["cardinality_capped"]:
+            continue
+        if (
+            abs(field["distinct_rate"] - stored_field["distinct_rate"])
+            > tolerances["distinct_rate"]
+        ):
+            drift.append(
+                f"{key} has {field['cardinality']} distinct values "
+                f"({field['distinct_rate']:.1%} of values), "
+                f"expected {stored_field['distinct_rate']:.1%}"
+            )
+    return drift
+
+
+def record_schema_profile(dataset_name: str, schema_profile: dict):
+    with PROFILES_LOCK:
+        PROFILES[dataset_name] = schema_profile
+
+
+def get_schema_profile(dataset_name: str) -> Optional[dict]:
+    with PROFILES_LOCK:
+        return PROFILES.get(dataset_name)
+
+
+def reset_schema_profiles():
+    with PROFILES_LOCK:
+        PROFILES.clear()
+
+
+def handle_schema_drift(drift_report: dict[str, list[str]]):
+    n_drifted = sum(1 for x in drift_report.values() if len(x) != 0)
+    if n_drifted == 0:
+        return
+    for dataset_name, drift in drift_report.items():
+        for difference in drift:
+            LOGGER.warning(f"Schema drift in {dataset_name}: {difference}")
+    message = f"Schema drift detected in {n_drifted} API responses"
+    if os.environ.get(SCHEMA_DRIFT_ACTION_VARIABLE, "warn").strip().lower() == "fail":
+        raise SchemaDriftDetected(message)
+    LOGGER.warning(message)
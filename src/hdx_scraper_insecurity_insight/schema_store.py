@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+An indexed store for the schema CSV files, metadata/schema.csv and metadata/schema-overview.csv.
+
+Each file is read once into an in-memory index of its rows by dataset_name, which is reused until
+the file changes on disk, so checking whether a dataset has a schema is a dictionary lookup rather
+than a scan of the CSV. Updates are upserts of whole datasets: the file is rewritten to a
+temporary file in the same directory and renamed into place, as the checkpoints are, so an
+interrupted or failed write never leaves a partial or interleaved schema file. Any number of
+datasets can be upserted in one rewrite.
+
+Writes within a process are serialised by a lock. Writers in other processes should go through
+one process, as marshall_datasets does.
+
+statuses = upsert_schemas(schema_filepath, {"insecurity-insight-crsv-incidents": rows})
+"""
+
+import csv
+import logging
+import os
+import tempfile
+import threading
+
+from typing import Any, Optional
+
+LOGGER = logging.getLogger(__name__)
+
+STORE_LOCK = threading.RLock()
+INDEXES: dict[str, dict] = {}
+
+
+def read_schema_index(schema_filepath: str) -> dict:
+    """Returns the index of a schema file, {"fieldnames": [...], "datasets": {dataset_name:
+    [rows]}}, with datasets in file order. The index must not be modified by callers.
+    """
+    with STORE_LOCK:
+        if not os.path.exists(schema_filepath):
+            INDEXES.pop(schema_filepath, None)
+            return {"fieldnames": [], "datasets": {}}
+        file_stat = os.stat(schema_filepath)
+        file_key = (file_stat.st_mtime_ns, file_stat.st_size)
+        index = INDEXES.get(schema_filepath)
+        if index is None or index["file_key"] != file_key:
+            index = {"file_key": file_key, **read_schema_file(schema_filepath)}
+            INDEXES[schema_filepath] = index
+        return index
+
+
+def read_schema_file(schema_filepath: str) -> dict:
+    datasets = {}
+    with open(schema_filepath, "r", encoding="UTF-8", newline="") as schema_filehandle:
+        schema_rows = csv.DictReader(schema_filehandle)
+        for row in schema_rows:
+            datasets.setdefault(row["dataset_name"], []).append(row)
+        fieldnames = list(schema_rows.fieldnames or [])
+    return {"fieldnames": fieldnames, "datasets": datasets}
+
+
+def read_schema_rows(schema_filepath: str, dataset_name: str) -> list[dict]:
+    return read_schema_index(schema_filepath)["datasets"].get(dataset_name, [])
+
+
+def has_schema(schema_filepath: str, dataset_name: str) -> bool:
+    return dataset_name in read_schema_index(schema_filepath)["datasets"]
+
+
+def upsert_schemas(
+    schema_filepath: str, schemas: dict[str, list[dict]], replace: bool = True
+) -> dict[str, str]:
+    """Adds or, if replace is True, replaces the rows of each dataset in schemas with one rewrite
+    of the schema file. Existing datasets keep their place in the file and new datasets are added
+    at the end. Returns "added", "replaced" or "unchanged" for each dataset.
+    """
+    with STORE_LOCK:
+        index = read_schema_index(schema_filepath)
+        datasets = dict(index["datasets"])
+        fieldnames = list(index["fieldnames"])
+        statuses = {}
+        for dataset_name, output_rows in schemas.items():
+            if len(output_rows) == 0 or (dataset_name in datasets and not replace):
+                statuses[dataset_name] = "unchanged"
+                continue
+            statuses[dataset_name] = "replaced" if dataset_name in datasets else "added"
+            if len(fieldnames) == 0:
+                fieldnames = list(output_rows[0].keys())
+            datasets[dataset_name] = [
+                {x: "" if row.get(x) is None else str(row.get(x)) for x in fieldnames}
+                for row in output_rows
+            ]
+
+        if any(x != "unchanged" for x in statuses.values()):
+            rows = [row for dataset_rows in datasets.values() for row in dataset_rows]
+            write_csv_atomically(schema_filepath, fieldnames, rows)
+            LOGGER.info(f"Wrote {len(rows)} rows for {len(datasets)} datasets to {schema_filepath}")
+    return statuses
+
+
+def write_csv_atomically(
+    output_filepath: str,
+    fieldnames: list[str],
+    output_rows: list[dict[str, Any]],
+    existing_filepath: Optional[str] = None,
+):
+    # Rows are written after the content of existing_filepath, if given, which must have the same
+    # columns. The header is only written for a new file
+    output_directory = os.path.dirname(os.path.abspath(output_filepath))
+    with tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", dir=output_directory, suffix=".tmp", delete=False, newline=""
+    ) as temp_file:
+        try:
+            dict_writer = csv.DictWriter(temp_file, fieldnames, lineterminator="\n")
+            if existing_filepath is not None:
+                with open(existing_filepath, "r", encoding="utf-8", newline="") as existing_file:
+                    existing_content = existing_file.read()
+                temp_file.write(existing_content)
+                if len(existing_content) != 0 and not existing_content.endswith("\n"):
+                    temp_file.write("\n")
+            else:
+                dict_writer.writeheader()
+            dict_writer.writerows(output_rows)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        except BaseException:
+            temp_file.close()
+            os.remove(temp_file.name)
+            raise
+    os.replace(temp_file.name, output_filepath)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+This code holds generated spreadsheets in memory so they can be uploaded to HDX without being
+written to, and rediscovered in, output-spreadsheets
+
+hdx-python-api only accepts a filepath for uploads and names the upload after it, so each
+spreadsheet is written under its own filename to a temporary directory on the in-memory tmpfs at
+/dev/shm. Elsewhere, or once memory_limit bytes are held in memory, spreadsheets are spilled to a
+temporary directory on disk.
+
+Spreadsheets may be added from several threads at once, as in run.py --in-memory --parallel, so
+the buffers are guarded by a lock.
+"""
+
+import logging
+import os
+import tempfile
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_MEMORY_LIMIT = 512 * 1024 * 1024
+MEMORY_FILESYSTEM = "/dev/shm"
+
+
+class SpreadsheetBuffers:
+    def __init__(
+        self,
+        persist_directory: str = None,
+        memory_limit: int = DEFAULT_MEMORY_LIMIT,
+        spill_directory: str = None,
+    ):
+        self.persist_directory = persist_directory
+        self.memory_limit = memory_limit
+        self.spill_directory = spill_directory
+        self.memory_bytes = 0
+        self._filepaths = {}
+        self._in_memory = set()
+        self._sizes = {}
+        self._memory_directory = None
+        self._spill_directory = None
+        self._lock = threading.RLock()
+        self._warned_no_memory_filesystem = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, filename: str, content: bytes) -> str:
+        with self._lock:
+            self.remove(filename)
+            has_memory_filesystem = os.path.isdir(MEMORY_FILESYSTEM)
+            if has_memory_filesystem and self.memory_bytes + len(content) <= self.memory_limit:
+                if self._memory_directory is None:
+                    self._memory_directory = tempfile.mkdtemp(dir=MEMORY_FILESYSTEM)
+                filepath = os.path.join(self._memory_directory, filename)
+                self._in_memory.add(filename)
+                self.memory_bytes += len(content)
+            else:
+                if not has_memory_filesystem:
+                    if not self._warned_no_memory_filesystem:
+                        LOGGER.info(
+                            f"No in-memory filesystem at {MEMORY_FILESYSTEM}, "
+                            "spreadsheets are held in temporary files"
+                        )
+                        self._warned_no_memory_filesystem = True
+                else:
+                    LOGGER.info(f"Memory limit reached, spilling `{filename}` to a temporary file")
+                if self._spill_directory is None:
+                    self._spill_directory = tempfile.mkdtemp(dir=self.spill_directory)
+                filepath = os.path.join(self._spill_directory, filename)
+            with open(filepath, "wb") as buffer_file:
+                buffer_file.write(content)
+            self._filepaths[filename] = filepath
+            self._sizes[filename] = len(content)
+
+        if self.persist_directory is not None:
+            with open(os.path.join(self.persist_directory, filename), "wb") as persist_file:
+                persist_file.write(content)
+
+        return filepath
+
+    def filenames(self) -> list[str]:
+        with self._lock:
+            return list(self._filepaths.keys())
+
+    def get_filepath(self, filename: str) -> str:
+        with self._lock:
+            return self._filepaths[filename]
+
+    def read(self, filename: str) -> bytes:
+        with open(self.get_filepath(filename), "rb") as buffer_file:
+            return buffer_file.read()
+
+    def remove(self, filename: str):
+        with self._lock:
+            if filename not in self._filepaths:
+                return
+            if filename in self._in_memory:
+                self._in_memory.remove(filename)
+                self.memory_bytes -= self._sizes[filename]
+            os.remove(self._filepaths[filename])
+            del self._filepaths[filename]
+            del self._sizes[filename]
+
+    def close(self):
+        with self._lock:
+            for filename in self.filenames():
+                self.remove(filename)
+            for directory in [self._memory_directory, self._spill_directory]:
+                if directory is not None:
+                    os.rmdir(directory)
+            self._memory_directory = None
+            self._spill_directory = None
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Generates synthetic API responses which follow the schema for each endpoint in schema.csv and
+schema-overview.csv. These are used by the benchmarks to test the pipeline at multiples of the
+current record counts, and across many more countries than the samples contain.
+
+Values are chosen using the HXL terms in the schema: dates, countries, coordinates and counts
+get values of the right shape and other fields are drawn from a small vocabulary. Numbers are
+returned as strings, as the API does.
+"""
+
+import json
+import os
+import random
+
+from typing import Optional
+
+from hdx.location.country import Country
+
+from hdx_scraper_insecurity_insight.utilities import read_attributes, read_schema
+
+DEFAULT_RECORD_COUNT = 1000
+GEO_PRECISIONS = ["(1) exact location", "(2) 25 km precision ", "(6) Country"]
+VOCABULARY_SIZE = 20
+WORDS = (
+    "attack reported village district clinic school convoy staff vehicle armed group "
+    "security forces civilians looted damaged threatened detained injured killed"
+).split()
+
+
+def generate_api_response(
+    dataset_name: str,
+    n_records: int,
+    countries: Optional[list[str]] = None,
+    start_year: int = 2020,
+    end_year: int = 2025,
+    seed: int = 0,
+) -> list[dict]:
+    """Returns n_records synthetic API rows for dataset_name. Countries are ISO3 codes and
+    default to all countries known to hdx-python-country.
+    """
+    hxl_terms, row_template = read_schema(dataset_name.replace("-current-year", ""))
+    if len(row_template) == 0:
+        raise ValueError(f"No schema found for {dataset_name}")
+    terms_by_upstream = {row_template[x]: hxl_terms[x] for x in row_template}
+
+    country_names = read_country_names(countries)
+    country_isos = list(country_names.keys())
+    rng = random.Random(seed)
+
+    api_response = []
+    for _ in range(n_records):
+        country_iso = rng.choice(country_isos)
+        year = rng.randint(start_year, end_year)
+        api_row = {}
+        for upstream_field, hxl_term in terms_by_upstream.items():
+            api_row[upstream_field] = generate_value(
+                upstream_field, hxl_term, rng, year, country_iso, country_names[country_iso]
+            )
+        api_response.append(api_row)
+
+    return api_response
+
+
+def generate_value(
+    upstream_field: str, hxl_term: str, rng: random.Random, year: int, iso: str, name: str
+) -> str:
+    if upstream_field in ["Country ISO", "country_iso"]:
+        value = iso
+    elif upstream_field in ["Country", "country"]:
+        value = name
+    elif upstream_field == "Year":
+        value = str(year)
+    elif "#date" in hxl_term:
+        value = f"{year}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+    elif upstream_field == "Latitude":
+        value = f"{rng.uniform(-60.0, 70.0):0.10f}"
+    elif upstream_field == "Longitude":
+        value = f"{rng.uniform(-180.0, 180.0):0.10f}"
+    elif upstream_field == "Geo Precision":
+        value = rng.choice(GEO_PRECISIONS)
+    elif "+id" in hxl_term:
+        value = str(rng.randint(1, 999999))
+    elif any(x in hxl_term for x in ["#affected", "+num", "+count"]):
+        value = str(int(min(rng.expovariate(1.0), 50.0)))
+    elif upstream_field == "Event Description":
+        value = " ".join(rng.choices(WORDS, k=rng.randint(8, 30)))
+    else:
+        value = f"{upstream_field} {rng.randint(1, VOCABULARY_SIZE)}"
+
+    return value
+
+
+def generate_scaled_api_response(
+    dataset_name: str, scale: int, countries: Optional[list[str]] = None, seed: int = 0
+) -> list[dict]:
+    n_records = scale * count_sample_records(dataset_name)
+    return generate_api_response(dataset_name, n_records, countries=countries, seed=seed)
+
+
+def count_sample_records(dataset_name: str) -> int:
+    # Not all endpoints have a sample, these are counted as DEFAULT_RECORD_COUNT records
+    attributes = read_attributes(dataset_name)
+    sample_filepath = os.path.join(
+        os.path.dirname(__file__), "api-samples", attributes.get("api_response_filename", "")
+    )
+    if not os.path.isfile(sample_filepath):
+        return DEFAULT_RECORD_COUNT
+    with open(sample_filepath, "r", encoding="UTF-8") as sample_file:
+        return len(json.load(sample_file))
+
+
+def read_country_names(countries: Optional[list[str]] = None) -> dict[str, str]:
+    if countries is None:
+        countries = list(Country.countriesdata(use_live=False)["countries"].keys())
+    return {x: Country.get_country_name_from_iso3(x, use_live=False) or x for x in countries}
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+A queue for dataset uploads to HDX, run on a bounded thread pool so that a slow or failing upload
+does not hold up the others and the time for all uploads is set by the bandwidth to HDX rather
+than the latency of each request.
+
+Each upload is retried with exponential backoff, up to INSECURITY_INSIGHT_UPLOAD_MAX_ATTEMPTS
+attempts. Upload functions must be safe to repeat: create_datasets_in_hdx compares with the
+dataset in HDX and leaves the dataset in the dataset cache unchanged if an upload fails, so a
+retry sends the same changes. An upload which fails on every attempt is recorded as failed and
+the queue carries on with the others.
+
+The status, attempts and latency of each upload are recorded in memory, as the metrics spans are,
+and summarised with summarise_uploads.
+
+with UploadQueue(max_workers=4) as upload_queue:
+    upload_queue.submit("insecurity-insight-pse-dataset", update_country_dataset, "PSE", ...)
+results = upload_queue.results
+"""
+
+import logging
+import os
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Optional
+
+LOGGER = logging.getLogger(__name__)
+
+UPLOAD_MAX_WORKERS = 4
+UPLOAD_MAX_ATTEMPTS_VARIABLE = "INSECURITY_INSIGHT_UPLOAD_MAX_ATTEMPTS"
+UPLOAD_MAX_ATTEMPTS = int(os.environ.get(UPLOAD_MAX_ATTEMPTS_VARIABLE) or 3)
+# Seconds before the first retry, doubled for each further retry
+UPLOAD_BACKOFF_SECONDS = 5.0
+
+UPLOADS_LOCK = threading.Lock()
+UPLOADS: dict[str, dict] = {}
+
+
+class UploadFailed(RuntimeError):
+    pass
+
+
+def record_upload(upload_key: str, **fields):
+    with UPLOADS_LOCK:
+        UPLOADS.setdefault(upload_key, {"status": "queued", "attempts": 0})
+        UPLOADS[upload_key].update(fields)
+
+
+def get_upload(upload_key: str) -> Optional[dict]:
+    with UPLOADS_LOCK:
+        upload = UPLOADS.get(upload_key)
+        return dict(upload) if upload is not None else None
+
+
+def list_uploads() -> dict[str, dict]:
+    with UPLOADS_LOCK:
+        return {x: dict(y) for x, y in UPLOADS.items()}
+
+
+def reset_uploads():
+    with UPLOADS_LOCK:
+        UPLOADS.clear()
+
+
+def run_upload(
+    upload_key: str,
+    function: Callable,
+    *args,
+    max_attempts: Optional[int] = None,
+    backoff_seconds: float = UPLOAD_BACKOFF_SECONDS,
+    **kwargs,
+) -> Any:
+    """Calls function, retrying with exponential backoff if it raises. Returns the result of
+    function, or None if every attempt failed.
+    """
+    if max_attempts is None:
+        max_attempts = UPLOAD_MAX_ATTEMPTS
+    t0 = time.perf_counter()
+    for attempt in range(1, max_attempts + 1):
+        record_upload(upload_key, status="running", attempts=attempt)
+        attempt_t0 = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except Exception as exception:  # pylint: disable=broad-exception-caught
+            error = f"{type(exception).__name__}: {exception}"
+            if attempt == max_attempts:
+                LOGGER.error(f"Upload of {upload_key} failed after {attempt} attempts: {error}")
+                record_upload(
+                    upload_key,
+                    status="failed",
+                    error=error,
+                    seconds=round(time.perf_counter() - t0, 3),
+                )
+                return None
+            backoff = backoff_seconds * 2 ** (attempt - 1)
+            LOGGER.warning(
+                f"Upload of {upload_key} failed on attempt {attempt} of {max_attempts}, "
+                f"retrying in {backoff:0.1f} seconds: {error}"
+            )
+            record_upload(upload_key, status="retrying", error=error)
+            time.sleep(backoff)
+            continue
+        record_upload(
+            upload_key,
+            status="uploaded",
+            error=None,
+            seconds=round(time.perf_counter() - t0, 3),
+            attempt_seconds=round(time.perf_counter() - attempt_t0, 3),
+        )
+        return result
+    return None
+
+
+class UploadQueue:
+    def __init__(
+        self,
+        max_workers: int = UPLOAD_MAX_WORKERS,
+        max_attempts: Optional[int] = None,
+        backoff_seconds: float = UPLOAD_BACKOFF_SECONDS,
+    ):
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.results: dict[str, Any] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures: dict[str, Future] = {}
+
+    def __enter__(self) -> "UploadQueue":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.join()
+
+    def submit(self, upload_key: str, function: Callable, *args, **kwargs):
+        if upload_key in self._futures:
+            raise ValueError(f"Upload {upload_key} is already in the queue")
+        record_upload(upload_key, status="queued", attempts=0, error=None)
+        self._futures[upload_key] = self._executor.submit(
+            run_upload,
+            upload_key,
+            function,
+            *args,
+            max_attempts=self.max_attempts,
+            backoff_seconds=self.backoff_seconds,
+            **kwargs,
+        )
+
+    def join(self) -> dict[str, Any]:
+        # Waits for all uploads, returning the results of those which succeeded
+        wait(list(self._futures.values()))
+        self._executor.shutdown(wait=True)
+        for upload_key, future in self._futures.items():
+            if get_upload(upload_key)["status"] == "uploaded":
+                self.results[upload_key] = future.result()
+        return self.results
+
+    def list_failed(self) -> list[str]:
+        return [x for x in self._futures if get_upload(x)["status"] == "failed"]
+
+
+def summarise_uploads(uploads: Optional[dict[str, dict]] = None) -> dict:
+    if uploads is None:
+        uploads = list_uploads()
+    latencies = sorted(x["seconds"] for x in uploads.values() if "seconds" in x)
+    summary = {
+        "n_uploads": len(uploads),
+        "n_uploaded": sum(1 for x in uploads.values() if x["status"] == "uploaded"),
+        "n_failed": sum(1 for x in uploads.values() if x["status"] == "failed"),
+        "n_retried": sum(1 for x in uploads.values() if x["attempts"] > 1),
+        "n_attempts": sum(x["attempts"] for x in uploads.values()),
+        "total_seconds": round(sum(latencies), 3),
+    }
+    if len(latencies) != 0:
+        summary["mean_seconds"] = round(sum(latencies) / len(latencies), 3)
+        summary["p95_seconds"] = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+        summary["max_seconds"] = latencies[-1]
+    return summary
+
+
+def make_upload_report_rows(uploads: Optional[dict[str, dict]] = None) -> list[list]:
+    # Rows for the missing resources report: failed uploads and uploads which needed retries
+    if uploads is None:
+        uploads = list_uploads()
+    rows = []
+    for upload_key, upload in uploads.items():
+        if upload["status"] == "failed":
+            rows.append([upload_key, f"upload failed after {upload['attempts']} attempts"])
+        elif upload["status"] == "uploaded" and upload["attempts"] > 1:
+            rows.append([upload_key, f"uploaded on attempt {upload['attempts']}"])
+    return rows
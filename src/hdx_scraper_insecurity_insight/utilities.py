@@ -14,11 +14,26 @@ import os
 import sys
 import time
 
-from typing import Any
+from typing import Any, Optional
+from urllib.parse import urlparse
 
 from urllib3 import request
 from urllib3.util import Retry
 
+from hdx_scraper_insecurity_insight.metrics import span
+from hdx_scraper_insecurity_insight.profiling import remove_flag_arguments
+from hdx_scraper_insecurity_insight.schema_store import (
+    read_schema_rows,
+    upsert_schemas,
+    write_csv_atomically,
+)
+from hdx_scraper_insecurity_insight.schema_profile import (
+    make_profiling_hook,
+    record_schema_profile,
+    start_schema_profile,
+    summarise_schema_profile,
+)
+
 SCHEMA_FILEPATH = os.path.join(os.path.dirname(__file__), "metadata", "schema.csv")
 ATTRIBUTES_FILEPATH = os.path.join(os.path.dirname(__file__), "metadata", "attributes.csv")
 INSECURITY_INSIGHTS_FILEPATH_PAGES = os.path.join(
@@ -30,52 +45,87 @@ INSECURITY_INSIGHTS_FILEPATH_TOPICS = os.path.join(
 INSECURITY_INSIGHTS_FILEPATH_COUNTRIES = os.path.join(
     os.path.dirname(__file__), "metadata", "New-HDX-APIs-3-Country.csv"
 )
+# Setting this replaces the scheme and host of the api_url attributes, i.e. to point at a local
+# FakeInsecurityInsightAPI server
+API_BASE_URL_VARIABLE = "INSECURITY_INSIGHT_API_BASE_URL"
+# Seconds to wait before retrying an endpoint which returns 503 without a Retry-After header
+API_UNAVAILABLE_WAIT = 300
 
 
 def fetch_json(dataset_name: str, use_sample: bool = False):
+    # The response is profiled as it is parsed, before censoring changes any values
+    schema_profile = start_schema_profile()
     if use_sample:
-        json_response = fetch_json_from_samples(dataset_name)
+        json_response = fetch_json_from_samples(dataset_name, schema_profile=schema_profile)
     else:
-        json_response = fetch_json_from_api(dataset_name)
+        json_response = fetch_json_from_api(dataset_name, schema_profile=schema_profile)
+    record_schema_profile(dataset_name, summarise_schema_profile(schema_profile))
 
-    censored_location_response = censor_location("PSE", json_response)
-    censored_response = censor_event_description(censored_location_response)
+    with span("censor", resource=dataset_name) as censor_metrics:
+        censored_location_response = censor_location("PSE", json_response)
+        censored_response = censor_event_description(censored_location_response)
+        censor_metrics["records"] = len(censored_response)
 
     return censored_response
 
 
-def fetch_json_from_api(dataset_name: str) -> list[dict]:
+def fetch_json_from_api(dataset_name: str, schema_profile: Optional[dict] = None) -> list[dict]:
     attributes = read_attributes(dataset_name)
+    api_url = resolve_api_url(attributes["api_url"])
 
-    response = request(
-        "GET", attributes["api_url"], timeout=60, retries=Retry(90, backoff_factor=1.0)
-    )
+    with span("fetch", resource=dataset_name) as fetch_metrics:
+        # 503 responses with a Retry-After header are retried by urllib3
+        response = request("GET", api_url, timeout=60, retries=Retry(90, backoff_factor=1.0))
 
-    if response.status == 503:
-        logging.info(
-            f"Endpoint returned a 503 status for {dataset_name}, waiting 300 seconds to retry"
-        )
-        time.sleep(300)
-        response = request(
-            "GET", attributes["api_url"], timeout=60, retries=Retry(90, backoff_factor=1.0)
-        )
+        if response.status == 503:
+            logging.info(
+                f"Endpoint returned a 503 status for {dataset_name}, "
+                f"waiting {API_UNAVAILABLE_WAIT} seconds to retry"
+            )
+            time.sleep(API_UNAVAILABLE_WAIT)
+            response = request("GET", api_url, timeout=60, retries=Retry(90, backoff_factor=1.0))
+        fetch_metrics["bytes"] = len(response.data)
 
-    json_response = response.json()
+    with span("parse", resource=dataset_name) as parse_metrics:
+        json_response = parse_json(response.data, schema_profile=schema_profile)
+        parse_metrics["records"] = len(json_response)
 
     return json_response
 
 
-def fetch_json_from_samples(dataset_name: str) -> list[dict]:
+def resolve_api_url(api_url: str) -> str:
+    base_url = os.environ.get(API_BASE_URL_VARIABLE, "")
+    if len(base_url) == 0:
+        return api_url
+    return base_url.rstrip("/") + urlparse(api_url).path
+
+
+def fetch_json_from_samples(dataset_name: str, schema_profile: Optional[dict] = None) -> list[dict]:
     attributes = read_attributes(dataset_name)
-    with open(
-        os.path.join(os.path.dirname(__file__), "api-samples", attributes["api_response_filename"]),
-        "r",
-        encoding="UTF-8",
-    ) as api_response_filehandle:
-        json_response = json.load(api_response_filehandle)
+    with span("fetch", resource=dataset_name) as fetch_metrics:
+        with open(
+            os.path.join(
+                os.path.dirname(__file__), "api-samples", attributes["api_response_filename"]
+            ),
+            "rb",
+        ) as api_response_filehandle:
+            api_response_bytes = api_response_filehandle.read()
+        fetch_metrics["bytes"] = len(api_response_bytes)
+
+    with span("parse", resource=dataset_name) as parse_metrics:
+        json_response = parse_json(api_response_bytes, schema_profile=schema_profile)
+        parse_metrics["records"] = len(json_response)
     return json_response
 
 
+def parse_json(response_bytes: bytes, schema_profile: Optional[dict] = None) -> Any:
+    if schema_profile is None:
+        return json.loads(response_bytes.decode("UTF-8"))
+    return json.loads(
+        response_bytes.decode("UTF-8"), object_hook=make_profiling_hook(schema_profile)
+    )
+
+
 def filter_json_rows(country_filter: str, year_filter: str, api_response: list[dict]) -> list[dict]:
     filtered_rows = []
 
@@ -99,6 +149,20 @@ def filter_json_rows(country_filter: str, year_filter: str, api_response: list[d
     return filtered_rows
 
 
+def partition_api_response(api_response: list[dict]) -> dict[tuple[str, str], list[dict]]:
+    # Groups rows by (country, year) in one pass, keeping the order of the response within each
+    # partition, so that a country or year slice is a lookup rather than a filter_json_rows scan
+    partitions = {}
+    if len(api_response) == 0:
+        return partitions
+    date_field, iso_country_field = pick_date_and_iso_country_fields(api_response[0])
+    for api_row in api_response:
+        key = (api_row[iso_country_field], str(api_row[date_field])[0:4])
+        partitions.setdefault(key, []).append(api_row)
+
+    return partitions
+
+
 def censor_location(countries: list[str], api_response: list[dict]) -> list[dict]:
     censored_rows = []
 
@@ -148,6 +212,48 @@ def censor_event_description(api_response: list[dict]) -> list[dict]:
     return censored_rows
 
 
+def project_api_response(dataset_name: str, api_response: list[dict]) -> list[dict]:
+    # Keep only the upstream fields used by the spreadsheets, in schema order, so that the
+    # API cache does not hold unused fields for the whole run
+    if len(api_response) == 0:
+        return api_response
+
+    upstream_fields = read_upstream_fields(dataset_name)
+    if len(upstream_fields) == 0:
+        logging.info(f"No schema found for {dataset_name}, API response not projected")
+        return api_response
+
+    # The date and country fields are needed for filtering even if not in the schema
+    for field in pick_date_and_iso_country_fields(api_response[0]):
+        if field not in upstream_fields and field in api_response[0]:
+            upstream_fields.append(field)
+
+    projected_rows = [
+        {field: api_row[field] for field in upstream_fields if field in api_row}
+        for api_row in api_response
+    ]
+
+    n_dropped = len(api_response[0]) - len(projected_rows[0])
+    logging.info(
+        f"Projected {dataset_name} to {len(upstream_fields)} fields, "
+        f"dropped {n_dropped} unused fields"
+    )
+    return projected_rows
+
+
+def read_upstream_fields(dataset_name: str) -> list[str]:
+    if dataset_name.endswith("current-year"):
+        dataset_name = dataset_name.replace("-current-year", "")
+    _, row_template = read_schema(dataset_name)
+
+    upstream_fields = []
+    for upstream_field in row_template.values():
+        if upstream_field != "" and upstream_field not in upstream_fields:
+            upstream_fields.append(upstream_field)
+
+    return upstream_fields
+
+
 def read_attributes(dataset_name: str) -> dict:
     with open(ATTRIBUTES_FILEPATH, "r", encoding="UTF-8") as attributes_filehandle:
         attribute_rows = csv.DictReader(attributes_filehandle)
@@ -224,48 +330,44 @@ def read_schema(dataset_name: str) -> tuple[dict, dict]:
         schema_filepath = SCHEMA_FILEPATH
     else:
         schema_filepath = SCHEMA_FILEPATH.replace("schema.csv", "schema-overview.csv")
-    if os.path.exists(schema_filepath):
-        with open(schema_filepath, "r", encoding="UTF-8") as schema_filehandle:
-            schema_rows = csv.DictReader(schema_filehandle)
-
-            for row in schema_rows:
-                if row["dataset_name"] != dataset_name:
-                    continue
-                hdx_row[row["field_name"]] = row["terms"]
-                # This is where we would switch to using the API as the template
-                row_template[row["field_name"]] = row["upstream"]
+    # The schema file is indexed by dataset_name on first read, see schema_store.py
+    for row in read_schema_rows(schema_filepath, dataset_name):
+        hdx_row[row["field_name"]] = row["terms"]
+        # This is where we would switch to using the API as the template
+        row_template[row["field_name"]] = row["upstream"]
 
     return hdx_row, row_template
 
 
 def write_schema(dataset_name: str, output_rows: list[dict]) -> str:
-    hdx_row, _ = read_schema(dataset_name)
-    if not hdx_row:
-        status = write_dictionary(SCHEMA_FILEPATH, output_rows, append=True)
-    else:
-        status = f"Schema for {dataset_name} already in {SCHEMA_FILEPATH}, no update made"
-    return status
+    return write_schemas({dataset_name: output_rows})[dataset_name]
+
+
+def write_schemas(schemas: dict[str, list[dict]]) -> dict[str, str]:
+    # Datasets already in the schema file are not updated, new ones are added in one rewrite
+    file_statuses = upsert_schemas(SCHEMA_FILEPATH, schemas, replace=False)
+    statuses = {}
+    for dataset_name, file_status in file_statuses.items():
+        if file_status == "unchanged":
+            statuses[
+                dataset_name
+            ] = f"Schema for {dataset_name} already in {SCHEMA_FILEPATH}, no update made"
+        else:
+            statuses[dataset_name] = f"Schema for {dataset_name} added to {SCHEMA_FILEPATH}"
+    return statuses
 
 
 def write_dictionary(
     output_filepath: str, output_rows: list[dict[str, Any]], append: bool = True
 ) -> str:
+    # The file is rewritten and renamed into place so an interrupted write leaves it unchanged
     keys = list(output_rows[0].keys())
     newfile = not os.path.isfile(output_filepath)
 
-    if not append and not newfile:
-        os.remove(output_filepath)
-        newfile = True
-
-    with open(output_filepath, "a", encoding="utf-8", errors="ignore") as output_file:
-        dict_writer = csv.DictWriter(
-            output_file,
-            keys,
-            lineterminator="\n",
-        )
-        if newfile:
-            dict_writer.writeheader()
-        dict_writer.writerows(output_rows)
+    existing_filepath = None
+    if append and not newfile:
+        existing_filepath = output_filepath
+    write_csv_atomically(output_filepath, keys, output_rows, existing_filepath=existing_filepath)
 
     status = _make_write_dictionary_status(append, output_filepath, newfile)
 
@@ -286,12 +388,14 @@ def _make_write_dictionary_status(append: bool, filepath: str, newfile: bool) ->
 def parse_commandline_arguments() -> tuple[str, str]:
     dataset_name = "insecurity-insight-aidworkerKIKA-overview"
     country_code = ""
-    if len(sys.argv) == 2:
-        dataset_name = sys.argv[1]
+    # Flags such as --profile are handled elsewhere
+    arguments = remove_flag_arguments(sys.argv)
+    if len(arguments) == 2:
+        dataset_name = arguments[1]
         country_code = ""
-    elif len(sys.argv) == 3:
-        dataset_name = sys.argv[1]
-        country_code = sys.argv[2]
+    elif len(arguments) == 3:
+        dataset_name = arguments[1]
+        country_code = arguments[2]
 
     return dataset_name, country_code
 
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Header-only and single column reading of Excel workbooks, for the places which only need the
+column names, the HXL tag row or one column of a workbook rather than the whole sheet.
+
+Workbooks are opened with openpyxl in read-only mode, which streams rows from the sheet XML, so
+reading stops after the rows asked for and a column is read without building a DataFrame of the
+sheet. Column names follow pandas.read_excel: a blank header is "Unnamed: <index>" and a repeated
+header gets a ".1", ".2" suffix.
+
+column_names, hxl_tags = read_workbook_rows("2022-shcc-incident-data.xlsx", n_rows=2)
+dates = read_workbook_column("2024 Conflict Related Sexual Violence Incident Data.xlsx", "Date")
+"""
+
+import logging
+
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+import openpyxl
+
+LOGGER = logging.getLogger(__name__)
+
+
+@contextmanager
+def open_worksheet(workbook_filepath: str, sheet_name: Optional[str] = None) -> Iterator[Any]:
+    # The first sheet is used if no sheet_name is given, as pandas.read_excel does
+    workbook = openpyxl.load_workbook(workbook_filepath, read_only=True, data_only=True)
+    try:
+        if sheet_name is None:
+            yield workbook.worksheets[0]
+        else:
+            yield workbook[sheet_name]
+    finally:
+        workbook.close()
+
+
+def read_rows(worksheet: Any, n_rows: int) -> list[list]:
+    rows = [list(x) for x in worksheet.iter_rows(max_row=n_rows, values_only=True)]
+    if len(rows) != 0:
+        rows[0] = make_column_names(rows[0])
+    return rows
+
+
+def read_column(worksheet: Any, column_name: str) -> list:
+    column_names = read_rows(worksheet, 1)[0]
+    if column_name not in column_names:
+        raise KeyError(f"Column {column_name} is not in the worksheet columns {column_names}")
+    column_index = column_names.index(column_name) + 1
+    return [
+        x[0]
+        for x in worksheet.iter_rows(
+            min_row=2, min_col=column_index, max_col=column_index, values_only=True
+        )
+    ]
+
+
+def read_workbook_rows(
+    workbook_filepath: str, n_rows: int = 2, sheet_name: Optional[str] = None
+) -> list[list]:
+    with open_worksheet(workbook_filepath, sheet_name=sheet_name) as worksheet:
+        return read_rows(worksheet, n_rows)
+
+
+def read_workbook_column(
+    workbook_filepath: str, column_name: str, sheet_name: Optional[str] = None
+) -> list:
+    with open_worksheet(workbook_filepath, sheet_name=sheet_name) as worksheet:
+        return read_column(worksheet, column_name)
+
+
+def make_column_names(header_row: list) -> list[str]:
+    column_names = []
+    for i, value in enumerate(header_row):
+        column_name = f"Unnamed: {i}" if value is None else str(value)
+        if column_name in column_names:
+            n_repeats = 1
+            while f"{column_name}.{n_repeats}" in column_names:
+                n_repeats += 1
+            column_name = f"{column_name}.{n_repeats}"
+        column_names.append(column_name)
+    return column_names
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import copy
+
+from unittest import mock
+
+import pytest
+
+from hdx.api.configuration import Configuration
+
+from hdx_scraper_insecurity_insight.change_plan import (
+    list_spreadsheet_hashes,
+    load_content_hashes,
+    make_change_plan,
+    make_content_index,
+    record_published_spreadsheets,
+)
+from hdx_scraper_insecurity_insight.fake_ckan import FakeCKANServer
+from hdx_scraper_insecurity_insight import run
+from hdx_scraper_insecurity_insight.run import main
+from hdx_scraper_insecurity_insight.utilities import (
+    fetch_json_from_samples,
+    partition_api_response,
+    project_api_response,
+)
+
+RESOURCE_NAMES = [
+    "insecurity-insight-crsv-incidents",
+    "insecurity-insight-crsv-incidents-current-year",
+    "insecurity-insight-crsv-overview",
+]
+API_CACHE = {x: project_api_response(x, fetch_json_from_samples(x)) for x in RESOURCE_NAMES}
+
+
+def make_published_dataset_cache(api_cache: dict) -> dict:
+    # Datasets as they would be after the scraper published the planned changes
+    plan = make_change_plan(api_cache, make_empty_dataset_cache(), content_hashes={})
+    dataset_cache = {}
+    for entry in plan["topics"] + plan["countries"]:
+        dataset = {x: y["planned"] for x, y in entry["fields"].items() if "planned" in y}
+        if "groups" in entry["fields"]:
+            dataset["groups"] = [{"name": x} for x in entry["fields"]["groups"]["added"]]
+        dataset["resources"] = [{"name": x["filename"]} for x in entry["files"]]
+        dataset_cache[entry["dataset"]] = dataset
+    return dataset_cache
+
+
+def make_empty_dataset_cache() -> dict:
+    return {"insecurity-insight-crsv-dataset": {}, "insecurity-insight-pse-dataset": {}}
+
+
+def test_partition_api_response():
+    api_response = API_CACHE["insecurity-insight-crsv-incidents"]
+    partitions = partition_api_response(api_response)
+
+    assert sum(len(x) for x in partitions.values()) == len(api_response)
+    assert all(x["Date"][0:4] == year for (_, year), rows in partitions.items() for x in rows)
+    assert all(x["Country ISO"] == iso for (iso, _), rows in partitions.items() for x in rows)
+
+
+def test_make_change_plan_lists_new_datasets():
+    plan = make_change_plan(
+        API_CACHE, make_empty_dataset_cache(), topics=["crsv"], countries=["PSE"], content_hashes={}
+    )
+
+    assert plan["has_changes"]
+    assert [x["dataset"] for x in plan["topics"]] == ["insecurity-insight-crsv-dataset"]
+    assert [x["country"] for x in plan["countries"]] == ["PSE"]
+    topic_files = [x["filename"] for x in plan["topics"][0]["files"]]
+    assert "2020-2025 Conflict Related Sexual Violence Incident Data.xlsx" in topic_files
+    assert all(x["reason"] == "not on HDX" for x in plan["topics"][0]["files"])
+    assert set(plan["topics"][0]["fields"]) == {"dataset_date", "groups", "title", "description"}
+
+
+def test_make_change_plan_after_publishing():
+    dataset_cache = make_published_dataset_cache(API_CACHE)
+    content_hashes = list_spreadsheet_hashes(API_CACHE, topics=["crsv"], countries=["PSE"])
+
+    plan = make_change_plan(
+        API_CACHE, dataset_cache, topics=["crsv"], countries=["PSE"], content_hashes=content_hashes
+    )
+    assert not plan["has_changes"]
+
+    # A changed PSE record changes the topic and PSE spreadsheets but no other dataset fields
+    api_cache = copy.deepcopy(API_CACHE)
+    api_row = next(
+        x
+        for x in api_cache["insecurity-insight-crsv-incidents"]
+        if x["Country ISO"] == "PSE" and x["Date"][0:4] == "2024"
+    )
+    api_row["Country"] = "Changed"
+    plan = make_change_plan(
+        api_cache, dataset_cache, topics=["crsv"], countries=["PSE"], content_hashes=content_hashes
+    )
+
+    assert plan["has_changes"]
+    for entry in plan["topics"] + plan["countries"]:
+        assert entry["fields"] == {}
+        assert [x["reason"] for x in entry["files"]] == ["content changed"]
+        assert "Incident Data" in entry["files"][0]["filename"]
+
+
+def test_make_change_plan_only_counts_datasets_the_run_updates():
+    dataset_cache = make_published_dataset_cache(API_CACHE)
+    api_cache = copy.deepcopy(API_CACHE)
+    api_cache["insecurity-insight-crsv-incidents"][0]["Country"] = "Changed"
+
+    # Content changed without new dates, which the run does not update
+    plan = make_change_plan(
+        api_cache, dataset_cache, topics=["crsv"], countries=["PSE"], items_to_update=[]
+    )
+    assert not plan["has_changes"]
+    assert plan["topics"] == [] and plan["countries"] == []
+    assert [x["dataset"] for x in plan["not_updated"]][0] == "insecurity-insight-crsv-dataset"
+
+    plan = make_change_plan(
+        api_cache,
+        dataset_cache,
+        topics=["crsv"],
+        countries=["PSE"],
+        items_to_update=[("crsv", "2020-01-07", "2025-01-27")],
+    )
+    assert plan["has_changes"]
+    assert plan["not_updated"] == []
+
+
+REAL_FETCH_AND_CACHE_API_RESPONSES = run.fetch_and_cache_api_responses
+
+
+def fetch_crsv_api_responses(use_sample=False, state_directory=None):
+    return REAL_FETCH_AND_CACHE_API_RESPONSES(
+        use_sample=use_sample, refresh=["crsv"], state_directory=state_directory
+    )
+
+
+def test_main_diff_settles_after_run(tmp_path):
+    options = [
+        "--sample",
+        "--topics",
+        "crsv",
+        "--countries",
+        "PSE",
+        "--state-dir",
+        str(tmp_path / "state"),
+        "--report-dir",
+        str(tmp_path / "reports"),
+        "--hashes-dir",
+        str(tmp_path / "hashes"),
+    ]
+    with FakeCKANServer() as server:
+        server.configure_hdx()
+        try:
+            assert main(["diff"] + options)["has_changes"]
+            # Only some endpoints have samples in api-samples
+            with mock.patch.object(
+                run, "fetch_and_cache_api_responses", fetch_crsv_api_responses
+            ), mock.patch.object(run, "check_api_has_not_changed"):
+                main(["all", "--resume", "--in-memory"] + options)
+            plan = main(["diff"] + options)
+        finally:
+            Configuration.delete()
+
+    assert not plan["has_changes"]
+    assert plan["topics"] == [] and plan["countries"] == []
+
+
+def test_make_content_index_is_stable():
+    api_response = API_CACHE["insecurity-insight-crsv-incidents"]
+
+    assert make_content_index(api_response) == make_content_index(copy.deepcopy(api_response))
+
+
+def test_record_published_spreadsheets(tmp_path):
+    record_published_spreadsheets(API_CACHE, str(tmp_path), topics=["crsv"], countries=[])
+    record_published_spreadsheets(API_CACHE, str(tmp_path), topics=[], countries=["PSE"])
+    record_published_spreadsheets(API_CACHE, None, topics=["crsv"], countries=[])
+
+    assert load_content_hashes(str(tmp_path)) == list_spreadsheet_hashes(
+        API_CACHE, topics=["crsv"], countries=["PSE"]
+    )
+
+
+def test_main_diff_detailed_exitcode(tmp_path):
+    options = [
+        "--sample",
+        "--topics",
+        "crsv",
+        "--countries",
+        "PSE",
+        "--local-hdx",
+        "--state-dir",
+        str(tmp_path / "state"),
+        "--report-dir",
+        str(tmp_path / "reports"),
+        "--hashes-dir",
+        str(tmp_path / "hashes"),
+    ]
+    try:
+        plan = main(["diff"] + options)
+        with pytest.raises(SystemExit) as exit_info:
+            main(["diff", "--detailed-exitcode"] + options)
+    finally:
+        Configuration.delete()
+
+    assert plan["has_changes"]
+    assert len(list((tmp_path / "reports").glob("plan-*.json"))) != 0
+    assert exit_info.value.code == 2
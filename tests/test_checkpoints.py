@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import json
+import os
+import time
+
+from hdx_scraper_insecurity_insight import checkpoints
+from hdx_scraper_insecurity_insight.checkpoints import (
+    STARTED_CHECKPOINT,
+    checkpoint_filepath,
+    list_completed,
+    load_checkpoint,
+    mark_completed,
+    mark_completed_with_outputs,
+    read_completed_outputs,
+    save_checkpoint,
+    start_run_state,
+)
+
+
+def test_save_and_load_checkpoint(tmp_path):
+    save_checkpoint(str(tmp_path), "api-cache/test-resource", [{"a": 1}])
+
+    assert load_checkpoint(str(tmp_path), "api-cache/test-resource") == [{"a": 1}]
+    assert load_checkpoint(str(tmp_path), "missing") is None
+    assert [x.name for x in (tmp_path / "api-cache").iterdir()] == ["test-resource.json"]
+
+
+def test_mark_completed(tmp_path):
+    mark_completed(str(tmp_path), "uploads", "dataset-1")
+    mark_completed(str(tmp_path), "uploads", "dataset-2")
+    mark_completed(str(tmp_path), "uploads", "dataset-1")
+
+    assert list_completed(str(tmp_path), "uploads") == ["dataset-1", "dataset-2"]
+    assert list_completed(None, "uploads") == []
+
+
+def test_mark_completed_with_outputs(tmp_path):
+    mark_completed_with_outputs(str(tmp_path), "spreadsheets", "country:PSE", ["a.xlsx"])
+    mark_completed_with_outputs(str(tmp_path), "spreadsheets", "topic:crsv", [])
+
+    assert read_completed_outputs(str(tmp_path), "spreadsheets") == {
+        "country:PSE": ["a.xlsx"],
+        "topic:crsv": [],
+    }
+    assert read_completed_outputs(None, "spreadsheets") == {}
+
+
+def test_start_run_state_resume(tmp_path):
+    state_directory = str(tmp_path / "run-state")
+    assert not start_run_state(state_directory, resume=True)
+    mark_completed(state_directory, "uploads", "dataset-1")
+
+    assert start_run_state(state_directory, resume=True)
+    assert list_completed(state_directory, "uploads") == ["dataset-1"]
+
+    assert not start_run_state(state_directory, resume=False)
+    assert list_completed(state_directory, "uploads") == []
+
+
+def test_start_run_state_discards_stale_state(tmp_path):
+    state_directory = str(tmp_path)
+    mark_completed(state_directory, "uploads", "dataset-1")
+    with open(checkpoint_filepath(state_directory, STARTED_CHECKPOINT), "w", encoding="utf-8") as f:
+        json.dump({"timestamp": time.time() - 48 * 3600}, f)
+
+    assert not start_run_state(state_directory, resume=True)
+    assert list_completed(state_directory, "uploads") == []
+    assert os.path.exists(checkpoint_filepath(state_directory, STARTED_CHECKPOINT))
+
+
+def test_start_run_state_max_age_is_configurable(tmp_path, monkeypatch):
+    state_directory = str(tmp_path)
+    mark_completed(state_directory, "uploads", "dataset-1")
+    with open(checkpoint_filepath(state_directory, STARTED_CHECKPOINT), "w", encoding="utf-8") as f:
+        json.dump({"timestamp": time.time() - 48 * 3600}, f)
+    monkeypatch.setattr(checkpoints, "MAX_STATE_AGE_HOURS", 7 * 24)
+
+    assert start_run_state(state_directory, resume=True)
+    assert list_completed(state_directory, "uploads") == ["dataset-1"]
@@ -23,6 +23,8 @@ from hdx_scraper_insecurity_insight.create_datasets import (
     create_or_fetch_base_dataset,
     create_datasets_in_hdx,
     get_date_range_from_resource_file,
+    make_dataset_patch,
+    order_resource_ids,
 )
 
 
@@ -89,6 +91,25 @@ def test_find_resource_filename():
     assert filename == "2020-2023 Conflict Related Sexual Violence Incident Data.xlsx"
 
 
+def test_find_resource_filename_file_format(tmp_path):
+    resource_name = "insecurity-insight-crsv-incidents"
+    attributes = read_attributes(resource_name)
+    filename = "2020-2025 Conflict Related Sexual Violence Incident Data"
+    for extension in [".xlsx", ".csv", "Xxlsx"]:
+        (tmp_path / f"{filename}{extension}").write_bytes(b"")
+
+    # The . in the template extension matches literally
+    xlsx_filepath = find_resource_filepath(
+        resource_name, attributes, spreadsheet_directory=str(tmp_path)
+    )
+    csv_filepath = find_resource_filepath(
+        resource_name, attributes, spreadsheet_directory=str(tmp_path), file_format="CSV"
+    )
+
+    assert os.path.basename(xlsx_filepath) == f"{filename}.xlsx"
+    assert os.path.basename(csv_filepath) == f"{filename}.csv"
+
+
 def test_find_resource_filename_single_year():
     spreadsheet_directory = os.path.join(os.path.dirname(__file__), "fixtures")
     resource_name = "insecurity-insight-healthcare-incidents"
@@ -284,6 +305,42 @@ def test_create_datasets_in_hdx_country_use_legacy():
     )
 
 
+def test_make_dataset_patch():
+    hdx_dataset_data = {
+        "id": "1234",
+        "title": "Title",
+        "dataset_date": "[2020-01-01T00:00:00 TO 2025-01-27T23:59:59]",
+        "groups": [{"id": "5678", "name": "sdn", "title": "Sudan"}],
+    }
+    dataset_data = {
+        "id": "1234",
+        "title": "Title",
+        "dataset_date": "[2020-01-01 TO 2025-01-27]",
+        "groups": [{"name": "sdn"}],
+    }
+
+    assert make_dataset_patch(hdx_dataset_data, dataset_data) == {}
+
+    dataset_data["title"] = "New title"
+    dataset_data["groups"].append({"name": "ssd"})
+    assert make_dataset_patch(hdx_dataset_data, dataset_data) == {
+        "title": "New title",
+        "groups": [{"name": "sdn"}, {"name": "ssd"}],
+    }
+
+
+def test_order_resource_ids():
+    resources = [
+        {"id": "1", "name": "Methodology.pdf"},
+        {"id": "2", "name": "2020-2025 Incident Data.xlsx"},
+        {"id": "3", "name": "2020-2025 Overview Data.xlsx"},
+    ]
+    resource_list_names = ["2020-2025 Incident Data.xlsx", "2020-2025 Overview Data.xlsx"]
+
+    assert order_resource_ids(resources, resource_list_names) == ["2", "3", "1"]
+    assert order_resource_ids(resources[1:], resource_list_names) == ["2", "3"]
+
+
 def test_get_date_range_from_resource_file():
     test_filenames = [
         ("2024 Conflict Related Sexual Violence Incident Data.xlsx", "2024-05-28T00:00:00"),
@@ -1,15 +1,22 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import datetime
 import os
 import pandas
+import pytest
 
 from hdx_scraper_insecurity_insight.create_spreadsheets import (
     generate_spreadsheet_filename,
     date_range_from_json,
-    transform_input_rows,
+    compile_row_transformer,
     create_spreadsheet,
     make_type_dict,
+    build_typed_dataframe,
+    change_filename_format,
+    make_spreadsheet_index,
+    select_from_spreadsheet_index,
+    transform_api_rows,
 )
 
 from hdx_scraper_insecurity_insight.utilities import (
@@ -88,6 +95,63 @@ def test_create_current_year_spreadsheet():
         os.remove(expected_file_path)
 
 
+def test_create_spreadsheet_csv_companion():
+    expected_filename = "2020-2025 Conflict Related Sexual Violence Incident Data"
+    temp_directory = os.path.join(os.path.dirname(__file__), "temp")
+
+    for extension in [".xlsx", ".csv"]:
+        expected_file_path = os.path.join(temp_directory, expected_filename + extension)
+        if os.path.exists(expected_file_path):
+            os.remove(expected_file_path)
+    status = create_spreadsheet(
+        DATASET_NAME,
+        output_directory=temp_directory,
+        api_response=SAMPLE_RESPONSE,
+        file_formats=["XLSX", "CSV"],
+    )
+
+    assert f"{expected_filename}.xlsx" in status
+    assert f"{expected_filename}.csv" in status
+
+    excel_df = pandas.read_excel(os.path.join(temp_directory, f"{expected_filename}.xlsx"))
+    csv_df = pandas.read_csv(os.path.join(temp_directory, f"{expected_filename}.csv"))
+
+    assert len(csv_df) == len(excel_df)
+    assert csv_df.columns.tolist() == excel_df.columns.tolist()
+    for extension in [".xlsx", ".csv"]:
+        os.remove(os.path.join(temp_directory, expected_filename + extension))
+
+
+@pytest.mark.parametrize(
+    "file_format,reader", [("PARQUET", pandas.read_parquet), ("ARROW", pandas.read_feather)]
+)
+def test_create_spreadsheet_arrow_formats(file_format, reader, tmp_path):
+    pytest.importorskip("pyarrow")
+    expected_filename = "2020-2025 Conflict Related Sexual Violence Incident Data"
+    status = create_spreadsheet(
+        DATASET_NAME,
+        output_directory=str(tmp_path),
+        api_response=SAMPLE_RESPONSE,
+        file_formats=["XLSX", file_format],
+    )
+    output_filename = change_filename_format(f"{expected_filename}.xlsx", file_format)
+
+    assert output_filename in status
+
+    excel_df = pandas.read_excel(tmp_path / f"{expected_filename}.xlsx")
+    arrow_df = reader(tmp_path / output_filename)
+
+    assert len(arrow_df) == len(excel_df)
+    assert arrow_df.columns.tolist() == excel_df.columns.tolist()
+
+
+def test_change_filename_format():
+    filename = "2020-2025 Conflict Related Sexual Violence Incident Data.xlsx"
+
+    assert change_filename_format(filename, "csv") == filename.replace(".xlsx", ".csv")
+    assert change_filename_format(filename, "PARQUET") == filename.replace(".xlsx", ".parquet")
+
+
 def test_date_range_from_json():
     start_year, end_year = date_range_from_json(SAMPLE_RESPONSE)
 
@@ -118,20 +182,116 @@ def test_generate_spreadsheet_filename_country():
     assert filename == "2021-NGA Conflict Related Sexual Violence Incident Data.xlsx"
 
 
-def test_transform_input_rows():
+def test_compile_row_transformer_columns():
     filtered_rows = filter_json_rows("", "2021", SAMPLE_RESPONSE)
     _, row_template = read_schema(DATASET_NAME)
-    output_rows = transform_input_rows(row_template, filtered_rows)
+    output_columns = compile_row_transformer(row_template)(filtered_rows)
 
-    assert len(output_rows) == len(filtered_rows)
+    assert all(len(x) == len(filtered_rows) for x in output_columns.values())
 
-    assert "Admin 1" in output_rows[0].keys()
+    assert "Admin 1" in output_columns.keys()
     assert "Admin 1" in filtered_rows[0].keys()
 
 
+def test_compile_row_transformer():
+    filtered_rows = filter_json_rows("", "2021", SAMPLE_RESPONSE)
+    _, row_template = read_schema(DATASET_NAME)
+    row_transformer = compile_row_transformer(row_template)
+    output_columns = row_transformer(filtered_rows)
+
+    expected_dataframe = pandas.DataFrame.from_dict(
+        [{key: x.get(value, "") for key, value in row_template.items()} for x in filtered_rows]
+    )
+    assert list(output_columns.keys()) == list(row_template.keys())
+    assert pandas.DataFrame(output_columns).equals(expected_dataframe)
+
+
+def test_compile_row_transformer_missing_field():
+    row_template = {"Date": "Date", "Number of Events": "Number of Events"}
+    row_transformer = compile_row_transformer(row_template)
+    output_columns = row_transformer([{"Date": "2021-01-01", "Number Of Events": 1}])
+
+    assert output_columns == {"Date": ["2021-01-01"], "Number of Events": [""]}
+
+
 def test_make_type_dict():
     hdx_row, row_template = read_schema(DATASET_NAME)
     type_dict = make_type_dict(hdx_row)
     assert type_dict["Date"] == "datetime64[ns, UTC]"
     assert type_dict["Longitude"] == "float64"
     assert type_dict["Number of Reported Victims"] == "Int64"
+
+
+def test_build_typed_dataframe():
+    hdx_row, row_template = read_schema(DATASET_NAME)
+    columns = compile_row_transformer(row_template)(SAMPLE_RESPONSE)
+    output_dataframe, cast_failures = build_typed_dataframe(hdx_row, columns)
+
+    assert cast_failures == {}
+    assert len(output_dataframe) == len(SAMPLE_RESPONSE)
+    assert output_dataframe["Latitude"].dtype == "float64"
+    assert output_dataframe["Number of Reported Victims"].dtype == "Int64"
+    assert isinstance(output_dataframe["Date"][0], datetime.date)
+
+
+def test_build_typed_dataframe_reports_failures():
+    hdx_row = {"Date": "#date +occurred", "Latitude": "#geo +lat", "Killed": "#affected +killed"}
+    columns = {
+        "Date": ["2021-01-01T00:00:00.000Z", "not a date", ""],
+        "Latitude": ["14.5", None, "north"],
+        "Killed": ["3", "2.5", ""],
+    }
+    output_dataframe, cast_failures = build_typed_dataframe(hdx_row, columns)
+
+    assert cast_failures == {"Date": [1], "Latitude": [2], "Killed": [1]}
+    assert output_dataframe["Date"][0] == datetime.date(2021, 1, 1)
+    assert output_dataframe["Latitude"].isna().tolist() == [False, True, True]
+    assert output_dataframe["Killed"].isna().tolist() == [False, True, True]
+
+
+def test_select_from_spreadsheet_index():
+    hdx_row, row_template = read_schema(DATASET_NAME)
+    spreadsheet_index = make_spreadsheet_index(DATASET_NAME, SAMPLE_RESPONSE, hdx_row, row_template)
+
+    # The index matches filtering the response then transforming the filtered rows
+    for country_filter, year_filter in [("", ""), ("", "2024"), ("PSE", ""), ("PSE", "2024")]:
+        output_dataframe, years = select_from_spreadsheet_index(
+            spreadsheet_index, country_filter, year_filter
+        )
+        filtered_rows = filter_json_rows(country_filter, year_filter, SAMPLE_RESPONSE)
+        expected_dataframe = transform_api_rows(DATASET_NAME, filtered_rows, hdx_row, row_template)
+        pandas.testing.assert_frame_equal(output_dataframe, expected_dataframe)
+        assert (years[0], years[-1]) == date_range_from_json(filtered_rows)
+
+    # A year is a contiguous range of the rows
+    start, stop = spreadsheet_index["year_ranges"]["2024"]
+    assert stop - start == len(filter_json_rows("", "2024", SAMPLE_RESPONSE))
+
+    output_dataframe, years = select_from_spreadsheet_index(spreadsheet_index, "", "1999")
+    assert len(output_dataframe) == 0
+    assert years == []
+
+
+def test_create_current_year_spreadsheet_from_index(tmp_path):
+    spreadsheet_indexes = {}
+    create_spreadsheet(
+        DATASET_NAME,
+        output_directory=str(tmp_path),
+        api_response=SAMPLE_RESPONSE,
+        spreadsheet_indexes=spreadsheet_indexes,
+    )
+    status = create_spreadsheet(
+        f"{DATASET_NAME}-current-year",
+        year_filter="2024",
+        output_directory=str(tmp_path),
+        api_response=SAMPLE_RESPONSE,
+        spreadsheet_indexes=spreadsheet_indexes,
+    )
+
+    # The current-year spreadsheet reused the index made for the incidents spreadsheet
+    assert len(spreadsheet_indexes) == 1
+    assert "2024 Conflict Related Sexual Violence Incident Data.xlsx" in status
+    sheets_df = pandas.read_excel(
+        tmp_path / "2024 Conflict Related Sexual Violence Incident Data.xlsx"
+    )
+    assert len(sheets_df) == len(filter_json_rows("", "2024", SAMPLE_RESPONSE))
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from urllib3 import request
+
+from hdx_scraper_insecurity_insight import utilities
+from hdx_scraper_insecurity_insight.fake_api import FakeInsecurityInsightAPI
+from hdx_scraper_insecurity_insight.utilities import (
+    API_BASE_URL_VARIABLE,
+    fetch_json_from_api,
+    fetch_json_from_samples,
+    resolve_api_url,
+)
+
+DATASET_NAME = "insecurity-insight-crsv-overview"
+
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    with FakeInsecurityInsightAPI() as server:
+        monkeypatch.setenv(API_BASE_URL_VARIABLE, server.url)
+        yield server
+
+
+def test_resolve_api_url(monkeypatch):
+    api_url = "https://sind-api.herokuapp.com/hdx/v1/sv"
+    monkeypatch.delenv(API_BASE_URL_VARIABLE, raising=False)
+    assert resolve_api_url(api_url) == api_url
+
+    monkeypatch.setenv(API_BASE_URL_VARIABLE, "http://127.0.0.1:8000/")
+    assert resolve_api_url(api_url) == "http://127.0.0.1:8000/hdx/v1/sv"
+
+
+def test_fetch_json_from_api_serves_samples(fake_api):
+    api_response = fetch_json_from_api(DATASET_NAME)
+
+    assert api_response == fetch_json_from_samples(DATASET_NAME)
+    assert fake_api.call_counts[DATASET_NAME] == 1
+
+
+def test_scaled_synthetic_responses(monkeypatch):
+    with FakeInsecurityInsightAPI(scale=2) as server:
+        monkeypatch.setenv(API_BASE_URL_VARIABLE, server.url)
+        api_response = fetch_json_from_api(DATASET_NAME)
+
+    assert len(api_response) == 2 * len(fetch_json_from_samples(DATASET_NAME))
+
+
+def test_retry_after_is_honoured(fake_api):
+    fake_api.fail_next(DATASET_NAME, status=503, retry_after=1)
+
+    t0 = time.perf_counter()
+    api_response = fetch_json_from_api(DATASET_NAME)
+
+    assert len(api_response) != 0
+    assert fake_api.call_counts[DATASET_NAME] == 2
+    assert time.perf_counter() - t0 >= 1.0
+
+
+def test_unavailable_without_retry_after_waits(fake_api, monkeypatch):
+    monkeypatch.setattr(utilities, "API_UNAVAILABLE_WAIT", 0)
+    fake_api.fail_next(DATASET_NAME, status=503)
+
+    api_response = fetch_json_from_api(DATASET_NAME)
+
+    assert len(api_response) != 0
+    assert fake_api.call_counts[DATASET_NAME] == 2
+
+
+def test_etag_not_modified(fake_api):
+    url = resolve_api_url("https://sind-api.herokuapp.com/hdx/v1/svOverview")
+    response = request("GET", url)
+    etag = response.headers["ETag"]
+
+    not_modified = request("GET", url, headers={"If-None-Match": etag})
+
+    assert not_modified.status == 304
+    assert not_modified.data == b""
+    assert request("GET", url, headers={"If-None-Match": '"stale"'}).status == 200
+
+
+def test_replayed_latency_profile(fake_api):
+    fake_api.latency = [0.3, 0.0]
+
+    timings = []
+    for _ in range(4):
+        t0 = time.perf_counter()
+        fetch_json_from_api(DATASET_NAME)
+        timings.append(time.perf_counter() - t0)
+
+    assert timings[0] >= 0.3 and timings[2] >= 0.3
+    assert timings[1] < 0.3 and timings[3] < 0.3
+
+
+def test_concurrent_fetches_with_bandwidth_limit(fake_api):
+    fake_api.latency = 0.2
+    fake_api.bandwidth = 10_000_000
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        api_responses = list(executor.map(fetch_json_from_api, [DATASET_NAME] * 4))
+
+    assert all(x == api_responses[0] for x in api_responses)
+    assert time.perf_counter() - t0 < 0.8
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import pytest
+
+from hdx.api.configuration import Configuration
+from hdx.data.dataset import Dataset
+from hdx.data.hdxobject import HDXError
+from hdx.data.organization import Organization
+from urllib.parse import unquote
+
+from urllib3 import request
+
+from hdx_scraper_insecurity_insight.create_datasets import create_datasets_in_hdx
+from hdx_scraper_insecurity_insight.create_spreadsheets import create_spreadsheet
+from hdx_scraper_insecurity_insight.fake_ckan import FakeCKANServer
+from hdx_scraper_insecurity_insight.run import fetch_and_cache_datasets, list_datasets_to_cache
+from hdx_scraper_insecurity_insight.spreadsheet_buffers import SpreadsheetBuffers
+from hdx_scraper_insecurity_insight.upload_queue import get_upload, reset_uploads, run_upload
+from hdx_scraper_insecurity_insight.utilities import fetch_json
+
+DATASET_NAME = "insecurity-insight-crsv-dataset"
+
+
+@pytest.fixture
+def fake_ckan():
+    with FakeCKANServer() as server:
+        server.configure_hdx()
+        yield server
+    Configuration.delete()
+
+
+def create_crsv_dataset(
+    dataset_cache: dict,
+    dataset_date: str = "[2020-01-01T00:00:00 TO 2025-01-27T23:59:59]",
+    countries_group: Optional[list[dict]] = None,
+    n_rows: Optional[int] = None,
+):
+    api_response = fetch_json("insecurity-insight-crsv-incidents", use_sample=True)
+    with SpreadsheetBuffers() as spreadsheet_buffers:
+        create_spreadsheet(
+            "insecurity-insight-crsv-incidents",
+            api_response=api_response[0:n_rows],
+            spreadsheet_buffers=spreadsheet_buffers,
+        )
+        return create_datasets_in_hdx(
+            DATASET_NAME,
+            dataset_cache=dataset_cache,
+            dataset_date=dataset_date,
+            countries_group=countries_group or [{"name": "sdn"}],
+            spreadsheet_buffers=spreadsheet_buffers,
+        )
+
+
+def test_read_missing_dataset(fake_ckan):
+    assert Dataset.read_from_hdx("no-such-dataset") is None
+    assert fake_ckan.call_counts["package_show"] == 1
+
+
+def test_fetch_and_cache_datasets_offline(fake_ckan):
+    dataset_cache = fetch_and_cache_datasets(use_legacy=True, refresh=["crsv"])
+
+    assert DATASET_NAME in dataset_cache
+    assert len(dataset_cache) == len(list_datasets_to_cache(refresh=["crsv"]))
+    assert fake_ckan.call_counts["package_show"] == len(dataset_cache)
+
+
+def test_create_and_update_dataset(fake_ckan):
+    dataset_cache = fetch_and_cache_datasets(use_legacy=True, refresh=["crsv"])
+    fake_ckan.reset_call_counts()
+    dataset, _ = create_crsv_dataset(dataset_cache)
+
+    # The dataset is not read back from HDX and its single resource needs no reordering
+    assert dict(fake_ckan.call_counts) == {
+        "package_show": 1,
+        "vocabulary_show": 1,
+        "package_create": 1,
+        "package_revise": 1,
+    }
+    hdx_dataset = Dataset.read_from_hdx(dataset["name"])
+    assert len(hdx_dataset.get_resources()) == 1
+    resource = hdx_dataset.get_resources()[0]
+    assert resource["name"] == "2020-2025 Conflict Related Sexual Violence Incident Data.xlsx"
+    assert unquote(resource["url"]).endswith(f"/download/{resource['name']}")
+    download = request("GET", resource["url"])
+    assert download.status == 200
+    assert len(download.data) == resource["size"]
+
+    # A second run with the same content and metadata leaves the dataset unchanged
+    create_crsv_dataset(dataset_cache)
+    assert fake_ckan.call_counts["package_create"] == 1
+    assert fake_ckan.call_counts["package_revise"] == 1
+    assert len(fake_ckan.datasets) == 1
+
+
+def test_update_dataset_metadata_only(fake_ckan):
+    dataset_cache = fetch_and_cache_datasets(use_legacy=True, refresh=["crsv"])
+    create_crsv_dataset(dataset_cache)
+    resource = Dataset.read_from_hdx(dataset_cache[DATASET_NAME]["name"]).get_resources()[0]
+    fake_ckan.reset_call_counts()
+
+    dataset, _ = create_crsv_dataset(
+        dataset_cache,
+        dataset_date="[2020-01-01T00:00:00 TO 2025-02-28T23:59:59]",
+        countries_group=[{"name": "sdn"}, {"name": "ssd"}],
+    )
+
+    assert dict(fake_ckan.call_counts) == {"package_revise": 1}
+    hdx_dataset = Dataset.read_from_hdx(dataset["name"])
+    assert hdx_dataset["dataset_date"] == "[2020-01-01T00:00:00 TO 2025-02-28T23:59:59]"
+    assert [x["name"] for x in hdx_dataset["groups"]] == ["sdn", "ssd"]
+    # The file was not uploaded again
+    assert hdx_dataset.get_resources()[0]["last_modified"] == resource["last_modified"]
+    assert hdx_dataset.get_resources()[0]["url"] == resource["url"]
+    assert dataset["dataset_date"] == hdx_dataset["dataset_date"]
+
+
+def test_update_dataset_uploads_changed_files(fake_ckan):
+    dataset_cache = fetch_and_cache_datasets(use_legacy=True, refresh=["crsv"])
+    create_crsv_dataset(dataset_cache)
+    resource = Dataset.read_from_hdx(dataset_cache[DATASET_NAME]["name"]).get_resources()[0]
+    fake_ckan.reset_call_counts()
+
+    dataset, _ = create_crsv_dataset(dataset_cache, n_rows=-10)
+
+    assert dict(fake_ckan.call_counts) == {"package_revise": 1}
+    updated_resource = Dataset.read_from_hdx(dataset["name"]).get_resources()[0]
+    assert updated_resource["id"] == resource["id"]
+    assert updated_resource["hash"] != resource["hash"]
+    assert updated_resource["size"] == len(fake_ckan.uploads[resource["id"]])
+    assert updated_resource["size"] < resource["size"]
+
+
+def test_update_dataset_sets_resource_order(fake_ckan):
+    dataset_cache = fetch_and_cache_datasets(use_legacy=True, refresh=["crsv"])
+    dataset, _ = create_crsv_dataset(dataset_cache)
+    # A resource added by hand in HDX ahead of the resource from the API
+    hdx_dataset = fake_ckan.datasets[dataset["id"]]
+    hdx_dataset["resources"].insert(0, {"name": "Methodology.pdf", "format": "PDF", "url": "x"})
+    fake_ckan.add_dataset(hdx_dataset)
+    dataset_cache = fetch_and_cache_datasets(use_legacy=True, refresh=["crsv"])
+    fake_ckan.reset_call_counts()
+
+    dataset, _ = create_crsv_dataset(dataset_cache)
+
+    assert dict(fake_ckan.call_counts) == {"package_revise": 1}
+    assert [x["name"] for x in Dataset.read_from_hdx(dataset["name"]).get_resources()] == [
+        "2020-2025 Conflict Related Sexual Violence Incident Data.xlsx",
+        "Methodology.pdf",
+    ]
+
+
+def test_update_dataset_retried_after_failure(fake_ckan):
+    dataset_cache = fetch_and_cache_datasets(use_legacy=True, refresh=["crsv"])
+    create_crsv_dataset(dataset_cache)
+    fake_ckan.reset_call_counts()
+    reset_uploads()
+    # Client errors are not retried by hdx-python-api so the first attempt fails
+    fake_ckan.fail_next("package_revise", status=400)
+
+    dataset, _ = run_upload(
+        DATASET_NAME,
+        create_crsv_dataset,
+        dataset_cache,
+        dataset_date="[2020-01-01T00:00:00 TO 2025-02-28T23:59:59]",
+        backoff_seconds=0,
+    )
+
+    # The failed attempt left the cached dataset as it is in HDX so the retry sent the change
+    assert dict(fake_ckan.call_counts) == {"package_revise": 2}
+    assert get_upload(DATASET_NAME)["attempts"] == 2
+    hdx_dataset = Dataset.read_from_hdx(dataset["name"])
+    assert hdx_dataset["dataset_date"] == "[2020-01-01T00:00:00 TO 2025-02-28T23:59:59]"
+    reset_uploads()
+
+
+def test_create_dataset_with_csv_companion(fake_ckan):
+    dataset_cache = fetch_and_cache_datasets(use_legacy=True, refresh=["crsv"])
+    with SpreadsheetBuffers() as spreadsheet_buffers:
+        create_spreadsheet(
+            "insecurity-insight-crsv-incidents",
+            api_response=fetch_json("insecurity-insight-crsv-incidents", use_sample=True),
+            file_formats=["XLSX", "CSV"],
+            spreadsheet_buffers=spreadsheet_buffers,
+        )
+        dataset, _ = create_datasets_in_hdx(
+            DATASET_NAME,
+            dataset_cache=dataset_cache,
+            dataset_date="[2020-01-01T00:00:00 TO 2025-01-27T23:59:59]",
+            countries_group=[{"name": "sdn"}],
+            spreadsheet_buffers=spreadsheet_buffers,
+            file_formats=["XLSX", "CSV"],
+        )
+
+    resources = Dataset.read_from_hdx(dataset["name"]).get_resources()
+    assert [(x["name"][-4:], x["format"].upper()) for x in resources] == [
+        ("xlsx", "XLSX"),
+        (".csv", "CSV"),
+    ]
+
+
+def test_create_country_datasets_call_counts(fake_ckan):
+    countries = ["PSE", "SDN", "UKR"]
+    dataset_cache = fetch_and_cache_datasets(use_legacy=True, countries=countries, refresh=[])
+    with SpreadsheetBuffers() as spreadsheet_buffers:
+        for country in countries:
+            for resource_name in ["crsv", "protection"]:
+                create_spreadsheet(
+                    f"insecurity-insight-{resource_name}-incidents",
+                    country_filter=country,
+                    api_response=fetch_json(
+                        f"insecurity-insight-{resource_name}-incidents", use_sample=True
+                    ),
+                    spreadsheet_buffers=spreadsheet_buffers,
+                )
+
+        for n_run in range(2):
+            fake_ckan.reset_call_counts()
+            for country in countries:
+                create_datasets_in_hdx(
+                    "insecurity-insight-country-dataset",
+                    country_filter=country,
+                    dataset_cache=dataset_cache,
+                    dataset_date="[2020-01-01T00:00:00 TO 2025-01-27T23:59:59]",
+                    countries_group=[{"name": country.lower()}],
+                    spreadsheet_buffers=spreadsheet_buffers,
+                )
+            if n_run == 0:
+                # One existence check, create and revise with the files per dataset
+                assert fake_ckan.call_counts["package_show"] == len(countries)
+                assert fake_ckan.call_counts["package_create"] == len(countries)
+                assert fake_ckan.call_counts["package_revise"] == len(countries)
+                assert fake_ckan.call_counts["package_resource_reorder"] == 0
+
+    # Nothing has changed on the second run
+    assert sum(fake_ckan.call_counts.values()) == 0
+    assert max(len(x["resources"]) for x in fake_ckan.datasets.values()) == 2
+    # The dataset cache holds the resource ids returned by the create calls
+    for country in countries:
+        dataset = dataset_cache[f"insecurity-insight-{country.lower()}-dataset"]
+        assert [x["id"] for x in dataset.get_resources()] == [
+            x["id"] for x in fake_ckan.datasets[dataset["id"]]["resources"]
+        ]
+
+
+def test_failure_injection(fake_ckan):
+    fake_ckan.add_dataset({"name": "test-dataset", "title": "Test dataset"})
+
+    # hdx-python-api retries server errors so a single failure is not seen by the caller
+    fake_ckan.fail_next("package_show", status=503)
+    assert Dataset.read_from_hdx("test-dataset")["title"] == "Test dataset"
+    assert fake_ckan.call_counts["package_show"] == 2
+
+    # Client errors are not retried
+    fake_ckan.fail_next("package_show", status=400)
+    with pytest.raises(HDXError):
+        Dataset.read_from_hdx("test-dataset")
+
+
+def test_concurrent_reads_with_latency(fake_ckan):
+    fake_ckan.latency = {"package_show": 0.2}
+    for i in range(8):
+        fake_ckan.add_dataset({"name": f"test-dataset-{i}"})
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        datasets = list(
+            executor.map(Dataset.read_from_hdx, [f"test-dataset-{i}" for i in range(8)])
+        )
+
+    assert all(x is not None for x in datasets)
+    assert time.perf_counter() - t0 < 1.0
+
+
+def test_organization_listing(fake_ckan):
+    assert Organization.get_all_organization_names() == ["insecurity-insight"]
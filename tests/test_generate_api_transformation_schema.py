@@ -1,10 +1,16 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+from hdx_scraper_insecurity_insight import generate_api_transformation_schema
 from hdx_scraper_insecurity_insight.generate_api_transformation_schema import (
     generate_schema,
     compare_api_to_samples,
+    make_api_fingerprint,
+    make_schema_rows,
+    marshall_datasets,
     print_country_codes_analysis,
+    read_api_fingerprints,
+    write_api_fingerprints,
 )
 from hdx_scraper_insecurity_insight.utilities import fetch_json_from_samples
 
@@ -33,6 +39,30 @@ def test_generate_schema_where_no_example_spreadsheet():
     }
 
 
+def test_marshall_datasets_in_process_pool(monkeypatch):
+    dataset_names = [
+        "insecurity-insight-crsv-incidents",
+        "insecurity-insight-crsv-overview",
+        "insecurity-insight-education-incidents",
+    ]
+    written = []
+    monkeypatch.setattr(
+        generate_api_transformation_schema, "list_entities", lambda type_: dataset_names
+    )
+    monkeypatch.setattr(
+        generate_api_transformation_schema,
+        "write_schemas",
+        lambda schemas: {x: written.append((x, y)) for x, y in schemas.items()},
+    )
+
+    status_list = marshall_datasets("all", max_processes=2)
+
+    expected = [make_schema_rows(x, api_fields_basis=True) for x in dataset_names]
+    assert status_list == [x[1] for x in expected]
+    # Rows are written in one batch in attributes order, overviews are not written
+    assert written == [(x, y[0]) for x, y in zip(dataset_names, expected) if len(y[0]) != 0]
+
+
 def test_compare_api_to_samples_same():
     dataset_name = "insecurity-insight-crsv-overview"
     api_cache = {}
@@ -55,6 +85,49 @@ def test_compare_api_to_samples_changed():
     assert len(change_list) == 1
 
 
+def test_compare_api_to_samples_does_not_read_samples(monkeypatch):
+    dataset_name = "insecurity-insight-crsv-overview"
+    api_cache = {dataset_name: fetch_json_from_samples(dataset_name)}
+
+    def fail_to_read_samples(_):
+        raise AssertionError("compare_api_to_samples read a sample")
+
+    monkeypatch.setattr(
+        generate_api_transformation_schema, "fetch_json_from_samples", fail_to_read_samples
+    )
+    api_changed, _ = compare_api_to_samples(api_cache, dataset_names=[dataset_name])
+
+    assert not api_changed
+
+
+def test_compare_api_to_samples_key_order_is_not_a_change():
+    dataset_name = "insecurity-insight-crsv-overview"
+    api_response = fetch_json_from_samples(dataset_name)
+    api_cache = {dataset_name: [dict(reversed(list(x.items()))) for x in api_response]}
+
+    api_changed, _ = compare_api_to_samples(api_cache, dataset_names=[dataset_name])
+
+    assert not api_changed
+
+
+def test_api_fingerprints_match_samples(tmp_path):
+    fingerprints_filepath = str(tmp_path / "api-fingerprints.json")
+    api_fingerprints = write_api_fingerprints(fingerprints_filepath=fingerprints_filepath)
+
+    # The checked in fingerprints need regenerating if the samples change
+    assert read_api_fingerprints() == api_fingerprints
+    assert read_api_fingerprints(fingerprints_filepath) == api_fingerprints
+
+
+def test_make_api_fingerprint():
+    api_fingerprint = make_api_fingerprint([{"a": 1, "b": None}, {"a": "x", "b": 2.0}])
+
+    assert api_fingerprint["keys"] == ["a", "b"]
+    assert api_fingerprint["types"] == {"a": ["int", "str"], "b": ["NoneType", "float"]}
+    assert api_fingerprint["n_records"] == 2
+    assert make_api_fingerprint([{"b": 1, "a": 1}])["hash"] != api_fingerprint["hash"]
+
+
 def test_print_country_codes_analysis():
     dataset_name = "insecurity-insight-crsv-overview"
     api_response = fetch_json_from_samples(dataset_name)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import json
+
+import pytest
+
+from hdx_scraper_insecurity_insight.create_spreadsheets import create_spreadsheet
+from hdx_scraper_insecurity_insight.metrics import (
+    MEMORY_BUDGET_ACTION_VARIABLE,
+    MEMORY_BUDGET_VARIABLE,
+    MemoryBudgetExceeded,
+    configure_memory_tracking,
+    get_spans,
+    make_metrics_report,
+    reset_metrics,
+    span,
+    summarise_spans,
+    write_metrics_report,
+)
+from hdx_scraper_insecurity_insight.utilities import fetch_json
+
+
+def test_span_records_timings_and_counts():
+    reset_metrics()
+    with span("fetch", resource="test-resource") as fetch_metrics:
+        fetch_metrics["records"] = 10
+        fetch_metrics["bytes"] = 100
+
+    spans = get_spans()
+    assert len(spans) == 1
+    assert spans[0]["stage"] == "fetch"
+    assert spans[0]["resource"] == "test-resource"
+    assert spans[0]["records"] == 10
+    assert spans[0]["wall_time"] >= 0.0
+    assert spans[0]["cpu_time"] >= 0.0
+
+
+def test_span_records_failure():
+    reset_metrics()
+    with pytest.raises(ValueError):
+        with span("parse"):
+            raise ValueError("bad response")
+
+    assert get_spans()[0]["failed"]
+
+
+def test_summarise_spans_in_stage_order():
+    spans = [
+        {"stage": "write", "wall_time": 1.0, "cpu_time": 0.5, "records": 5, "bytes": 50},
+        {"stage": "fetch", "wall_time": 2.0, "cpu_time": 0.1, "records": None, "bytes": 10},
+        {"stage": "fetch", "wall_time": 3.0, "cpu_time": 0.1, "records": None, "bytes": 20},
+    ]
+    for item in spans:
+        item["peak_rss_bytes"] = None
+
+    summary = summarise_spans(spans)
+
+    assert [x["stage"] for x in summary] == ["fetch", "write"]
+    assert summary[0]["spans"] == 2
+    assert summary[0]["wall_time"] == 5.0
+    assert summary[0]["bytes"] == 30
+    assert summary[0]["peak_rss_bytes"] is None
+
+
+def test_pipeline_stages_are_instrumented(tmp_path):
+    reset_metrics()
+    api_response = fetch_json("insecurity-insight-crsv-incidents", use_sample=True)
+    create_spreadsheet(
+        "insecurity-insight-crsv-incidents",
+        api_response=api_response,
+        output_directory=str(tmp_path),
+    )
+
+    report = make_metrics_report()
+    stages = [x["stage"] for x in report["stages"]]
+    assert stages == ["fetch", "parse", "censor", "partition", "transform", "write"]
+    write_span = [x for x in report["spans"] if x["stage"] == "write"][0]
+    assert write_span["bytes"] > 0
+    assert write_span["records"] == len(api_response)
+
+    report_filepath = write_metrics_report(report, str(tmp_path / "metrics.json"))
+    with open(report_filepath, encoding="utf-8") as report_file:
+        assert json.load(report_file)["stages"] == report["stages"]
+
+
+@pytest.fixture
+def memory_tracking():
+    yield
+    configure_memory_tracking(trace=False, budget_bytes=None, budget_action="warn")
+
+
+def test_span_records_traced_memory(memory_tracking):
+    configure_memory_tracking(trace=True)
+    reset_metrics()
+    with span("transform", resource="outer"):
+        retained = [bytes(1000) for _ in range(1000)]
+        with span("write", resource="inner"):
+            temporary = bytes(5_000_000)
+            del temporary
+
+    spans = {x["resource"]: x for x in get_spans()}
+    assert spans["inner"]["traced_peak_bytes"] >= 5_000_000
+    # The inner span resets the tracemalloc peak but its peak is credited to the outer span
+    assert spans["outer"]["traced_peak_bytes"] >= spans["inner"]["traced_peak_bytes"]
+    assert spans["outer"]["traced_delta_bytes"] >= 1_000_000
+    assert spans["outer"]["rss_bytes"] is None or spans["outer"]["rss_bytes"] > 0
+
+    report = make_metrics_report()
+    assert report["high_water_mark"]["span"]["resource"] in ["inner", "outer"]
+    assert len(report["high_water_mark"]["allocation_sites"]) != 0
+    assert {x["resource"] for x in report["resources"]} == {"inner", "outer"}
+    del retained
+
+
+def test_memory_budget_warns(memory_tracking, caplog):
+    configure_memory_tracking(budget_bytes=1)
+    reset_metrics()
+    with span("fetch", resource="test-resource"):
+        pass
+    with span("parse", resource="test-resource"):
+        pass
+
+    assert len([x for x in caplog.records if "exceeded" in x.message]) == 1
+    assert make_metrics_report()["memory_budget_exceeded"]
+
+
+def test_memory_budget_fails(memory_tracking):
+    configure_memory_tracking(budget_bytes=1, budget_action="fail")
+    reset_metrics()
+    with pytest.raises(MemoryBudgetExceeded):
+        with span("fetch", resource="test-resource"):
+            pass
+    # The span is recorded before the budget is checked
+    assert len(get_spans()) == 1
+
+
+def test_memory_budget_from_environment(memory_tracking, monkeypatch):
+    monkeypatch.setenv(MEMORY_BUDGET_VARIABLE, "2048")
+    monkeypatch.setenv(MEMORY_BUDGET_ACTION_VARIABLE, "fail")
+    configure_memory_tracking()
+
+    reset_metrics()
+    with span("fetch"):
+        pass
+
+    monkeypatch.setenv(MEMORY_BUDGET_ACTION_VARIABLE, "explode")
+    with pytest.raises(ValueError):
+        configure_memory_tracking()
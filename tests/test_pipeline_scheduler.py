@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import time
+
+import pytest
+
+from hdx_scraper_insecurity_insight.pipeline_scheduler import (
+    Task,
+    order_tasks,
+    run_task_graph,
+    find_critical_path,
+)
+
+
+def add(a: int, b: int) -> int:
+    return a + b
+
+
+def sleep_and_return(value: str, delay: float = 0.1) -> str:
+    time.sleep(delay)
+    return value
+
+
+def fail():
+    raise RuntimeError("Task failed")
+
+
+def test_order_tasks():
+    tasks = [
+        Task("c", add, dependencies=["a", "b"]),
+        Task("b", add, dependencies=["a"]),
+        Task("a", add),
+    ]
+
+    assert order_tasks(tasks) == ["a", "b", "c"]
+
+
+def test_order_tasks_cycle():
+    tasks = [Task("a", add, dependencies=["b"]), Task("b", add, dependencies=["a"])]
+
+    with pytest.raises(ValueError, match="cycle"):
+        order_tasks(tasks)
+
+
+def test_order_tasks_unknown_dependency():
+    with pytest.raises(ValueError, match="unknown task"):
+        order_tasks([Task("a", add, dependencies=["missing"])])
+
+
+def test_run_task_graph_passes_inputs():
+    tasks = [
+        Task("one", add, args=(0, 1)),
+        Task("two", add, args=(1, 1)),
+        Task("three", add, inputs={"a": "one", "b": "two"}),
+    ]
+    results, timings = run_task_graph(tasks)
+
+    assert results == {"one": 1, "two": 2, "three": 3}
+    assert timings["three"][0] >= max(timings["one"][1], timings["two"][1])
+
+
+def test_run_task_graph_runs_independent_tasks_concurrently():
+    tasks = [Task(f"sleep-{i}", sleep_and_return, args=(str(i),)) for i in range(4)]
+    t0 = time.perf_counter()
+    results, _ = run_task_graph(tasks, max_workers=4)
+
+    assert len(results) == 4
+    assert time.perf_counter() - t0 < 0.3
+
+
+def test_run_task_graph_process_executor():
+    tasks = [
+        Task("one", add, args=(0, 1), executor="process"),
+        Task("two", add, args=(1,), inputs={"b": "one"}),
+    ]
+    results, _ = run_task_graph(tasks, max_processes=1)
+
+    assert results["two"] == 2
+
+
+def test_run_task_graph_failure_stops_dependents():
+    tasks = [Task("fail", fail), Task("after", add, args=(1, 1), dependencies=["fail"])]
+
+    with pytest.raises(RuntimeError, match="Task failed"):
+        run_task_graph(tasks)
+
+
+def test_find_critical_path():
+    tasks = [
+        Task("a", add),
+        Task("b", add, dependencies=["a"]),
+        Task("c", add, dependencies=["a"]),
+        Task("d", add, dependencies=["b", "c"]),
+    ]
+    timings = {"a": (0.0, 1.0), "b": (1.0, 2.0), "c": (1.0, 4.0), "d": (4.0, 5.0)}
+    critical_path, duration = find_critical_path(tasks, timings)
+
+    assert critical_path == ["a", "c", "d"]
+    assert duration == 5.0
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import pstats
+
+import pytest
+
+from hdx_scraper_insecurity_insight.create_spreadsheets import create_spreadsheet
+from hdx_scraper_insecurity_insight.profiling import (
+    PROFILE_VARIABLE,
+    profile_run,
+    read_profiler_setting,
+    remove_flag_arguments,
+)
+from hdx_scraper_insecurity_insight.utilities import parse_commandline_arguments
+
+
+def test_read_profiler_setting(monkeypatch):
+    monkeypatch.delenv(PROFILE_VARIABLE, raising=False)
+    assert read_profiler_setting(["run.py"]) is None
+    assert read_profiler_setting(["run.py", "--profile"]) == "cprofile"
+    assert read_profiler_setting(["run.py", "--profile=pyinstrument"]) == "pyinstrument"
+    assert read_profiler_setting(["run.py", "--profile", "pyinstrument"]) == "pyinstrument"
+    assert read_profiler_setting(["run.py", "--profile", "dataset-name"]) == "cprofile"
+
+    monkeypatch.setenv(PROFILE_VARIABLE, "pyinstrument")
+    assert read_profiler_setting(["run.py"]) == "pyinstrument"
+    assert read_profiler_setting(["run.py", "--profile=cprofile"]) == "cprofile"
+
+    monkeypatch.setenv(PROFILE_VARIABLE, "yappi")
+    with pytest.raises(ValueError):
+        read_profiler_setting(["run.py"])
+
+
+def test_remove_flag_arguments(monkeypatch):
+    assert remove_flag_arguments(["run.py", "--profile", "pyinstrument", "dataset-name"]) == [
+        "run.py",
+        "dataset-name",
+    ]
+    assert remove_flag_arguments(["run.py", "--profile", "dataset-name", "PSE"]) == [
+        "run.py",
+        "dataset-name",
+        "PSE",
+    ]
+
+    monkeypatch.setattr(
+        "sys.argv", ["create_spreadsheets.py", "--profile", "pyinstrument", "dataset-name"]
+    )
+    assert parse_commandline_arguments() == ("dataset-name", "")
+
+
+def test_profile_run_off(tmp_path, monkeypatch):
+    monkeypatch.delenv(PROFILE_VARIABLE, raising=False)
+    with profile_run("test", output_directory=str(tmp_path)) as profile_result:
+        pass
+
+    assert profile_result["output_filepath"] is None
+    assert len(os.listdir(tmp_path)) == 0
+
+
+def test_profile_run_cprofile(tmp_path):
+    with profile_run("test", profiler="cprofile", output_directory=str(tmp_path)) as profile_result:
+        create_spreadsheet("insecurity-insight-crsv-overview", output_directory=str(tmp_path))
+
+    assert profile_result["output_filepath"].endswith(".prof")
+    stats = pstats.Stats(profile_result["output_filepath"])
+    assert any(x[2] == "create_spreadsheet" for x in stats.stats)
+
+
+def test_profile_run_pyinstrument(tmp_path):
+    with profile_run(
+        "test", profiler="pyinstrument", output_directory=str(tmp_path)
+    ) as profile_result:
+        sum(range(100000))
+
+    # cProfile is used if pyinstrument is not installed
+    if profile_result["profiler"] == "pyinstrument":
+        assert profile_result["output_filepath"].endswith(".html")
+    else:
+        assert profile_result["output_filepath"].endswith(".prof")
+    assert os.path.isfile(profile_result["output_filepath"])
@@ -1,12 +1,133 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import csv
+import json
+import os
+
+import pytest
+
+from hdx.api.configuration import Configuration
+
+from hdx_scraper_insecurity_insight.create_datasets import (
+    create_or_fetch_base_dataset,
+    dataset_from_inventory,
+)
+from hdx_scraper_insecurity_insight.fake_ckan import (
+    INSECURITY_INSIGHT_ORGANIZATION,
+    FakeCKANServer,
+)
 from hdx_scraper_insecurity_insight.read_insecurity_insight_hdx import (
+    clear_organization_inventory,
     create_insecurity_insight_resource_list,
+    get_latest_date,
+    read_organization_inventory,
+    write_inventory_csv,
+    write_inventory_json,
 )
 
+DATASET_NAME = "insecurity-insight-crsv-dataset"
+
+
+@pytest.fixture
+def fake_ckan():
+    with FakeCKANServer() as server:
+        server.configure_hdx()
+        for dataset_name in [DATASET_NAME, "insecurity-insight-education-dataset"]:
+            server.add_dataset(
+                {
+                    "name": dataset_name,
+                    "title": dataset_name.replace("-", " ").title(),
+                    "owner_org": INSECURITY_INSIGHT_ORGANIZATION["id"],
+                    "dataset_date": "[2020-01-01T00:00:00 TO 2024-05-28T23:59:59]",
+                    "resources": [
+                        {"name": f"{dataset_name}-{x}.xlsx", "format": "XLSX"} for x in range(2)
+                    ],
+                }
+            )
+        server.add_dataset({"name": "another-organization-dataset", "owner_org": "other"})
+        yield server
+    Configuration.delete()
+
 
 def test_create_insecurity_insight_resource_list():
     n_datasets, _ = create_insecurity_insight_resource_list()
 
     assert n_datasets == 38
+
+
+def test_read_organization_inventory(fake_ckan, tmp_path):
+    inventory = read_organization_inventory(inventory_directory=str(tmp_path), max_workers=2)
+
+    assert sorted(inventory["datasets"]) == [DATASET_NAME, "insecurity-insight-education-dataset"]
+    assert len(inventory["datasets"][DATASET_NAME]["resources"]) == 2
+    assert fake_ckan.call_counts["package_show"] == 2
+    assert create_insecurity_insight_resource_list(inventory=inventory) == (2, 4)
+
+
+def test_read_organization_inventory_reuses_cache(fake_ckan, tmp_path):
+    read_organization_inventory(inventory_directory=str(tmp_path))
+    fake_ckan.reset_call_counts()
+
+    read_organization_inventory(inventory_directory=str(tmp_path))
+    assert sum(fake_ckan.call_counts.values()) == 0
+
+    read_organization_inventory(inventory_directory=str(tmp_path), ttl_hours=0)
+    assert fake_ckan.call_counts["package_show"] == 2
+
+    clear_organization_inventory(inventory_directory=str(tmp_path))
+    assert not os.path.exists(tmp_path / "inventory-stage.json")
+
+
+def test_read_organization_inventory_checks_hdx_site_url(fake_ckan, tmp_path):
+    inventory = read_organization_inventory(inventory_directory=str(tmp_path))
+    inventory["hdx_site_url"] = "https://stage.data-humdata-org.ahconu.org"
+    with open(tmp_path / "inventory-stage.json", "w", encoding="utf-8") as inventory_file:
+        json.dump(inventory, inventory_file)
+    fake_ckan.reset_call_counts()
+
+    inventory = read_organization_inventory(inventory_directory=str(tmp_path))
+
+    assert inventory["hdx_site_url"] == fake_ckan.url
+    assert fake_ckan.call_counts["package_show"] == 2
+
+
+def test_write_inventory_outputs(fake_ckan, tmp_path):
+    inventory = read_organization_inventory(inventory_directory=str(tmp_path))
+    write_inventory_json(inventory, str(tmp_path / "inventory.json"))
+    write_inventory_csv(inventory, str(tmp_path / "inventory.csv"))
+
+    with open(tmp_path / "inventory.json", encoding="utf-8") as inventory_file:
+        assert json.load(inventory_file) == inventory
+    with open(tmp_path / "inventory.csv", encoding="utf-8") as inventory_file:
+        rows = list(csv.DictReader(inventory_file))
+    assert len(rows) == 4
+    assert rows[0]["dataset_name"] == DATASET_NAME
+    assert rows[0]["latest_date"] == "2024-05-28"
+    assert rows[0]["resource_name"] == f"{DATASET_NAME}-0.xlsx"
+
+
+def test_dataset_cache_from_inventory(fake_ckan, tmp_path):
+    inventory = read_organization_inventory(inventory_directory=str(tmp_path))
+    fake_ckan.reset_call_counts()
+
+    dataset, is_new = create_or_fetch_base_dataset(
+        DATASET_NAME, use_legacy=False, inventory=inventory
+    )
+
+    assert not is_new
+    assert [x["name"] for x in dataset.get_resources()] == [
+        f"{DATASET_NAME}-0.xlsx",
+        f"{DATASET_NAME}-1.xlsx",
+    ]
+    assert sum(fake_ckan.call_counts.values()) == 0
+    # Datasets are copies so changes made during an update do not reach the inventory
+    dataset["title"] = "Changed"
+    assert inventory["datasets"][DATASET_NAME]["title"] != "Changed"
+    assert dataset_from_inventory(inventory, "no-such-dataset") is None
+
+
+def test_get_latest_date():
+    assert get_latest_date("[2020-01-01T00:00:00 TO 2024-05-28T23:59:59]") == "2024-05-28"
+    assert get_latest_date("") == ""
+    assert get_latest_date(None) == ""
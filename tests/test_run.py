@@ -1,12 +1,23 @@
 #!/usr/bin/env python
 # encoding: utf-8
+import time
+from unittest import mock
+
 import pytest
 
+from hdx_scraper_insecurity_insight import run
+from hdx_scraper_insecurity_insight.upload_queue import UploadFailed, record_upload, reset_uploads
 from hdx_scraper_insecurity_insight.run import (
+    COMMANDS,
+    main,
+    make_argument_parser,
+    run_pipeline,
+    refresh_country_spreadsheets,
     parse_dates_from_string,
     fetch_and_cache_datasets,
     fetch_and_cache_api_responses,
     decide_which_resources_have_fresh_data,
+    check_uploads,
     # refresh_spreadsheets_with_fresh_data,
     # update_datasets_whose_resources_have_changed,
 )
@@ -106,3 +117,182 @@ def test_refresh_spreadsheets_with_fresh_data():
 
 def test_update_datasets_whose_resources_have_changed():
     pass
+
+
+REAL_FETCH_AND_CACHE_API_RESPONSES = run.fetch_and_cache_api_responses
+
+
+def fake_create_datasets_in_hdx(dataset_name, country_filter="", **kwargs):
+    # Stands in for the HDX round trips of a dataset update
+    time.sleep(0.05)
+    if country_filter:
+        dataset_name = dataset_name.replace("country", country_filter.lower())
+    return {"name": dataset_name}, 0
+
+
+def fetch_crsv_api_responses(use_sample=False, state_directory=None):
+    # Only some endpoints have samples in api-samples
+    return REAL_FETCH_AND_CACHE_API_RESPONSES(
+        use_sample=use_sample, refresh=["crsv"], state_directory=state_directory
+    )
+
+
+def fake_create_or_fetch_base_dataset(dataset_name, country_filter="", **kwargs):
+    time.sleep(0.05)
+    # No dataset dates so that only the refreshed topic is updated
+    return {"name": dataset_name, "dataset_date": ""}, False
+
+
+@mock.patch(
+    "hdx_scraper_insecurity_insight.run.create_or_fetch_base_dataset",
+    fake_create_or_fetch_base_dataset,
+)
+@mock.patch(
+    "hdx_scraper_insecurity_insight.run.create_datasets_in_hdx", fake_create_datasets_in_hdx
+)
+@mock.patch(
+    "hdx_scraper_insecurity_insight.run.fetch_and_cache_api_responses", fetch_crsv_api_responses
+)
+@mock.patch("hdx_scraper_insecurity_insight.run.check_api_has_not_changed")
+def test_run_pipeline(mock_check, tmp_path):
+    mock_check.return_value = (False, [])
+    with mock.patch(
+        "hdx_scraper_insecurity_insight.create_spreadsheets.OUTPUT_DIRECTORY", str(tmp_path)
+    ):
+        items_to_update, missing_report = run_pipeline(
+            use_sample=True, dry_run=True, refresh=["crsv"], max_workers=8
+        )
+
+    assert [x[0] for x in items_to_update] == ["crsv"]
+    assert missing_report == []
+    assert len(list(tmp_path.iterdir())) > 1
+
+
+def test_fetch_and_cache_api_responses_uses_checkpoint(tmp_path):
+    api_cache = fetch_and_cache_api_responses(
+        use_sample=True, refresh=["crsv-overview"], state_directory=str(tmp_path)
+    )
+    assert len(api_cache) == 1
+
+    with mock.patch("hdx_scraper_insecurity_insight.run.fetch_json") as mock_fetch:
+        resumed_api_cache = fetch_and_cache_api_responses(
+            use_sample=True, refresh=["crsv-overview"], state_directory=str(tmp_path)
+        )
+
+    mock_fetch.assert_not_called()
+    assert resumed_api_cache == api_cache
+
+
+def test_refresh_country_spreadsheets_skips_completed(tmp_path):
+    state_directory = str(tmp_path / "run-state")
+    with mock.patch(
+        "hdx_scraper_insecurity_insight.run.create_spreadsheet", return_value="status"
+    ) as mock_create:
+        api_cache = {"insecurity-insight-crsv-incidents": []}
+        refresh_country_spreadsheets("NGA", api_cache, state_directory=state_directory)
+        refresh_country_spreadsheets("NGA", api_cache, state_directory=state_directory)
+
+    assert mock_create.call_count == 1
+
+
+def test_refresh_country_spreadsheets_regenerates_missing_files(tmp_path):
+    state_directory = str(tmp_path / "run-state")
+    with mock.patch(
+        "hdx_scraper_insecurity_insight.create_spreadsheets.OUTPUT_DIRECTORY", str(tmp_path)
+    ), mock.patch(
+        "hdx_scraper_insecurity_insight.run.create_spreadsheet",
+        return_value="Output filename `PSE.xlsx`",
+    ) as mock_create:
+        api_cache = {"insecurity-insight-crsv-incidents": []}
+        refresh_country_spreadsheets("PSE", api_cache, state_directory=state_directory)
+        # Only run-state was restored so the spreadsheet is regenerated
+        refresh_country_spreadsheets("PSE", api_cache, state_directory=state_directory)
+        (tmp_path / "PSE.xlsx").write_bytes(b"")
+        refresh_country_spreadsheets("PSE", api_cache, state_directory=state_directory)
+
+    assert mock_create.call_count == 2
+
+
+def test_argument_parser():
+    arguments = make_argument_parser().parse_args(
+        ["upload", "--topics", "crsv", "education", "--countries", "pse", "--dry-run"]
+    )
+
+    assert arguments.command == "upload"
+    assert arguments.topics == ["crsv", "education"]
+    assert arguments.countries == ["PSE"]
+    assert arguments.dry_run
+    assert arguments.use_legacy
+    assert arguments.hdx_site == "prod"
+    assert arguments.refresh == []
+
+
+def test_main_runs_all_without_a_command(tmp_path):
+    with mock.patch.dict(COMMANDS, {"all": mock.Mock(return_value=[])}):
+        main(["--resume", "--state-dir", str(tmp_path / "state"), "--report-dir", str(tmp_path)])
+        arguments = COMMANDS["all"].call_args[0][0]
+
+    assert arguments.command == "all"
+    assert arguments.resume
+    assert len(list(tmp_path.glob("metrics-*.json"))) == 1
+
+
+@mock.patch(
+    "hdx_scraper_insecurity_insight.run.create_or_fetch_base_dataset",
+    fake_create_or_fetch_base_dataset,
+)
+@mock.patch(
+    "hdx_scraper_insecurity_insight.run.create_datasets_in_hdx", fake_create_datasets_in_hdx
+)
+def test_main_runs_stages_separately(tmp_path):
+    options = [
+        "--sample",
+        "--topics",
+        "crsv",
+        "--countries",
+        "PSE",
+        "--state-dir",
+        str(tmp_path / "state"),
+        "--report-dir",
+        str(tmp_path / "reports"),
+        "--hashes-dir",
+        str(tmp_path / "hashes"),
+    ]
+    fetched = main(["fetch"] + options)
+    assert "insecurity-insight-crsv-incidents" in fetched
+
+    with mock.patch("hdx_scraper_insecurity_insight.run.fetch_json") as mock_fetch:
+        items_to_update = main(["plan", "--refresh", "crsv"] + options)
+        mock_fetch.assert_not_called()
+    assert [x[0] for x in items_to_update] == ["crsv"]
+
+    output_directory = tmp_path / "output"
+    output_directory.mkdir()
+    with mock.patch(
+        "hdx_scraper_insecurity_insight.create_spreadsheets.OUTPUT_DIRECTORY",
+        str(output_directory),
+    ):
+        # The plan made by the previous stage is used
+        assert main(["spreadsheets"] + options) == items_to_update
+    assert any("PSE" in x.name for x in output_directory.iterdir())
+
+    assert main(["upload", "--parallel"] + options) == []
+    assert (tmp_path / "hashes" / "content-hashes.json").exists()
+    assert len(list((tmp_path / "reports").glob("metrics-*.json"))) == 4
+
+
+def test_check_uploads():
+    reset_uploads()
+    record_upload("upload:crsv", status="uploaded", attempts=2, seconds=1.0)
+    record_upload("upload:PSE", status="uploaded", attempts=1, seconds=0.5)
+
+    missing_report = check_uploads([["insecurity-insight-pse-dataset", 1]], ["upload:crsv"])
+    assert missing_report == [
+        ["insecurity-insight-pse-dataset", 1],
+        ["upload:crsv", "uploaded on attempt 2"],
+    ]
+
+    record_upload("upload:PSE", status="failed", attempts=3, error="HDXError: failed")
+    with pytest.raises(UploadFailed):
+        check_uploads([], ["upload:crsv", "upload:PSE"])
+    reset_uploads()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import copy
+import json
+
+import pytest
+
+from hdx_scraper_insecurity_insight.generate_api_transformation_schema import (
+    compare_api_profiles_to_samples,
+    make_api_fingerprint,
+)
+from hdx_scraper_insecurity_insight.schema_profile import (
+    SCHEMA_DRIFT_ACTION_VARIABLE,
+    SchemaDriftDetected,
+    compare_schema_profiles,
+    handle_schema_drift,
+    make_profiling_hook,
+    reset_schema_profiles,
+    start_schema_profile,
+    summarise_schema_profile,
+)
+from hdx_scraper_insecurity_insight.utilities import fetch_json, fetch_json_from_samples
+
+DATASET_NAME = "insecurity-insight-crsv-incidents"
+API_RESPONSE = fetch_json_from_samples(DATASET_NAME)
+STORED_PROFILE = make_api_fingerprint(API_RESPONSE)["profile"]
+
+
+def profile_while_parsing(api_response: list[dict]) -> dict:
+    schema_profile = start_schema_profile()
+    json.loads(json.dumps(api_response), object_hook=make_profiling_hook(schema_profile))
+    return summarise_schema_profile(schema_profile)
+
+
+def test_profile_while_parsing_matches_stored_profile():
+    schema_profile = profile_while_parsing(API_RESPONSE)
+
+    assert schema_profile == STORED_PROFILE
+    assert schema_profile["n_records"] == len(API_RESPONSE)
+    assert compare_schema_profiles(schema_profile, STORED_PROFILE) == []
+
+
+def test_summarise_schema_profile():
+    schema_profile = profile_while_parsing([{"a": 1, "b": None}, {"a": 1}, {"a": "x", "c": 1.5}])
+
+    assert schema_profile["fields"]["a"] == {
+        "types": {"int": 2, "str": 1},
+        "first_record": 0,
+        "presence_rate": 1.0,
+        "null_rate": 0.0,
+        "cardinality": 2,
+        "cardinality_capped": False,
+        "distinct_rate": 0.6667,
+    }
+    assert schema_profile["fields"]["b"]["null_rate"] == 1.0
+    assert schema_profile["fields"]["c"]["first_record"] == 2
+
+
+def test_compare_schema_profiles_finds_drift():
+    api_response = copy.deepcopy(API_RESPONSE)
+    for api_row in api_response[0:200]:
+        api_row["Country"] = None
+    api_response[10]["SIND Event ID"] = "123"
+    api_response[-1]["New Field"] = 1
+
+    drift = compare_schema_profiles(profile_while_parsing(api_response), STORED_PROFILE)
+
+    assert any(x.startswith("Country null rate") for x in drift)
+    assert any(x.startswith("SIND Event ID has new types ['str']") for x in drift)
+    assert f"New Field is new, first seen in record {len(api_response) - 1}" in drift
+    assert len(drift) == 3
+
+
+def test_compare_schema_profiles_tolerances():
+    api_response = copy.deepcopy(API_RESPONSE)
+    for api_row in api_response[0:20]:
+        api_row["Country"] = None
+
+    assert compare_schema_profiles(profile_while_parsing(api_response), STORED_PROFILE) == []
+    assert (
+        len(
+            compare_schema_profiles(
+                profile_while_parsing(api_response), STORED_PROFILE, tolerances={"null_rate": 0.0}
+            )
+        )
+        == 1
+    )
+
+
+def test_compare_api_profiles_to_samples_uses_fetch_profiles():
+    reset_schema_profiles()
+    assert compare_api_profiles_to_samples(dataset_names=[DATASET_NAME]) == {}
+
+    fetch_json(DATASET_NAME, use_sample=True)
+
+    assert compare_api_profiles_to_samples(dataset_names=[DATASET_NAME]) == {DATASET_NAME: []}
+
+
+def test_handle_schema_drift(monkeypatch):
+    drift_report = {DATASET_NAME: ["Country null rate is 50.0%, expected 0.0%"]}
+    handle_schema_drift(drift_report)
+    handle_schema_drift({DATASET_NAME: []})
+
+    monkeypatch.setenv(SCHEMA_DRIFT_ACTION_VARIABLE, "fail")
+    handle_schema_drift({DATASET_NAME: []})
+    with pytest.raises(SchemaDriftDetected):
+        handle_schema_drift(drift_report)
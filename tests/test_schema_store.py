@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+
+import pytest
+
+from hdx_scraper_insecurity_insight import schema_store
+from hdx_scraper_insecurity_insight.schema_store import (
+    has_schema,
+    read_schema_rows,
+    upsert_schemas,
+)
+from hdx_scraper_insecurity_insight.utilities import SCHEMA_FILEPATH, read_schema
+
+FIELDNAMES = ["dataset_name", "upstream", "field_name", "field_number", "terms"]
+
+
+def make_rows(dataset_name: str, n_rows: int, terms: str = "#tag") -> list[dict]:
+    return [
+        {
+            "dataset_name": dataset_name,
+            "upstream": f"field {i}",
+            "field_name": f"Field {i}",
+            "field_number": i,
+            "terms": terms,
+        }
+        for i in range(n_rows)
+    ]
+
+
+def test_upsert_schemas(tmp_path):
+    schema_filepath = str(tmp_path / "schema.csv")
+
+    statuses = upsert_schemas(schema_filepath, {"a": make_rows("a", 2), "b": make_rows("b", 3)})
+    assert statuses == {"a": "added", "b": "added"}
+    assert len(read_schema_rows(schema_filepath, "b")) == 3
+    assert read_schema_rows(schema_filepath, "a")[1]["field_number"] == "1"
+
+    statuses = upsert_schemas(
+        schema_filepath, {"a": make_rows("a", 1, terms="#new"), "c": make_rows("c", 1)}
+    )
+    assert statuses == {"a": "replaced", "c": "added"}
+    assert upsert_schemas(schema_filepath, {"a": make_rows("a", 4)}, replace=False) == {
+        "a": "unchanged"
+    }
+
+    with open(schema_filepath, "r", encoding="utf-8") as schema_file:
+        lines = schema_file.read().splitlines()
+    # Replaced datasets keep their place in the file
+    assert lines[0] == ",".join(FIELDNAMES)
+    assert [x.split(",")[0] for x in lines[1:]] == ["a", "b", "b", "b", "c"]
+    assert lines[1].endswith("#new")
+
+
+def test_index_is_reused_until_file_changes(tmp_path, monkeypatch):
+    schema_filepath = str(tmp_path / "schema.csv")
+    upsert_schemas(schema_filepath, {"a": make_rows("a", 2)})
+    n_reads = []
+    read_schema_file = schema_store.read_schema_file
+    monkeypatch.setattr(
+        schema_store, "read_schema_file", lambda x: n_reads.append(x) or read_schema_file(x)
+    )
+
+    assert has_schema(schema_filepath, "a")
+    assert not has_schema(schema_filepath, "b")
+    assert len(n_reads) == 1
+
+    with open(schema_filepath, "a", encoding="utf-8") as schema_file:
+        schema_file.write("b,field 0,Field 0,0,#tag\n")
+    assert has_schema(schema_filepath, "b")
+    assert len(n_reads) == 2
+
+
+def test_failed_write_leaves_schema_unchanged(tmp_path, monkeypatch):
+    schema_filepath = str(tmp_path / "schema.csv")
+    upsert_schemas(schema_filepath, {"a": make_rows("a", 2)})
+    with open(schema_filepath, "rb") as schema_file:
+        original_content = schema_file.read()
+
+    def fail_to_sync(_):
+        raise OSError("Disk full")
+
+    monkeypatch.setattr(schema_store.os, "fsync", fail_to_sync)
+    with pytest.raises(OSError):
+        upsert_schemas(schema_filepath, {"b": make_rows("b", 2)})
+
+    with open(schema_filepath, "rb") as schema_file:
+        assert schema_file.read() == original_content
+    assert os.listdir(tmp_path) == ["schema.csv"]
+
+
+def test_read_schema_uses_the_store():
+    hdx_row, row_template = read_schema("insecurity-insight-crsv-incidents")
+
+    rows = read_schema_rows(SCHEMA_FILEPATH, "insecurity-insight-crsv-incidents")
+    assert list(row_template.keys()) == [x["field_name"] for x in rows]
+    assert hdx_row["Date"] == "#date +occurred"
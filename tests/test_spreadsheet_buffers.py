@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import pandas
+
+from hdx_scraper_insecurity_insight.create_datasets import (
+    find_resource_filepath,
+    get_date_range_from_resource_file,
+)
+from hdx_scraper_insecurity_insight.create_spreadsheets import create_spreadsheet
+from hdx_scraper_insecurity_insight import spreadsheet_buffers as spreadsheet_buffers_module
+from hdx_scraper_insecurity_insight.spreadsheet_buffers import SpreadsheetBuffers
+from hdx_scraper_insecurity_insight.utilities import fetch_json_from_samples, read_attributes
+
+DATASET_NAME = "insecurity-insight-crsv-incidents"
+SAMPLE_RESPONSE = fetch_json_from_samples(DATASET_NAME)
+EXPECTED_FILENAME = "2020-2025 Conflict Related Sexual Violence Incident Data.xlsx"
+
+
+def test_spreadsheet_buffers_add_and_read():
+    with SpreadsheetBuffers() as spreadsheet_buffers:
+        filepath = spreadsheet_buffers.add("test.csv", b"a,b\n1,2\n")
+
+        assert spreadsheet_buffers.filenames() == ["test.csv"]
+        assert os.path.basename(filepath) == "test.csv"
+        assert spreadsheet_buffers.read("test.csv") == b"a,b\n1,2\n"
+        with open(filepath, "rb") as buffer_file:
+            assert buffer_file.read() == b"a,b\n1,2\n"
+
+    assert spreadsheet_buffers.filenames() == []
+
+
+def test_spreadsheet_buffers_spill_when_memory_limit_reached():
+    with SpreadsheetBuffers(memory_limit=4) as spreadsheet_buffers:
+        filepath = spreadsheet_buffers.add("test.csv", b"a,b\n1,2\n")
+
+        assert spreadsheet_buffers.memory_bytes == 0
+        assert os.path.exists(filepath)
+        assert os.path.basename(filepath) == "test.csv"
+        assert spreadsheet_buffers.read("test.csv") == b"a,b\n1,2\n"
+
+    assert not os.path.exists(filepath)
+
+
+def test_spreadsheet_buffers_concurrent_add():
+    content = b"a,b\n1,2\n"
+    with SpreadsheetBuffers(memory_limit=20 * len(content)) as spreadsheet_buffers:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            filepaths = list(
+                executor.map(lambda i: spreadsheet_buffers.add(f"{i}.csv", content), range(40))
+            )
+
+        # One directory of each kind and the memory limit is kept
+        assert len({os.path.dirname(x) for x in filepaths}) == 2
+        assert spreadsheet_buffers.memory_bytes == 20 * len(content)
+        assert sorted(spreadsheet_buffers.filenames()) == sorted(f"{i}.csv" for i in range(40))
+        assert all(spreadsheet_buffers.read(f"{i}.csv") == content for i in range(40))
+
+    assert not any(os.path.exists(x) for x in filepaths)
+    assert not any(os.path.exists(os.path.dirname(x)) for x in filepaths)
+
+
+def test_spreadsheet_buffers_without_memory_filesystem(tmp_path, caplog):
+    with mock.patch.object(
+        spreadsheet_buffers_module, "MEMORY_FILESYSTEM", str(tmp_path / "no-shm")
+    ):
+        with SpreadsheetBuffers() as spreadsheet_buffers:
+            with caplog.at_level(logging.INFO):
+                spreadsheet_buffers.add("1.csv", b"a,b\n1,2\n")
+                spreadsheet_buffers.add("2.csv", b"a,b\n1,2\n")
+
+            assert spreadsheet_buffers.memory_bytes == 0
+            assert spreadsheet_buffers.read("2.csv") == b"a,b\n1,2\n"
+
+    assert caplog.text.count("No in-memory filesystem") == 1
+    assert "Memory limit reached" not in caplog.text
+
+
+def test_create_spreadsheet_in_memory():
+    temp_directory = os.path.join(os.path.dirname(__file__), "temp")
+    persisted_filepath = os.path.join(temp_directory, EXPECTED_FILENAME)
+    if os.path.exists(persisted_filepath):
+        os.remove(persisted_filepath)
+
+    with SpreadsheetBuffers() as spreadsheet_buffers:
+        status = create_spreadsheet(
+            DATASET_NAME, api_response=SAMPLE_RESPONSE, spreadsheet_buffers=spreadsheet_buffers
+        )
+
+        assert EXPECTED_FILENAME in status
+        assert not os.path.exists(persisted_filepath)
+        sheets_df = pandas.read_excel(spreadsheet_buffers.get_filepath(EXPECTED_FILENAME))
+        assert len(sheets_df) == len(SAMPLE_RESPONSE)
+
+        resource_filepath = find_resource_filepath(
+            DATASET_NAME,
+            read_attributes(DATASET_NAME),
+            spreadsheet_directory=temp_directory,
+            spreadsheet_buffers=spreadsheet_buffers,
+        )
+        assert os.path.basename(resource_filepath) == EXPECTED_FILENAME
+
+        _, end_date = get_date_range_from_resource_file(
+            resource_filepath, spreadsheet_buffers=spreadsheet_buffers
+        )
+        assert end_date.startswith("2025")
+
+
+def test_create_spreadsheet_in_memory_persisted():
+    temp_directory = os.path.join(os.path.dirname(__file__), "temp")
+    persisted_filepath = os.path.join(temp_directory, EXPECTED_FILENAME)
+    if os.path.exists(persisted_filepath):
+        os.remove(persisted_filepath)
+
+    with SpreadsheetBuffers(persist_directory=temp_directory) as spreadsheet_buffers:
+        create_spreadsheet(
+            DATASET_NAME, api_response=SAMPLE_RESPONSE, spreadsheet_buffers=spreadsheet_buffers
+        )
+
+    assert os.path.exists(persisted_filepath)
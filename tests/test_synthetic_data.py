@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from hdx_scraper_insecurity_insight.create_spreadsheets import create_spreadsheet
+from hdx_scraper_insecurity_insight.synthetic_data import (
+    count_sample_records,
+    generate_api_response,
+    generate_scaled_api_response,
+)
+from hdx_scraper_insecurity_insight.utilities import (
+    filter_json_rows,
+    read_upstream_fields,
+)
+
+
+def test_generate_api_response_follows_schema():
+    api_response = generate_api_response(
+        "insecurity-insight-crsv-incidents", 100, countries=["SDN", "PSE"]
+    )
+
+    assert len(api_response) == 100
+    assert list(api_response[0].keys()) == read_upstream_fields("insecurity-insight-crsv-incidents")
+    assert {x["Country ISO"] for x in api_response} == {"SDN", "PSE"}
+    assert all(len(x["Date"]) == 10 for x in api_response)
+    assert all(x["Number of Reported Victims"].isdigit() for x in api_response)
+
+
+def test_generate_api_response_overview():
+    api_response = generate_api_response("insecurity-insight-crsv-overview", 10)
+
+    assert all(len(x["Year"]) == 4 for x in api_response)
+    assert all(x["Recorded SV Events"].isdigit() for x in api_response)
+
+
+def test_generate_api_response_is_repeatable():
+    first = generate_api_response("insecurity-insight-education-incidents", 10, seed=1)
+    second = generate_api_response("insecurity-insight-education-incidents", 10, seed=1)
+
+    assert first == second
+
+
+def test_generate_scaled_api_response():
+    api_response = generate_scaled_api_response("insecurity-insight-crsv-overview", 2)
+
+    assert len(api_response) == 2 * count_sample_records("insecurity-insight-crsv-overview")
+
+
+def test_synthetic_data_creates_spreadsheet(tmp_path):
+    api_response = generate_api_response(
+        "insecurity-insight-aidworkerKIKA-incidents", 200, countries=["AFG", "PSE"]
+    )
+
+    assert len(filter_json_rows("AFG", "", api_response)) < 200
+    status = create_spreadsheet(
+        "insecurity-insight-aidworkerKIKA-incidents",
+        api_response=api_response,
+        output_directory=str(tmp_path),
+    )
+    assert "Output filename" in status
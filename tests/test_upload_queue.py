@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import threading
+import time
+
+import pytest
+
+from hdx_scraper_insecurity_insight.upload_queue import (
+    UploadQueue,
+    get_upload,
+    make_upload_report_rows,
+    reset_uploads,
+    run_upload,
+    summarise_uploads,
+)
+
+
+@pytest.fixture(autouse=True)
+def uploads():
+    reset_uploads()
+    yield
+    reset_uploads()
+
+
+def make_flaky_upload(n_failures: int):
+    calls = []
+
+    def flaky_upload(value):
+        calls.append(value)
+        if len(calls) <= n_failures:
+            raise ConnectionError(f"failure {len(calls)}")
+        return [["dataset", value]]
+
+    return flaky_upload, calls
+
+
+def test_run_upload_retries():
+    flaky_upload, calls = make_flaky_upload(2)
+
+    result = run_upload("dataset", flaky_upload, 1, max_attempts=3, backoff_seconds=0)
+
+    assert result == [["dataset", 1]]
+    assert len(calls) == 3
+    upload = get_upload("dataset")
+    assert upload["status"] == "uploaded"
+    assert upload["attempts"] == 3
+    assert upload["error"] is None
+    assert make_upload_report_rows() == [["dataset", "uploaded on attempt 3"]]
+
+
+def test_run_upload_records_failure():
+    flaky_upload, calls = make_flaky_upload(5)
+
+    assert run_upload("dataset", flaky_upload, 1, max_attempts=2, backoff_seconds=0) is None
+
+    assert len(calls) == 2
+    upload = get_upload("dataset")
+    assert upload["status"] == "failed"
+    assert upload["error"] == "ConnectionError: failure 2"
+    assert make_upload_report_rows() == [["dataset", "upload failed after 2 attempts"]]
+
+
+def test_upload_queue_bounds_workers():
+    lock = threading.Lock()
+    running = []
+    max_running = []
+
+    def slow_upload(value):
+        with lock:
+            running.append(value)
+            max_running.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(value)
+        return value
+
+    with UploadQueue(max_workers=2, backoff_seconds=0) as upload_queue:
+        for i in range(6):
+            upload_queue.submit(f"dataset-{i}", slow_upload, i)
+
+    assert max(max_running) == 2
+    assert upload_queue.results == {f"dataset-{i}": i for i in range(6)}
+    assert upload_queue.list_failed() == []
+
+
+def test_upload_queue_carries_on_after_failure():
+    flaky_upload, _ = make_flaky_upload(10)
+
+    with UploadQueue(max_workers=2, max_attempts=2, backoff_seconds=0) as upload_queue:
+        upload_queue.submit("failing-dataset", flaky_upload, 1)
+        upload_queue.submit("dataset", lambda: [])
+        with pytest.raises(ValueError):
+            upload_queue.submit("dataset", lambda: [])
+
+    assert upload_queue.results == {"dataset": []}
+    assert upload_queue.list_failed() == ["failing-dataset"]
+    summary = summarise_uploads()
+    assert summary["n_uploads"] == 2
+    assert summary["n_uploaded"] == 1
+    assert summary["n_failed"] == 1
+    assert summary["n_retried"] == 1
+    assert summary["n_attempts"] == 3
+    assert summary["max_seconds"] >= summary["mean_seconds"]
@@ -15,12 +15,14 @@ from hdx_scraper_insecurity_insight.utilities import (
     list_entities,
     parse_commandline_arguments,
     print_banner_to_log,
+    project_api_response,
     read_attributes,
     read_insecurity_insight_attributes_pages,
     read_insecurity_insight_resource_attributes,
     read_countries,
     read_field_mappings,
     read_schema,
+    read_upstream_fields,
     write_dictionary,
     write_schema,
 )
@@ -44,6 +46,26 @@ def test_read_schema_overview():
     assert len(hdx_row.keys()) == 10
 
 
+def test_read_upstream_fields_current_year():
+    upstream_fields = read_upstream_fields("insecurity-insight-crsv-incidents-current-year")
+    _, row_template = read_schema("insecurity-insight-crsv-incidents")
+
+    assert upstream_fields == list(row_template.values())
+
+
+def test_project_api_response():
+    dataset_name = "insecurity-insight-crsv-incidents"
+    sample_response = fetch_json_from_samples(dataset_name)
+    for record in sample_response:
+        record["Unused Field"] = "unused"
+    projected_response = project_api_response(dataset_name, sample_response)
+
+    _, row_template = read_schema(dataset_name)
+    assert len(projected_response) == len(sample_response)
+    assert list(projected_response[0].keys()) == list(row_template.values())
+    assert "Unused Field" not in projected_response[0]
+
+
 def test_read_attributes():
     dataset_name = "insecurity-insight-crsv-incidents"
     attributes = read_attributes(dataset_name)
@@ -287,6 +309,14 @@ def test_write_dictionary_to_local_file():
     assert "New file" in status
     assert "is being created" in status
 
+    status = write_dictionary(temp_file_path, dict_list[0:1])
+
+    with open(temp_file_path, "r", encoding="utf-8") as file_handle:
+        rows_read = list(csv.DictReader(file_handle))
+
+    assert len(rows_read) == 4
+    assert "data is being appended" in status
+
 
 def test_write_schema():
     dataset_name = "insecurity-insight-crsv-incidents"
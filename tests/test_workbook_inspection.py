@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+
+import pandas
+import pytest
+
+from hdx_scraper_insecurity_insight.workbook_inspection import (
+    make_column_names,
+    read_workbook_column,
+    read_workbook_rows,
+)
+
+SPREADSHEET_SAMPLE = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "src",
+    "hdx_scraper_insecurity_insight",
+    "spreadsheet-samples",
+    "2020-2023-conflict-related-sexual-violence-crsv-incident-data.xlsx",
+)
+FIXTURE = os.path.join(
+    os.path.dirname(__file__), "fixtures", "2023-MMR Attacks on Health Care Incident Data.xlsx"
+)
+
+
+def test_read_workbook_rows_matches_read_excel():
+    column_names, hxl_tags = read_workbook_rows(SPREADSHEET_SAMPLE, n_rows=2)
+    sheet_df = pandas.read_excel(SPREADSHEET_SAMPLE, nrows=1)
+
+    assert column_names == sheet_df.columns.tolist()
+    assert hxl_tags == [None if isinstance(x, float) else x for x in sheet_df.loc[0, :].tolist()]
+    assert hxl_tags[0].startswith("#date")
+
+
+def test_read_workbook_rows_mangles_repeated_columns():
+    column_names = read_workbook_rows(FIXTURE, n_rows=1)[0]
+
+    assert column_names == pandas.read_excel(FIXTURE, nrows=0).columns.tolist()
+    assert "Health Workers Killed.1" in column_names
+
+
+def test_read_workbook_column():
+    dates = read_workbook_column(FIXTURE, "Date")
+
+    assert dates == pandas.read_excel(FIXTURE)["Date"].tolist()
+    with pytest.raises(KeyError):
+        read_workbook_column(FIXTURE, "Not a column")
+
+
+def test_make_column_names():
+    assert make_column_names(["a", None, "a", "a", 1]) == ["a", "Unnamed: 1", "a.1", "a.2", "1"]